@@ -1,52 +1,133 @@
 ################################################################################
 # Q-Chef Server
 # Authors: Q-Chef Backend Programmers
-# Updated: 20200627
+# Updated: 20261018
+
+import datetime
 
 from func import *
+from firebase_admin import firestore
 
 ################################################################################
 # Constants
 ################################################################################
+# The user's actions are appended to monthly documents in the
+# actions/<user_id>/log sub collection, as {recipe_id: {timestamp: action}}.
+# actions/<user_id> itself only keeps a summary per recipe, which is what
+# the recommender reads as the user's history:
+# {recipe_id: {'n_actions', 'last_action', 'last_timestamp'}}
+# (older users' documents also still have their full log in these maps).
+ACTION_LOG_COLLECTION = 'log'
+ACTION_LOG_BUCKET_FORMAT = '%Y%m'
 
 ################################################################################
 # Helper Functions
+################################################################################
+# actionLogBucket
+# Returns the id of the log document an action belongs in.
+# - Input:
+#   - (string) timestamp, in epoch milliseconds
+# - Output:
+#   - (string) bucket id, e.g. '202012'
+def actionLogBucket(timestamp):
+  try:
+    action_time = datetime.datetime.utcfromtimestamp(int(timestamp)/1000)
+  except:
+    action_time = datetime.datetime.utcnow()
+  return action_time.strftime(ACTION_LOG_BUCKET_FORMAT)
+
+################################################################################
+# checkActionLog
+# Checks the action log is a list of [timestamp, recipe_id, action] entries,
+# so a malformed one is rejected before it is queued.
+# - Input:
+#   - (list) action_log
+# - Output:
+#   - (string) error
+def checkActionLog(action_log):
+  if not isinstance(action_log, list):
+    err = f'[checkActionLog - ERROR]: action_log is not a list.'
+    debug(err)
+    return err
+  for entry in action_log:
+    if not (isinstance(entry, (list, tuple)) and len(entry) == 3):
+      err = f'[checkActionLog - ERROR]: action_log entry {entry} is not a [timestamp, recipe_id, action] list.'
+      debug(err)
+      return err
+  return ''
+
+################################################################################
+# timestampValue
+# Returns an action timestamp (epoch milliseconds, as a string or number)
+# as a number to compare, or -1 if it is not one.
+def timestampValue(timestamp):
+  try:
+    return float(timestamp)
+  except (TypeError, ValueError):
+    return -1
+
 ################################################################################
 # updateActionLog
-# Updates the user's action log
+# Appends to the user's action log, without reading any of it, and updates
+# the user's summary of each recipe to its latest action.
+# Only the actions newer than the recipe's summary are counted, so a job
+# that is run again (e.g. retried after a commit that timed out but went
+# through) does not count its actions twice. The log itself is keyed by
+# timestamp, so writing it again changes nothing.
 # - Input:
 #   - (dict) data containing user_id, recipe_ids, actions.
 # - Output:
 #   - (string) error
 def updateActionLog(data):
   debug(f'[updateActionLog - INFO]: Starting.')
-  updating_data = {}
   user_id = data['userID']
 
-  # Retrieve the user document
-  user_doc_ref, user_doc, err = retrieveDocument('actions', user_id)
+  # Only the summary is read, the log is not
+  summary_doc_ref, summary_doc, err = retrieveDocument('actions', user_id)
   if err:
+    err = f'[updateActionLog - ERROR]: Unable to retrieve the action summary of {user_id}, err: {err}'
+    debug(err)
     return err
+  stored_summary = summary_doc.to_dict()
 
-  updating_data = user_doc.to_dict()
+  log_data = {}
+  summary_data = {}
   action_log = data['action_log']
   for timestamp, recipe_id, action in action_log:
     timestamp = str(timestamp)
     recipe_id = str(recipe_id)
     action = str(action)
-    try:
-      updating_data[recipe_id][timestamp] = action
-    except:
-      try:
-        updating_data[recipe_id] = {timestamp: action}
-      except:
-        err = f'[updateActionLog - ERROR]: Unable to update user action log for recipe {recipe_id} with {action} at {timestamp}'
-        debug(err)
-
-  # Update the user's review document
-  err = updateDocument('actions', user_id, updating_data)
+    bucket = actionLogBucket(timestamp)
+    log_data.setdefault(bucket, {}).setdefault(recipe_id, {})[timestamp] = action
+
+    stored = stored_summary.get(recipe_id, {})
+    stored_timestamp = timestampValue(stored.get('last_timestamp')) if 'n_actions' in stored else -1
+    if timestampValue(timestamp) <= stored_timestamp:
+      continue
+    if not (recipe_id in summary_data):
+      summary_data[recipe_id] = {'n_actions': 0}
+    recipe_summary = summary_data[recipe_id]
+    recipe_summary['n_actions'] += 1
+    if timestampValue(timestamp) >= timestampValue(recipe_summary.get('last_timestamp')):
+      recipe_summary['last_action'] = action
+      recipe_summary['last_timestamp'] = timestamp
+
+  # Append the actions to the log
+  for bucket, bucket_data in log_data.items():
+    err = mergeSubDocument('actions', user_id, ACTION_LOG_COLLECTION, bucket, bucket_data)
+    if err:
+      err = f'[updateActionLog - ERROR]: Unable to update user action log {bucket} with actions, err: {err}'
+      debug(err)
+      return err
+
+  # Update the user's summary
+  if not summary_data:
+    return ''
+  for recipe_summary in summary_data.values():
+    recipe_summary['n_actions'] = firestore.Increment(recipe_summary['n_actions'])
+  err = mergeDocument('actions', user_id, summary_data)
   if err:
-    err = f'[updateActionLog - ERROR]: Unable to update user action log document with actions, err: {err}'
+    err = f'[updateActionLog - ERROR]: Unable to update user action summary, err: {err}'
     debug(err)
     return err
   return ''
@@ -6,20 +6,69 @@
 ################################################################################
 # Imports and Server Initialisation
 ################################################################################
+import json
 import os
 
 import firebase_admin
 from firebase_admin import credentials, firestore
 
-# Use the application default credentials
-cred = credentials.Certificate("./keyKey.json")
-auth_app = firebase_admin.initialize_app(cred)
-db = firestore.client()
+from storage import createStorage
+from blob_store import createBlobStore
+
+# Where the documents are stored, set by the QCHEF_STORAGE environment variable:
+# 'firestore' (the default), or 'memory' or 'sqlite:<file name>' to run
+# without credentials or a network connection. QCHEF_STORAGE_SEED can name a
+# json file of {'collection/document': data} to add to a local store, e.g.
+# server/settings and the onboarding documents.
+STORAGE_BACKEND = os.environ.get('QCHEF_STORAGE', 'firestore')
+STORAGE_SEED = os.environ.get('QCHEF_STORAGE_SEED', '')
+
+if STORAGE_BACKEND == 'firestore':
+  # Use the application default credentials
+  cred = credentials.Certificate("./keyKey.json")
+  auth_app = firebase_admin.initialize_app(cred)
+  db = firestore.client()
+else:
+  # Without Firebase, users can only be identified with manualID requests.
+  auth_app = None
+  db = None
+
+# How the users' rating maps are written, set by the QCHEF_USER_DOC_ENCODING
+# environment variable: 'maps' (the default) keeps a map entry per rating,
+# 'packed' keeps them in one binary field (see func.py). Documents in
+# either encoding can be read, and are rewritten in this one when their
+# ratings change.
+USER_DOC_ENCODING = os.environ.get('QCHEF_USER_DOC_ENCODING', 'maps')
+
+storage = createStorage(STORAGE_BACKEND, lambda: db)
+if STORAGE_SEED and STORAGE_BACKEND != 'firestore':
+  with open(STORAGE_SEED) as f:
+    storage.seed(json.load(f))
+
+# Where review photos are kept, set by the QCHEF_BLOB_STORE environment
+# variable: 'local:<directory>' or 'firebase:<bucket name>'. The local store
+# is meant for tests and local runs: deployments should use a bucket, as the
+# container's disk does not last and is not shared between instances.
+BLOB_STORE = os.environ.get('QCHEF_BLOB_STORE') or 'local:./blobs'
+if STORAGE_BACKEND == 'firestore' and not BLOB_STORE.startswith('firebase:'):
+  print(f'[app - WARN]: Keeping review photos in {BLOB_STORE}, which does not last. Set QCHEF_BLOB_STORE to firebase:<bucket name> to keep them.')
+blob_store = createBlobStore(BLOB_STORE, auth_app)
+
+# Token the internal endpoints (/model_info, /cache_info, /queue_info and
+# /session_info) require, as 'Authorization: Bearer <token>', set by the
+# QCHEF_INTERNAL_TOKEN environment variable. Without it they are disabled.
+INTERNAL_TOKEN = os.environ.get('QCHEF_INTERNAL_TOKEN', '')
 
 from flask import Flask
 app = Flask(__name__)
 
 from routes import *
 
+# Load and warm up the catalog and the surprise models before serving any
+# requests. Under gunicorn this runs in the master before the workers fork,
+# see gunicorn.conf.py.
+from lifecycle import server_lifecycle
+server_lifecycle.warm()
+
 if __name__ == "__main__":
   app.run(debug=True, host='0.0.0.0', port=int(os.environ.get('PORT', 8080)))
\ No newline at end of file
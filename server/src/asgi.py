@@ -0,0 +1,244 @@
+################################################################################
+# Q-Chef Server
+# Authors: Q-Chef Backend Programmers
+# Updated: 20261018
+
+# Async serving mode. Serves the same endpoints as routes.py, e.g. with
+#   $ uvicorn asgi:application --host 0.0.0.0 --port $PORT
+# Each request is handled by the Flask app on a bounded thread pool, but the
+# documents its endpoint's requestPipeline needs are read beforehand, and
+# its document changes committed afterwards, with the async Firestore client
+# (see storage.AsyncFirestoreBackend). A request only holds a thread while
+# its endpoint runs (e.g. scoring recipes), not while it waits on those,
+# so a process can have many more requests in flight than threads.
+# Any other reads an endpoint makes still use the sync client on its
+# endpoint thread, e.g. the group counter shards read when a user is
+# created (the settings and onboarding/recipes documents are kept in
+# memory, so are not normally read). The write queue's jobs (e.g. saving
+# reviews and the action log) are sync too, as are the Firebase Auth calls
+# (run on auth_pool).
+
+import asyncio
+import io
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from app import app, storage, auth_app
+from flask import g
+from firebase_admin import firestore_async
+from storage import createAsyncStorage
+from func import debug, DocumentSession
+from routes import pipelineDocuments
+from server_settings import settings_service
+from session_cache import session_cache
+from write_queue import write_queue, WRITE_QUEUE_FLUSH_TIMEOUT
+
+################################################################################
+# Constants
+################################################################################
+ASGI_ENDPOINT_THREADS = int(os.environ.get('QCHEF_ASGI_THREADS', 8)) # endpoints run at once
+ASGI_AUTH_THREADS = 32 # Firebase Auth calls, which have no async API
+
+endpoint_pool = ThreadPoolExecutor(max_workers=ASGI_ENDPOINT_THREADS, thread_name_prefix='asgi-endpoint')
+auth_pool = ThreadPoolExecutor(max_workers=ASGI_AUTH_THREADS, thread_name_prefix='asgi-auth')
+
+# The async client has to be made on the event loop, so it is made on first use.
+_async_storage = None
+
+def asyncStorage():
+  global _async_storage
+  if _async_storage is None:
+    _async_storage = createAsyncStorage(storage, lambda: firestore_async.client(auth_app))
+  return _async_storage
+
+################################################################################
+# Helper Functions
+################################################################################
+# wsgiEnviron
+# Returns the WSGI environ of an ASGI http request.
+# - Input:
+#   - (dict) scope,
+#   - (bytes) body
+# - Output:
+#   - (dict) environ
+def wsgiEnviron(scope, body):
+  server = scope.get('server') or ('localhost', 80)
+  environ = {'REQUEST_METHOD': scope['method'],
+             'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin1'),
+             'PATH_INFO': scope['path'].encode('utf-8').decode('latin1'),
+             'QUERY_STRING': scope['query_string'].decode('latin1'),
+             'SERVER_NAME': server[0],
+             'SERVER_PORT': str(server[1]),
+             'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+             'wsgi.version': (1, 0),
+             'wsgi.url_scheme': scope.get('scheme', 'http'),
+             'wsgi.input': io.BytesIO(body),
+             'wsgi.errors': sys.stderr,
+             'wsgi.multithread': True,
+             'wsgi.multiprocess': False,
+             'wsgi.run_once': False}
+  if scope.get('client'):
+    environ['REMOTE_ADDR'] = scope['client'][0]
+  for name, value in scope['headers']:
+    name = name.decode('latin1').upper().replace('-', '_')
+    key = name if name in ['CONTENT_TYPE', 'CONTENT_LENGTH'] else 'HTTP_'+name
+    value = value.decode('latin1')
+    environ[key] = environ[key]+','+value if key in environ else value
+  # The whole body has been read, even if it was sent in chunks
+  environ['CONTENT_LENGTH'] = str(len(body))
+  return environ
+
+################################################################################
+# requestUserId
+# Returns the user the request is from, following the same rules as
+# routes.authentication, or None if it can not tell.
+# - Input:
+#   - (dict) environ,
+#   - (bytes) body
+# - Output:
+#   - (string) user_id
+async def requestUserId(environ, body):
+  try:
+    request_data = json.loads(body)
+    if request_data['manualID']:
+      return request_data['userID']
+  except:
+    pass
+
+  session_cookie = environ.get('HTTP_AUTHORIZATION', '').replace('Bearer ', '')
+  if not session_cookie:
+    return None
+  claims = session_cache.lookup(session_cookie)
+  if claims is None:
+    loop = asyncio.get_running_loop()
+    claims, err = await loop.run_in_executor(auth_pool, session_cache.verify, session_cookie)
+    if err:
+      return None
+  return claims['uid']
+
+################################################################################
+# prefetchDocuments
+# Reads the documents the endpoint's requestPipeline will need into the
+# request's session. If they can not be read here, the pipeline reads them
+# itself (and reports any error).
+# - Input:
+#   - (dict) environ,
+#   - (bytes) body,
+#   - (DocumentSession) session
+async def prefetchDocuments(environ, body, session):
+  if environ['REQUEST_METHOD'] != 'POST':
+    return
+  try:
+    endpoint, view_args = app.url_map.bind_to_environ(environ).match()
+  except Exception:
+    return
+  needs = getattr(app.view_functions.get(endpoint), 'pipeline_needs', [])
+  if not needs:
+    return
+
+  try:
+    user_id = None
+    if 'user_doc' in needs or 'history' in needs:
+      user_id = await requestUserId(environ, body)
+    paths = [(f'{collectionID}', f'{documentID}') for collectionID, documentID
+             in pipelineDocuments(needs, user_id, settings_service.cached())]
+    paths = [path for path in paths if not session.isLoaded(path)]
+    if not paths:
+      return
+    documents = await asyncStorage().getDocuments(paths)
+    for path, data in zip(paths, documents):
+      session.preload(path, data)
+  except Exception as e:
+    debug(f'[prefetchDocuments - WARN]: Unable to read the documents for {endpoint}, err = {e}')
+
+################################################################################
+# dispatchRequest
+# Handles the request with the Flask app, using the given document session.
+# The session is deferred, so its changes are left for the caller to commit.
+# - Input:
+#   - (dict) environ,
+#   - (DocumentSession) session
+# - Output:
+#   - (int) status code,
+#   - (list) headers,
+#   - (bytes) body
+def dispatchRequest(environ, session):
+  started = {}
+  def startResponse(status, headers, exc_info=None):
+    started['status'] = int(status.split(' ', 1)[0])
+    started['headers'] = headers
+
+  ctx = app.request_context(environ)
+  ctx.push()
+  try:
+    g.document_session = session
+    try:
+      response = app.full_dispatch_request()
+    except Exception as e:
+      response = app.handle_exception(e)
+    chunks = response(environ, startResponse)
+    try:
+      body = b''.join(chunks)
+    finally:
+      if hasattr(chunks, 'close'):
+        chunks.close()
+  finally:
+    ctx.pop()
+  return started['status'], started['headers'], body
+
+################################################################################
+# ASGI Application
+################################################################################
+async def handleLifespan(receive, send):
+  while True:
+    message = await receive()
+    if message['type'] == 'lifespan.startup':
+      await send({'type': 'lifespan.startup.complete'})
+    elif message['type'] == 'lifespan.shutdown':
+      # Finishes the queued writes, as gunicorn.conf.py's worker_exit does
+      loop = asyncio.get_running_loop()
+      await loop.run_in_executor(None, write_queue.flush, WRITE_QUEUE_FLUSH_TIMEOUT)
+      await send({'type': 'lifespan.shutdown.complete'})
+      return
+
+async def handleRequest(scope, receive, send):
+  func_name = 'handleRequest'
+  body = b''
+  while True:
+    message = await receive()
+    body += message.get('body', b'')
+    if not message.get('more_body', False):
+      break
+
+  environ = wsgiEnviron(scope, body)
+  session = DocumentSession(deferred=True)
+  await prefetchDocuments(environ, body, session)
+
+  loop = asyncio.get_running_loop()
+  status, headers, response_body = await loop.run_in_executor(endpoint_pool, dispatchRequest, environ, session)
+
+  # As routes.after_request_func, the changes of a failed request are dropped
+  writes = session.pendingWrites() if status < 500 else []
+  if writes:
+    try:
+      await asyncStorage().commit(writes)
+      session.committed()
+    except Exception as e:
+      err = f"[{func_name} - ERROR]: Unable to save the request's changes, err = [DocumentSession - ERROR]: Unable to commit {len(writes)} writes, err: {e}"
+      debug(err)
+      status = 500
+      response_body = err.encode('utf-8')
+      headers = [('Content-Type', 'text/html; charset=utf-8'), ('Content-Length', str(len(response_body)))]
+
+  await send({'type': 'http.response.start',
+              'status': status,
+              'headers': [(name.lower().encode('latin1'), value.encode('latin1')) for name, value in headers]})
+  await send({'type': 'http.response.body', 'body': response_body})
+
+async def application(scope, receive, send):
+  if scope['type'] == 'lifespan':
+    await handleLifespan(receive, send)
+  elif scope['type'] == 'http':
+    await handleRequest(scope, receive, send)
@@ -0,0 +1,131 @@
+################################################################################
+# Q-Chef Server
+# Authors: Q-Chef Backend Programmers
+# Updated: 20261018
+
+# Content-addressed storage for binary objects such as review photos.
+# An object's key is the sha256 of its contents, so storing the same photo
+# twice keeps one copy, and an object never changes once stored.
+
+import hashlib
+import os
+import re
+import tempfile
+
+################################################################################
+# Constants
+################################################################################
+BLOB_KEY_PATTERN = re.compile('^[0-9a-f]{64}$')
+
+################################################################################
+# Helper Functions
+################################################################################
+# blobKey
+# Returns the key of the given contents.
+# - Input:
+#   - (bytes) data
+# - Output:
+#   - (string) key
+def blobKey(data):
+  return hashlib.sha256(data).hexdigest()
+
+def isBlobKey(key):
+  return bool(BLOB_KEY_PATTERN.match(f'{key}'))
+
+################################################################################
+# BlobStore
+################################################################################
+# BlobStore
+# Interface of the blob stores.
+# - put(data, content_type) stores the data and returns its key.
+# - get(key) returns (data, content_type), or (None, None) if there is no such object.
+class BlobStore:
+  name = ''
+
+  def put(self, data, content_type):
+    raise NotImplementedError
+
+  def get(self, key):
+    raise NotImplementedError
+
+################################################################################
+# LocalBlobStore
+# Keeps the objects as files under a directory, e.g. <root>/ab/abcdef...
+# with the content type in a .type file next to each object.
+class LocalBlobStore(BlobStore):
+  name = 'local'
+
+  def __init__(self, root):
+    self.root = root
+
+  def _path(self, key):
+    return os.path.join(self.root, key[:2], key)
+
+  def put(self, data, content_type):
+    key = blobKey(data)
+    path = self._path(key)
+    if os.path.exists(path):
+      return key
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path+'.type', 'w') as f:
+      f.write(content_type)
+    # Write to a temporary file first, so a reader never sees part of an object
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as f:
+      f.write(data)
+    os.replace(tmp_path, path)
+    return key
+
+  def get(self, key):
+    if not isBlobKey(key):
+      return None, None
+    path = self._path(key)
+    try:
+      with open(path, 'rb') as f:
+        data = f.read()
+      with open(path+'.type') as f:
+        content_type = f.read()
+    except FileNotFoundError:
+      return None, None
+    return data, content_type
+
+################################################################################
+# FirebaseBlobStore
+# Keeps the objects in a Firebase (Cloud) Storage bucket, under a prefix.
+class FirebaseBlobStore(BlobStore):
+  name = 'firebase'
+
+  def __init__(self, bucket_name, firebase_app=None, prefix='blobs/'):
+    from firebase_admin import storage as firebase_storage
+    self.bucket = firebase_storage.bucket(bucket_name, app=firebase_app)
+    self.prefix = prefix
+
+  def put(self, data, content_type):
+    key = blobKey(data)
+    blob = self.bucket.blob(self.prefix+key)
+    if not blob.exists():
+      blob.upload_from_string(data, content_type=content_type)
+    return key
+
+  def get(self, key):
+    if not isBlobKey(key):
+      return None, None
+    blob = self.bucket.get_blob(self.prefix+key)
+    if blob is None:
+      return None, None
+    return blob.download_as_bytes(), blob.content_type
+
+################################################################################
+# createBlobStore
+# Returns the blob store named by the QCHEF_BLOB_STORE setting.
+# - Input:
+#   - (string) setting, 'local:<directory>' or 'firebase:<bucket name>',
+#   - (App) firebase_app, used by the firebase store
+# - Output:
+#   - (BlobStore) blob_store
+def createBlobStore(setting, firebase_app=None):
+  if setting.startswith('local:'):
+    return LocalBlobStore(setting[len('local:'):])
+  if setting.startswith('firebase:'):
+    return FirebaseBlobStore(setting[len('firebase:'):], firebase_app)
+  raise ValueError(f'Unknown blob store {setting}, expected local:<directory> or firebase:<bucket name>.')
@@ -0,0 +1,521 @@
+################################################################################
+# Q-Chef Server
+# Authors: Q-Chef Backend Programmers
+# Updated: 20261018
+
+# The catalog holds the recipe and ingredient data as flat numpy columns.
+# It is either compiled in memory from the json/csv files in ./data, or
+# memory-mapped from a pre-compiled artifact so that every gunicorn worker
+# shares the same page-cache pages. To build the artifact:
+# $ python catalog.py [data_dir]
+
+import csv
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+# The status messages here are printed rather than sent to func.debug:
+# func imports this module (so importing it back would be circular), and
+# importing func would also import app.py (and its Firebase credentials),
+# which the build's "python catalog.py" step does not have.
+
+################################################################################
+# Constants
+################################################################################
+DATA_DIR = './data'
+
+catalog_files = {
+  'i_data': 'qchef_ingredients.json',
+  'is_data': 'qchef_ingredient_subclusters.json',
+  'ic_data': 'qchef_ingredient_clusters.json',
+  'r_data': 'qchef_recipes.json',
+  'surp_data': 'qchef_recipe_surprises.csv',
+  'nov_data': 'qchef_recipe_novelties.csv',
+  'neighbours': 'qchef_ingredient_cluster_neighbours.csv',
+}
+
+COMPILED_CATALOG = 'qchef_catalog.bin'
+CATALOG_MAGIC = b'QCHEFCAT'
+CATALOG_VERSION = 4
+CATALOG_ALIGNMENT = 64
+
+# Stand-in for a None/missing id in the integer columns.
+NO_ID = -1
+
+# Recipe fields stored as columns, the rest are kept as a json blob.
+recipe_columns = ['ingredient_ids', 'vector', 'surprises']
+# Recipe fields left out of the cards given to the front end.
+hidden_recipe_fields = ['image',
+                        'ingredient_ids',
+                        'surprises',
+                        'url',
+                        'vector',
+                        'vegetarian']
+feature_percentiles = ['100', '95', '90', '50']
+neighbour_columns = ['most_similar_id',
+                     'second_most_similar_id',
+                     'third_most_similar_id']
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+################################################################################
+# Compiling Helpers
+################################################################################
+def loadJSON(data_dir, key):
+  with open(f'{data_dir}/{catalog_files[key]}', 'r') as f:
+    return json.load(f)
+
+#-------------------------------------------------------------------------------
+# loadRecipeCSV
+# Reads one of the per recipe surprise/novelty csv files.
+# - Input:
+#   - (string) data_dir,
+#   - (string) key, either 'surp_data' or 'nov_data'
+# - Output:
+#   - (dict) recipe_id -> [value_100, value_95, value_90, value_50]
+def loadRecipeCSV(data_dir, key):
+  data = {}
+  with open(f'{data_dir}/{catalog_files[key]}', 'r') as f:
+    reader = csv.reader(f)
+    for row in reader:
+      rid = row[0].split("_")[-1]
+      if len(rid)<5:
+        rid = "0"+rid
+      data[rid] = [float(v) for v in row[1:1+len(feature_percentiles)]]
+  return data
+
+#-------------------------------------------------------------------------------
+def loadNeighbours(data_dir):
+  with open(f'{data_dir}/{catalog_files["neighbours"]}') as f:
+    return list(csv.DictReader(f))
+
+#-------------------------------------------------------------------------------
+# packStrings
+# Interns a list of strings into one utf-8 blob plus an offsets array.
+def packStrings(strings):
+  encoded = [s.encode('utf-8') for s in strings]
+  offsets = np.zeros(len(encoded)+1, dtype=np.int64)
+  offsets[1:] = np.cumsum([len(e) for e in encoded])
+  blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+  return offsets, blob
+
+#-------------------------------------------------------------------------------
+# packLists
+# Flattens a list of id lists into an offsets array and an int32 values array.
+# A missing (None) list is stored as an empty one.
+def packLists(lists):
+  lists = [l or [] for l in lists]
+  offsets = np.zeros(len(lists)+1, dtype=np.int64)
+  offsets[1:] = np.cumsum([len(l) for l in lists])
+  values = np.array([NO_ID if v is None else v for l in lists for v in l], dtype=np.int32)
+  return offsets, values
+
+#-------------------------------------------------------------------------------
+# denseIndex
+# Maps the (integer) ids to their row, with NO_ID for unused ids.
+def denseIndex(ids):
+  index = np.full(int(max(ids))+1 if len(ids) else 0, NO_ID, dtype=np.int32)
+  index[ids] = np.arange(len(ids), dtype=np.int32)
+  return index
+
+#-------------------------------------------------------------------------------
+def intOrNoID(value):
+  return NO_ID if value is None else int(value)
+
+#-------------------------------------------------------------------------------
+# idsToRows
+# Looks up the rows of ids through a denseIndex, NO_ID for unknown ids.
+def idsToRows(index, ids):
+  ids = np.asarray(ids, dtype=np.int64)
+  rows = np.full(len(ids), NO_ID, dtype=np.int32)
+  known = (ids >= 0) & (ids < len(index))
+  rows[known] = index[ids[known]]
+  return rows
+
+################################################################################
+# recipeCard
+# Encodes the recipe's card for the front end: every field except the
+# hidden ones, plus its capitalised, de-duplicated ingredient names.
+# - Input:
+#   - (dict) recipe,
+#   - (dict) ingredient id -> name
+# - Output:
+#   - (string) json encoded card
+def recipeCard(recipe, i_names):
+  ingredient_names = []
+  seen = set()
+  for ingredient_id in recipe['ingredient_ids']:
+    if ingredient_id == None or not (int(ingredient_id) in i_names):
+      continue
+    ingredient_name = i_names[int(ingredient_id)].replace('_', ' ').capitalize()
+    if not (ingredient_name in seen):
+      seen.add(ingredient_name)
+      ingredient_names.append(ingredient_name)
+  card = {k: v for k, v in recipe.items() if not (k in hidden_recipe_fields)}
+  card['ingredient_names'] = ingredient_names
+  return json.dumps(card, separators=(',', ':'), sort_keys=True)
+
+################################################################################
+# compileCatalog
+# Converts the json/csv data files into the catalog's columns.
+# - Input:
+#   - (string) data_dir
+# - Output:
+#   - (dict) column name -> numpy array,
+#   - (dict) meta data needed to interpret the columns
+def compileCatalog(data_dir=DATA_DIR):
+  columns = {}
+
+  # Ingredients
+  i_data = loadJSON(data_dir, 'i_data')
+  i_ids = sorted(int(i_id) for i_id in i_data)
+  i_rows = [i_data[str(i_id)] for i_id in i_ids]
+  columns['i_ids'] = np.array(i_ids, dtype=np.int32)
+  columns['i_index'] = denseIndex(columns['i_ids'])
+  columns['i_subcluster'] = np.array([intOrNoID(i['subcluster']) for i in i_rows], dtype=np.int32)
+  columns['i_cluster'] = np.array([intOrNoID(i['cluster']) for i in i_rows], dtype=np.int32)
+  columns['i_frequency'] = np.array([i['frequency'] for i in i_rows], dtype=np.int64)
+  columns['i_name_offsets'], columns['i_name_blob'] = packStrings([i['name'] for i in i_rows])
+
+  # Ingredient subclusters
+  is_data = loadJSON(data_dir, 'is_data')
+  is_ids = sorted(int(is_id) for is_id in is_data)
+  is_rows = [is_data[str(is_id)] for is_id in is_ids]
+  columns['is_ids'] = np.array(is_ids, dtype=np.int32)
+  columns['is_index'] = denseIndex(columns['is_ids'])
+  columns['is_cluster'] = np.array([intOrNoID(s['cluster']) for s in is_rows], dtype=np.int32)
+  columns['is_frequency'] = np.array([s['frequency'] for s in is_rows], dtype=np.int64)
+  columns['is_name_offsets'], columns['is_name_blob'] = packStrings([s['name'] for s in is_rows])
+  columns['is_ingredient_offsets'], columns['is_ingredient_values'] = packLists([s['ingredients'] for s in is_rows])
+
+  # Ingredient clusters
+  ic_data = loadJSON(data_dir, 'ic_data')
+  ic_ids = sorted(int(ic_id) for ic_id in ic_data)
+  ic_rows = [ic_data[str(ic_id)] for ic_id in ic_ids]
+  columns['ic_ids'] = np.array(ic_ids, dtype=np.int32)
+  columns['ic_index'] = denseIndex(columns['ic_ids'])
+  columns['ic_frequency'] = np.array([c['frequency'] for c in ic_rows], dtype=np.int64)
+  columns['ic_vector'] = np.array([c['vector'] for c in ic_rows], dtype=np.float32)
+  columns['ic_name_offsets'], columns['ic_name_blob'] = packStrings([c['name'] for c in ic_rows])
+  columns['ic_subcluster_offsets'], columns['ic_subcluster_values'] = packLists([c['subclusters'] for c in ic_rows])
+  columns['ic_ingredient_offsets'], columns['ic_ingredient_values'] = packLists([c['ingredients'] for c in ic_rows])
+
+  # Cluster neighbours, one row per cluster id.
+  neighbours = loadNeighbours(data_dir)
+  columns['neighbours'] = np.array([[int(row[n]) for n in neighbour_columns] for row in neighbours], dtype=np.int32).reshape(-1, len(neighbour_columns))
+
+  # Recipes, kept in file order.
+  r_data = loadJSON(data_dir, 'r_data')
+  r_ids = list(r_data.keys())
+  r_rows = [r_data[r_id] for r_id in r_ids]
+  surprise_keys = sorted({k for r in r_rows for k in (r.get('surprises') or {})})
+  surprises = np.full((len(r_rows), len(surprise_keys)), np.nan, dtype=np.float64)
+  for row, r in enumerate(r_rows):
+    for col, k in enumerate(surprise_keys):
+      if k in (r.get('surprises') or {}):
+        surprises[row, col] = r['surprises'][k]
+  columns['r_id_offsets'], columns['r_id_blob'] = packStrings(r_ids)
+  columns['r_ingredient_offsets'], columns['r_ingredient_values'] = packLists([r['ingredient_ids'] for r in r_rows])
+  columns['r_vector'] = np.array([r['vector'] for r in r_rows], dtype=np.float32)
+  columns['r_surprises'] = surprises
+  columns['r_fields_offsets'], columns['r_fields_blob'] = packStrings(
+      [json.dumps({k: v for k, v in r.items() if not (k in recipe_columns)}) for r in r_rows])
+  i_names = {i_id: i['name'] for i_id, i in zip(i_ids, i_rows)}
+  columns['r_card_offsets'], columns['r_card_blob'] = packStrings([recipeCard(r, i_names) for r in r_rows])
+
+  # Per recipe surprise/novelty model features, aligned with the recipes.
+  for key, name in [('surp_data', 'r_surp_features'), ('nov_data', 'r_nov_features')]:
+    data = loadRecipeCSV(data_dir, key)
+    features = np.full((len(r_ids), len(feature_percentiles)), np.nan, dtype=np.float64)
+    for row, r_id in enumerate(r_ids):
+      if r_id in data:
+        features[row] = data[r_id]
+    columns[name] = features
+
+  # Row (rather than id) links between the tables, used by the vectorised scorers.
+  columns['r_ingredient_rows'] = idsToRows(columns['i_index'], columns['r_ingredient_values'])
+  columns['i_subcluster_rows'] = idsToRows(columns['is_index'], columns['i_subcluster'])
+  columns['i_cluster_rows'] = idsToRows(columns['ic_index'], columns['i_cluster'])
+  columns['is_cluster_rows'] = idsToRows(columns['ic_index'], columns['is_cluster'])
+
+  meta = {'surprise_keys': surprise_keys,
+          'data_version': dataVersion(data_dir)}
+  return columns, meta
+
+################################################################################
+# writeCatalog
+# Writes the columns to a single file that readCatalog can memory-map:
+# magic, header length, json header, then each column aligned to 64 bytes.
+# - Input:
+#   - (string) path,
+#   - (dict) columns,
+#   - (dict) meta
+def writeCatalog(path, columns, meta):
+  arrays = {}
+  offset = 0
+  for name, column in columns.items():
+    column = np.ascontiguousarray(column)
+    columns[name] = column
+    arrays[name] = {'dtype': column.dtype.str, 'shape': list(column.shape), 'offset': offset}
+    offset += -(-column.nbytes // CATALOG_ALIGNMENT) * CATALOG_ALIGNMENT
+  header = json.dumps({'version': CATALOG_VERSION, 'meta': meta, 'arrays': arrays}).encode('utf-8')
+  data_start = -(-(len(CATALOG_MAGIC) + 8 + len(header)) // CATALOG_ALIGNMENT) * CATALOG_ALIGNMENT
+
+  tmp_path = f'{path}.tmp'
+  with open(tmp_path, 'wb') as f:
+    f.write(CATALOG_MAGIC)
+    f.write(struct.pack('<Q', len(header)))
+    f.write(header)
+    for name, column in columns.items():
+      f.seek(data_start + arrays[name]['offset'])
+      f.write(column.tobytes())
+    f.truncate(data_start + offset)
+  os.replace(tmp_path, path)
+
+################################################################################
+# readCatalog
+# Memory-maps a file written by writeCatalog. The returned columns are
+# read-only views onto the shared mapping, nothing is copied.
+# - Input:
+#   - (string) path
+# - Output:
+#   - (dict) columns,
+#   - (dict) meta
+def readCatalog(path):
+  with open(path, 'rb') as f:
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+  if mm[:len(CATALOG_MAGIC)] != CATALOG_MAGIC:
+    raise ValueError(f'{path} is not a compiled catalog.')
+  header_start = len(CATALOG_MAGIC) + 8
+  header_len, = struct.unpack('<Q', mm[len(CATALOG_MAGIC):header_start])
+  header = json.loads(mm[header_start:header_start+header_len].decode('utf-8'))
+  if header['version'] != CATALOG_VERSION:
+    raise ValueError(f'{path} has catalog version {header["version"]}, expected {CATALOG_VERSION}.')
+  data_start = -(-(header_start + header_len) // CATALOG_ALIGNMENT) * CATALOG_ALIGNMENT
+
+  columns = {}
+  for name, info in header['arrays'].items():
+    dtype = np.dtype(info['dtype'])
+    count = int(np.prod(info['shape'], dtype=np.int64))
+    columns[name] = np.frombuffer(mm, dtype=dtype, count=count, offset=data_start+info['offset']).reshape(info['shape'])
+  return columns, header['meta']
+
+#-------------------------------------------------------------------------------
+# dataVersion
+# Short hash of the source files' sizes and modification times, which
+# changes whenever the catalog data does.
+def dataVersion(data_dir=DATA_DIR):
+  stats = []
+  for fn in sorted(catalog_files.values()):
+    stat = os.stat(f'{data_dir}/{fn}')
+    stats.append(f'{fn}:{stat.st_size}:{stat.st_mtime}')
+  return hashlib.sha1('|'.join(stats).encode('utf-8')).hexdigest()[:12]
+
+#-------------------------------------------------------------------------------
+# isCompiledCatalogCurrent
+# True if the compiled artifact exists and is newer than all its sources.
+def isCompiledCatalogCurrent(data_dir=DATA_DIR):
+  path = f'{data_dir}/{COMPILED_CATALOG}'
+  if not os.path.exists(path):
+    return False
+  compiled_mtime = os.path.getmtime(path)
+  for fn in catalog_files.values():
+    if os.path.getmtime(f'{data_dir}/{fn}') > compiled_mtime:
+      return False
+  return True
+
+################################################################################
+# Catalog
+################################################################################
+# Catalog
+# Read-only recipe and ingredient data, loaded once per process and shared
+# by every request thread. Use getCatalog() rather than building one directly.
+class Catalog:
+  def __init__(self, columns, meta, source=''):
+    self.columns = columns
+    self.meta = meta
+    self.source = source
+    self.version = meta['data_version']
+    for column in columns.values():
+      if column.flags.writeable:
+        column.flags.writeable = False
+    self._recipe_ids = [self._string('r_id', row) for row in range(len(columns['r_id_offsets'])-1)]
+    self._recipe_index = {r_id: row for row, r_id in enumerate(self._recipe_ids)}
+
+    # Index arrays from ingredient row -> subcluster row -> cluster row.
+    # NO_ID marks an ingredient without a (known) subcluster/cluster.
+    self.ingredient_subcluster_rows = columns['i_subcluster_rows']
+    self.ingredient_cluster_rows = columns['i_cluster_rows']
+    self.subcluster_cluster_rows = columns['is_cluster_rows']
+    self.recipe_ingredients = self._buildRecipeIngredients()
+
+  # Builds the (recipes x ingredients) CSR matrix of ingredient counts.
+  # None and unknown ingredient ids are left out. Each row keeps the
+  # recipe's ingredient order and repeats, so a mat-vec sums the ratings
+  # in the same order (and to the same float) as getRecipeRating.
+  def _buildRecipeIngredients(self):
+    offsets = self.columns['r_ingredient_offsets']
+    ingredient_rows = self.columns['r_ingredient_rows']
+    n_recipes = len(offsets)-1
+    recipe_rows = np.repeat(np.arange(n_recipes, dtype=np.int64), np.diff(offsets))
+    known = ingredient_rows != NO_ID
+    indptr = np.zeros(n_recipes+1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(recipe_rows[known], minlength=n_recipes))
+    indices = ingredient_rows[known]
+    counts = np.ones(len(indices), dtype=np.float64)
+    return csr_matrix((counts, indices, indptr), shape=(n_recipes, len(self.columns['i_ids'])))
+
+  @classmethod
+  def fromDataDir(cls, data_dir=DATA_DIR):
+    columns, meta = compileCatalog(data_dir)
+    return cls(columns, meta, source=data_dir)
+
+  @classmethod
+  def fromCompiled(cls, path):
+    columns, meta = readCatalog(path)
+    return cls(columns, meta, source=path)
+
+  #-----------------------------------------------------------------------------
+  # Column helpers
+  def _string(self, prefix, row):
+    offsets = self.columns[prefix+'_offsets']
+    return self.columns[prefix+'_blob'][offsets[row]:offsets[row+1]].tobytes().decode('utf-8')
+
+  def _list(self, prefix, row):
+    offsets = self.columns[prefix+'_offsets']
+    return self.columns[prefix+'_values'][offsets[row]:offsets[row+1]]
+
+  def _row(self, index_name, id):
+    try:
+      row = int(self.columns[index_name][int(id)])
+    except (ValueError, TypeError, IndexError):
+      raise KeyError(id)
+    if row == NO_ID:
+      raise KeyError(id)
+    return row
+
+  def recipeRow(self, recipe_id):
+    return self._recipe_index[str(recipe_id)]
+
+  def ingredientRow(self, ingredient_id):
+    return self._row('i_index', ingredient_id)
+
+  def recipeRows(self, recipe_ids):
+    return np.array([self._recipe_index[str(r_id)] for r_id in recipe_ids], dtype=np.int64)
+
+  def clusterRow(self, cluster_id):
+    return self._row('ic_index', cluster_id)
+
+  #-----------------------------------------------------------------------------
+  # Recipes
+  def recipeIDs(self):
+    return self._recipe_ids
+
+  def hasRecipe(self, recipe_id):
+    return str(recipe_id) in self._recipe_index
+
+  # Rebuilds the recipe as it appears in qchef_recipes.json.
+  def recipe(self, recipe_id):
+    row = self.recipeRow(recipe_id)
+    recipe = json.loads(self._string('r_fields', row))
+    recipe['ingredient_ids'] = self.recipeIngredientIDs(recipe_id)
+    recipe['vector'] = self.columns['r_vector'][row]
+    recipe['surprises'] = self.recipeSurprises(recipe_id)
+    return recipe
+
+  # Returns the recipe's front end card as ready to send json bytes.
+  def recipeCard(self, recipe_id):
+    offsets = self.columns['r_card_offsets']
+    row = self.recipeRow(recipe_id)
+    return self.columns['r_card_blob'][offsets[row]:offsets[row+1]].tobytes()
+
+  def recipeIngredientIDs(self, recipe_id):
+    ingredient_ids = self._list('r_ingredient', self.recipeRow(recipe_id))
+    return [None if i_id == NO_ID else int(i_id) for i_id in ingredient_ids]
+
+  def recipeVector(self, recipe_id):
+    return self.columns['r_vector'][self.recipeRow(recipe_id)]
+
+  def recipeSurprises(self, recipe_id):
+    values = self.columns['r_surprises'][self.recipeRow(recipe_id)]
+    return {k: float(v) for k, v in zip(self.meta['surprise_keys'], values) if not np.isnan(v)}
+
+  def _features(self, name, prefix, recipe_id):
+    values = self.columns[name][self.recipeRow(recipe_id)]
+    if np.isnan(values).all():
+      raise KeyError(recipe_id)
+    return {prefix+'_'+p: float(v) for p, v in zip(feature_percentiles, values)}
+
+  def surpriseFeatures(self, recipe_id):
+    return self._features('r_surp_features', 'surprise', recipe_id)
+
+  def noveltyFeatures(self, recipe_id):
+    return self._features('r_nov_features', 'novelty', recipe_id)
+
+  #-----------------------------------------------------------------------------
+  # Ingredients
+  def ingredientName(self, ingredient_id):
+    return self._string('i_name', self.ingredientRow(ingredient_id))
+
+  def ingredientSubcluster(self, ingredient_id):
+    subcluster_id = int(self.columns['i_subcluster'][self.ingredientRow(ingredient_id)])
+    return None if subcluster_id == NO_ID else subcluster_id
+
+  def ingredientCluster(self, ingredient_id):
+    cluster_id = int(self.columns['i_cluster'][self.ingredientRow(ingredient_id)])
+    return None if cluster_id == NO_ID else cluster_id
+
+  def clusterName(self, cluster_id):
+    return self._string('ic_name', self.clusterRow(cluster_id))
+
+  # Returns the cluster's neighbours the same way as the csv row,
+  # i.e. {'most_similar_id': '321', ...} with '-1' for a removed neighbour.
+  def clusterNeighbours(self, cluster_id):
+    row = self.columns['neighbours'][int(cluster_id)]
+    return {n: str(int(v)) for n, v in zip(neighbour_columns, row)}
+
+################################################################################
+# getCatalog
+# Returns the process-wide catalog, loading it on first use. The compiled
+# artifact is used when it is up to date, otherwise the json/csv files are
+# compiled in memory.
+# - Output:
+#   - (Catalog) catalog
+def getCatalog():
+  global _catalog
+  if _catalog is None:
+    with _catalog_lock:
+      if _catalog is None:
+        start = time.time()
+        catalog = None
+        if isCompiledCatalogCurrent(DATA_DIR):
+          try:
+            catalog = Catalog.fromCompiled(f'{DATA_DIR}/{COMPILED_CATALOG}')
+          except ValueError as e:
+            print(f'[getCatalog - WARN]: Ignoring compiled catalog, err = {e}')
+        if catalog is None:
+          catalog = Catalog.fromDataDir(DATA_DIR)
+        print(f'[getCatalog - INFO]: Loaded catalog from {catalog.source} in {time.time()-start:.3f}s')
+        _catalog = catalog
+  return _catalog
+
+################################################################################
+# MAIN
+################################################################################
+if __name__ == "__main__":
+  data_dir = sys.argv[1] if len(sys.argv) > 1 else DATA_DIR
+  start = time.time()
+  columns, meta = compileCatalog(data_dir)
+  path = f'{data_dir}/{COMPILED_CATALOG}'
+  writeCatalog(path, columns, meta)
+  print(f'Compiled {path} ({os.path.getsize(path)} bytes) in {time.time()-start:.3f}s')
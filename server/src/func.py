@@ -2,10 +2,20 @@
 # Q-Chef Server
 # Authors: Q-Chef Backend Programmers
 # Updated: 20200621
+import contextlib
+import copy
 import json
-
-from app import db
-from flask import g
+import struct
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from app import storage, USER_DOC_ENCODING
+from storage import applyFieldPath, mergeFields
+from firebase_admin import firestore
+from flask import g, has_app_context, Response
+from catalog import getCatalog
 
 ################################################################################
 # Constants
@@ -16,6 +26,21 @@ collectionIDs = ['users',
                  'onboarding',
                  'server']
 
+# The user document's rating maps, e.g. ic_taste, each holding
+# {id: {'rating': mean rating, 'n_ratings': number of ratings}}.
+user_rating_maps = [level+rating_type for level in ['i_', 'is_', 'ic_', 'r_']
+                    for rating_type in ['taste', 'familiarity', 'surprise']]
+
+USER_DOC_ENCODINGS = ['maps', 'packed']
+PACKED_RATINGS_FIELD = 'packed_ratings'
+PACKED_RATINGS_MAGIC = b'QCR'
+PACKED_RATINGS_VERSION = 1
+
+DOCUMENT_READ_THREADS = 16 # shared by every request's concurrent reads
+
+if not (USER_DOC_ENCODING in USER_DOC_ENCODINGS):
+  raise ValueError(f'Unknown user document encoding {USER_DOC_ENCODING}, expected one of {USER_DOC_ENCODINGS}.')
+
 ################################################################################
 # Debugging
 ################################################################################
@@ -58,15 +83,470 @@ def debug(fString):
     print(fString)
     return
 
+################################################################################
+# User Document Encoding
+################################################################################
+# An active user's rating maps hold thousands of entries, which Firestore
+# has to encode and decode one map entry at a time. In the 'packed'
+# encoding they are instead kept in one bytes field, PACKED_RATINGS_FIELD:
+#   magic 'QCR', version (1 byte), then zlib compressed:
+#     number of maps (uint16), and for each map:
+#       name length (uint8), name, number of entries (uint32),
+#       length (uint32) of the ids joined by '\0', the joined ids,
+#       ratings (float64 x entries), n_ratings (int64 x entries)
+# all little endian. The DocumentSession decodes it back into the maps, so
+# the rest of the server only sees the usual {id: {'rating', 'n_ratings'}}.
+
+# isUserDocument
+# Returns whether the path is a user document, i.e. ('users', user_id).
+def isUserDocument(path):
+  return len(path) == 2 and path[0] == 'users'
+
+################################################################################
+# packRatingMaps
+# Packs the user's rating maps into PACKED_RATINGS_FIELD's bytes. A map
+# with an entry that is not exactly {'rating': number, 'n_ratings': integer}
+# is not packed.
+# Input:
+#  - (dict) user_dict
+# Output:
+#  - (bytes) packed ratings
+#  - (list - string) names of the packed maps
+def packRatingMaps(user_dict):
+  names = []
+  parts = []
+  for name in user_rating_maps:
+    ratings = user_dict.get(name)
+    if not isinstance(ratings, dict):
+      continue
+    try:
+      entries = list(ratings.values())
+      if any(set(entry) != {'rating', 'n_ratings'} or float(entry['n_ratings']) != int(entry['n_ratings']) for entry in entries):
+        raise ValueError('not a rating entry')
+      values = np.array([entry['rating'] for entry in entries], dtype='<f8')
+      counts = np.array([entry['n_ratings'] for entry in entries], dtype='<i8')
+      ids = '\0'.join(str(key) for key in ratings).encode('utf-8')
+    except Exception as e:
+      debug(f'[packRatingMaps - WARN]: Keeping {name} as a map, err = {e}')
+      continue
+    encoded_name = name.encode('utf-8')
+    parts += [struct.pack('<B', len(encoded_name)), encoded_name,
+              struct.pack('<II', len(entries), len(ids)), ids,
+              values.tobytes(), counts.tobytes()]
+    names.append(name)
+  payload = struct.pack('<H', len(names)) + b''.join(parts)
+  packed = PACKED_RATINGS_MAGIC + bytes([PACKED_RATINGS_VERSION]) + zlib.compress(payload, 1)
+  return packed, names
+
+################################################################################
+# unpackRatingMaps
+# Unpacks PACKED_RATINGS_FIELD's bytes into the rating maps.
+# Input:
+#  - (bytes) packed ratings
+# Output:
+#  - (dict) rating map name -> {id: {'rating', 'n_ratings'}}
+def unpackRatingMaps(packed):
+  packed = bytes(packed)
+  if packed[:len(PACKED_RATINGS_MAGIC)] != PACKED_RATINGS_MAGIC:
+    raise ValueError('Packed ratings do not start with the expected magic bytes.')
+  version = packed[len(PACKED_RATINGS_MAGIC)]
+  if version != PACKED_RATINGS_VERSION:
+    raise ValueError(f'Unknown packed ratings version {version}.')
+  payload = zlib.decompress(packed[len(PACKED_RATINGS_MAGIC)+1:])
+
+  rating_maps = {}
+  num_maps, = struct.unpack_from('<H', payload, 0)
+  offset = 2
+  for _ in range(num_maps):
+    name_length, = struct.unpack_from('<B', payload, offset)
+    name = payload[offset+1:offset+1+name_length].decode('utf-8')
+    offset += 1 + name_length
+    num_entries, ids_length = struct.unpack_from('<II', payload, offset)
+    offset += 8
+    ids = payload[offset:offset+ids_length].decode('utf-8').split('\0') if num_entries else []
+    offset += ids_length
+    values = np.frombuffer(payload, dtype='<f8', count=num_entries, offset=offset).tolist()
+    offset += 8*num_entries
+    counts = np.frombuffer(payload, dtype='<i8', count=num_entries, offset=offset).tolist()
+    offset += 8*num_entries
+    rating_maps[name] = {key: {'rating': value, 'n_ratings': count} for key, value, count in zip(ids, values, counts)}
+  return rating_maps
+
+################################################################################
+# decodeUserDocument
+# Returns the user document's data with any packed ratings unpacked into
+# the rating maps.
+# Input:
+#  - (dict) data <- as stored, or None
+# Output:
+#  - (dict) data
+def decodeUserDocument(data):
+  if data is None or not (PACKED_RATINGS_FIELD in data):
+    return data
+  data = dict(data)
+  data.update(unpackRatingMaps(data.pop(PACKED_RATINGS_FIELD)))
+  return data
+
+################################################################################
+# encodeUserDocument
+# Returns the user document's data in the USER_DOC_ENCODING, to be set.
+# Input:
+#  - (dict) data <- with the rating maps unpacked
+# Output:
+#  - (dict) data
+def encodeUserDocument(data):
+  if USER_DOC_ENCODING != 'packed':
+    return data
+  packed, names = packRatingMaps(data)
+  data = {key: value for key, value in data.items() if not (key in names)}
+  data[PACKED_RATINGS_FIELD] = packed
+  return data
+
+################################################################################
+# encodeUserRatings
+# Returns the update that rewrites all of the user's rating maps in the
+# USER_DOC_ENCODING, removing them from the other encoding.
+# Input:
+#  - (dict) data <- with the rating maps unpacked
+# Output:
+#  - (dict) field -> value
+def encodeUserRatings(data):
+  fields = {name: data[name] for name in user_rating_maps if name in data}
+  if USER_DOC_ENCODING != 'packed':
+    fields[PACKED_RATINGS_FIELD] = firestore.DELETE_FIELD
+    return fields
+  packed, names = packRatingMaps(data)
+  for name in names:
+    fields[name] = firestore.DELETE_FIELD
+  fields[PACKED_RATINGS_FIELD] = packed
+  return fields
+
 ################################################################################
 # "Database"
+################################################################################
+# Every document read and write goes through a DocumentSession, which uses
+# the storage backend chosen in app.py (see storage.py). During a
+# request the session is kept on flask.g, so each document is read at most
+# once and all of the request's changes are written in one batch by
+# commitDocumentSession after the response is made. Outside of a request
+# (e.g. on a listener thread) changes are written straight away.
+
+################################################################################
+# LocalDocument
+# Stands in for a document snapshot, using the session's copy of the data
+# rather than reading it from the database again. The document's reference
+# is its path.
+class LocalDocument:
+  def __init__(self, path, data, exists=True):
+    self.reference = path
+    self.id = path[-1]
+    self.exists = exists
+    self._data = data
+
+  def to_dict(self):
+    if not self.exists:
+      return None
+    return copy.deepcopy(self._data)
+
+################################################################################
+# document_read_pool
+# Thread pool used to read several documents at once from storage backends
+# that can not read them in one batch. The reads only use the storage
+# backend, so they do not need the request's context.
+document_read_pool = ThreadPoolExecutor(max_workers=DOCUMENT_READ_THREADS, thread_name_prefix='document-read')
+
+################################################################################
+# DocumentSession
+# Unit of work over the documents used by a request. Documents are keyed by
+# their path, e.g. ('users', user_id) or ('reviews', user_id, recipe_id, 'review').
+# Updates of a loaded document only write the top level fields whose values
+# changed. Field path updates (e.g. 'ic_taste.219.rating') and merges are
+# written as they are, and also applied to the loaded copy so later reads
+# see them.
+# A deferred session is not committed by commitDocumentSession, but by
+# whoever made it (asgi.py), using pendingWrites and committed.
+class DocumentSession:
+  def __init__(self, autocommit=False, deferred=False):
+    self.autocommit = autocommit
+    self.deferred = deferred
+    self._documents = {}
+    self._packed = []
+    self._after_commit = []
+
+  def _entry(self, path):
+    entry = self._documents.get(path)
+    if entry is None:
+      entry = {'path': path,
+               'loaded': False,
+               'data': None,
+               'created': False,
+               'deleted': False,
+               'packed': False,
+               'dirty': set(),
+               'raw': {},
+               'merge': {}}
+      self._documents[path] = entry
+    return entry
+
+  def _load(self, entry, data):
+    if isUserDocument(entry['path']):
+      entry['packed'] = data is not None and PACKED_RATINGS_FIELD in data
+      data = decodeUserDocument(data)
+    entry['data'] = data
+    entry['loaded'] = True
+
+  #-----------------------------------------------------------------------------
+  # Uses data read elsewhere (e.g. by asgi.py) for a document not read yet.
+  def preload(self, path, data):
+    entry = self._entry(path)
+    if not entry['loaded']:
+      self._load(entry, data)
+
+  def isLoaded(self, path):
+    return path in self._documents and self._documents[path]['loaded']
+
+  #-----------------------------------------------------------------------------
+  # Returns a LocalDocument of the document, reading it on first use.
+  def get(self, path):
+    entry = self._entry(path)
+    if not entry['loaded']:
+      self._load(entry, storage.getDocument(path))
+    return LocalDocument(path, entry['data'], entry['data'] is not None)
+
+  #-----------------------------------------------------------------------------
+  # Returns a LocalDocument of each document, reading the ones not used yet
+  # together: in one batch if the storage backend can, otherwise at the same
+  # time on the shared read pool.
+  def getMany(self, paths):
+    entries = [self._entry(path) for path in paths]
+    missing = list({id(entry): entry for entry in entries if not entry['loaded']}.values())
+    if len(missing) > 1:
+      missing_paths = [entry['path'] for entry in missing]
+      try:
+        documents = storage.getDocuments(missing_paths)
+      except NotImplementedError:
+        documents = document_read_pool.map(storage.getDocument, missing_paths)
+      for entry, data in zip(missing, documents):
+        self._load(entry, data)
+    return [self.get(path) for path in paths]
+
+  def set(self, path, data):
+    entry = self._entry(path)
+    entry.update({'loaded': True,
+                  'data': copy.deepcopy(data),
+                  'created': True,
+                  'deleted': False,
+                  'dirty': set(),
+                  'raw': {},
+                  'merge': {}})
+
+  def update(self, path, update_data):
+    entry = self._entry(path)
+    for key, value in update_data.items():
+      if entry['data'] is None:
+        entry['raw'][key] = value
+      elif '.' in key:
+        applyFieldPath(entry['data'], key, value)
+        entry['raw'][key] = value
+      elif not (key in entry['data']) or entry['data'][key] != value:
+        entry['data'][key] = copy.deepcopy(value)
+        entry['dirty'].add(key)
+
+  # Merges the data into the document (like set with merge=True), without
+  # needing to read it or for it to exist.
+  def merge(self, path, merge_data):
+    if isUserDocument(path):
+      # Loads the user's ratings, in case they need to be packed again
+      self.get(path)
+    entry = self._entry(path)
+    if entry['data'] is not None:
+      mergeFields(entry['data'], merge_data)
+    mergeFields(entry['merge'], merge_data, pending=True)
+
+  def delete(self, path):
+    entry = self._entry(path)
+    entry.update({'loaded': True,
+                  'data': None,
+                  'created': False,
+                  'deleted': True,
+                  'dirty': set(),
+                  'raw': {},
+                  'merge': {}})
+
+  #-----------------------------------------------------------------------------
+  # Writes every pending change in a single batch.
+  # Returns an error string if the batch fails, in which case nothing is written.
+  def commit(self):
+    writes = self.pendingWrites()
+    if not writes:
+      self.committed()
+      return ''
+
+    try:
+      storage.commit(writes)
+    except Exception as e:
+      err = f'[DocumentSession - ERROR]: Unable to commit {len(writes)} writes, err: {e}'
+      debug(err)
+      return err
+
+    self.committed()
+    return ''
+
+  #-----------------------------------------------------------------------------
+  # Returns the (operation, path, data) writes of every pending change, for
+  # StorageBackend.commit. Once they are written, call committed().
+  def pendingWrites(self):
+    writes = []
+    packed = []
+    for path, entry in self._documents.items():
+      if entry['deleted']:
+        writes.append(('delete', path, None))
+        continue
+      if entry['created']:
+        if isUserDocument(path):
+          writes.append(('set', path, encodeUserDocument(entry['data'])))
+          packed.append((entry, USER_DOC_ENCODING == 'packed'))
+        else:
+          writes.append(('set', path, entry['data']))
+      # A created document's data already includes its field path updates
+      # and merges, as does a top level field that is written as a whole.
+      merge_data = {}
+      if not entry['created']:
+        merge_data = {key: value for key, value in entry['merge'].items() if not (key in entry['dirty'])}
+      if merge_data:
+        writes.append(('merge', path, merge_data))
+      update_data = {}
+      if not entry['created']:
+        update_data = {key: entry['data'][key] for key in entry['dirty']}
+        for key, value in entry['raw'].items():
+          if not (key.split('.')[0] in entry['dirty']):
+            update_data[key] = value
+      if isUserDocument(path) and not entry['created']:
+        merge_data, update_data = self._encodeRatings(entry, merge_data, update_data, packed)
+      if update_data:
+        writes.append(('update', path, update_data))
+    self._packed = packed
+    return writes
+
+  # Marks the pendingWrites as written.
+  def committed(self):
+    for entry, entry_packed in self._packed:
+      entry['packed'] = entry_packed
+    self._packed = []
+    for entry in self._documents.values():
+      entry['created'] = False
+      entry['deleted'] = False
+      entry['dirty'] = set()
+      entry['raw'] = {}
+      entry['merge'] = {}
+    callbacks, self._after_commit = self._after_commit, []
+    for callback in callbacks:
+      try:
+        callback()
+      except Exception as e:
+        debug(f'[DocumentSession - ERROR]: After commit callback failed, err: {e}')
+
+  #-----------------------------------------------------------------------------
+  # Calls callback() once the session's pending changes have been written,
+  # e.g. to update an in memory copy of them. It is never called if they
+  # are discarded or fail to commit. An autocommit session has already
+  # written them, so it calls it straight away.
+  def afterCommit(self, callback):
+    if self.autocommit:
+      callback()
+    else:
+      self._after_commit.append(callback)
+
+  #-----------------------------------------------------------------------------
+  # Changes a user document's writes to rewrite all of its ratings in the
+  # USER_DOC_ENCODING, if its ratings changed and they are (or are to be)
+  # packed. Packed ratings can not be updated by field path, and a
+  # document's rating maps must not be left in both encodings.
+  def _encodeRatings(self, entry, merge_data, update_data, packed):
+    is_rating = lambda key: key.split('.')[0] in user_rating_maps
+    if not (entry['packed'] or USER_DOC_ENCODING == 'packed') or entry['data'] is None:
+      return merge_data, update_data
+    if not any(is_rating(key) for key in list(merge_data) + list(update_data)):
+      return merge_data, update_data
+    merge_data = {key: value for key, value in merge_data.items() if not is_rating(key)}
+    update_data = {key: value for key, value in update_data.items() if not is_rating(key)}
+    update_data.update(encodeUserRatings(entry['data']))
+    packed.append((entry, USER_DOC_ENCODING == 'packed'))
+    return merge_data, update_data
+
+  #-----------------------------------------------------------------------------
+  # Commits straight away if the session is not tied to a request.
+  def autoCommit(self):
+    if self.autocommit:
+      return self.commit()
+    return ''
+
+################################################################################
+# jobDocumentSession
+# Gives work done outside a request (e.g. a script or a background thread)
+# one document session on this thread, so each document is read at most
+# once in the block. The session writes straight away.
+#   with jobDocumentSession():
+#     user_doc_ref, user_doc, err = retrieveDocument('users', user_id)
+#     err = updateDocument('users', user_id, ...)
+# Output:
+#  - (DocumentSession) session
+_job_sessions = threading.local()
+
+@contextlib.contextmanager
+def jobDocumentSession():
+  previous = getattr(_job_sessions, 'session', None)
+  session = DocumentSession(autocommit=True)
+  _job_sessions.session = session
+  try:
+    yield session
+  finally:
+    _job_sessions.session = previous
+
+################################################################################
+# documentSession
+# Returns the current request's document session, or the thread's
+# jobDocumentSession if there is no request. Outside both, each call gets a
+# new session that writes straight away (so reads are not shared).
+# Output:
+#  - (DocumentSession) session
+def documentSession():
+  if not has_app_context():
+    session = getattr(_job_sessions, 'session', None)
+    if session is not None:
+      return session
+    return DocumentSession(autocommit=True)
+  if not ('document_session' in g):
+    g.document_session = DocumentSession()
+  return g.document_session
+
+################################################################################
+# commitDocumentSession
+# Writes the current request's changes, called once the response is made.
+# Output:
+#  - (string) error
+def commitDocumentSession():
+  if not has_app_context() or not ('document_session' in g):
+    return ''
+  session = g.pop('document_session')
+  if session.deferred:
+    return ''
+  return session.commit()
+
+################################################################################
+# discardDocumentSession
+# Drops the current request's changes without writing them.
+def discardDocumentSession():
+  if has_app_context():
+    g.pop('document_session', None)
+
 ################################################################################
 # retrieveCollection
 # Retrieve a collection of documents.
 # Input:
 #  - (string) collectionID <- Database collection name (ID)
 # Output:
-#  - (col_ref) collection reference
+#  - (tuple) collection path
 #  - (string) error
 def retrieveCollection(collectionID):
   debug(f'[retrieveCollection - INFO]: Starting.')
@@ -77,8 +557,7 @@ def retrieveCollection(collectionID):
     debug(err)
     return None, err
 
-  col_ref = db.collection(collectionID)
-  return col_ref, ''
+  return (collectionID,), ''
 
 ################################################################################
 # createDocument
@@ -94,17 +573,42 @@ def createDocument(collectionID, documentID, creationData):
   collectionID = f'{collectionID}'
   documentID = f'{documentID}'
 
-  doc_ref = db.collection(collectionID).document(documentID)
-  doc_ref.set(creationData)
-  doc = doc_ref.get()
-  if not doc.exists:
-    err = f'[retrieveDocument - ERROR]: Document {documentID} does not exist in collection {collectionID}.'
-    debug(err)
-    return err
-
-  return ''
+  session = documentSession()
+  session.set((collectionID, documentID), creationData)
+  return session.autoCommit()
 
+################################################################################
+# createDocuments
+# Creates and updates several documents together, so either all of the
+# writes are made or none are.
+# Input:
+#  - (list) creations <- (collectionID, documentID, creationData) to set
+#  - (list) updates <- (collectionID, documentID, updateData) to update
+# Output:
+#  - (dict) (collectionID, documentID) -> path for each created document
+#  - (string) error
+def createDocuments(creations, updates=None):
+  debug(f'[createDocuments - INFO]: Starting.')
+  if updates is None:
+    updates = []
+  session = documentSession()
+  doc_refs = {}
+  for collectionID, documentID, creationData in creations:
+    collectionID = f'{collectionID}'
+    documentID = f'{documentID}'
+    if not (collectionID in collectionIDs):
+      err = f'[createDocuments - ERROR]: Collection name {collectionID} is not a known collection.'
+      debug(err)
+      return None, err
+    session.set((collectionID, documentID), creationData)
+    doc_refs[(collectionID, documentID)] = (collectionID, documentID)
+  for collectionID, documentID, updateData in updates:
+    session.update((f'{collectionID}', f'{documentID}'), updateData)
 
+  err = session.autoCommit()
+  if err:
+    return None, err
+  return doc_refs, ''
 
 ################################################################################
 # createSubDocument
@@ -121,17 +625,55 @@ def createSubDocument(mainCollection, UserId, collectionID, documentID, creation
   debug(f'[createSubDocument - INFO]: Starting.')
   collectionID = f'{collectionID}'
   documentID = f'{documentID}'
-  doc_ref = db.collection(mainCollection).document(UserId)
-  subdoc_ref = doc_ref.collection(collectionID).document(documentID)
-  subdoc_ref.set(creationData)
-  
-  doc = subdoc_ref.get()
-  if not doc.exists:
-    err = f'[retrieveDocument - ERROR]: Document {documentID} does not exist in collection {collectionID}.'
+
+  session = documentSession()
+  session.set((f'{mainCollection}', f'{UserId}', collectionID, documentID), creationData)
+  return session.autoCommit()
+
+################################################################################
+# mergeDocument
+# Merge values into a document within a specified document collection,
+# creating it if needed. Nested maps are merged rather than replaced.
+# Input:
+#  - (string) collectionID <- Database collection name (ID)
+#  - (string) documentID <- Database document name (ID)
+#  - (dict) mergeData <- Dictionary containing values to merge into the doc
+# Output:
+#  - (string) error
+def mergeDocument(collectionID, documentID, mergeData):
+  debug(f'[mergeDocument - INFO]: Starting.')
+  collectionID = f'{collectionID}'
+  documentID = f'{documentID}'
+
+  if not (collectionID in collectionIDs):
+    err = f'[mergeDocument - ERROR]: Collection name {collectionID} is not a known collection.'
     debug(err)
     return err
 
-  return ''
+  session = documentSession()
+  session.merge((collectionID, documentID), mergeData)
+  return session.autoCommit()
+
+################################################################################
+# mergeSubDocument
+# Merge values into a sub document within a specified document, creating
+# it if needed. Nested maps are merged rather than replaced.
+# Input:
+#  - (String) mainCollection <- name of main collection
+#  - (String) UserId <- UserId or main Document Id
+#  - (string) collectionID <- Database sub collection name (ID)
+#  - (string) documentID <- Database sub document name (ID)
+#  - (dict) mergeData <- Dictionary containing values to merge into the doc
+# Output:
+#  - (string) error
+def mergeSubDocument(mainCollection, UserId, collectionID, documentID, mergeData):
+  debug(f'[mergeSubDocument - INFO]: Starting.')
+  collectionID = f'{collectionID}'
+  documentID = f'{documentID}'
+
+  session = documentSession()
+  session.merge((f'{mainCollection}', f'{UserId}', collectionID, documentID), mergeData)
+  return session.autoCommit()
 
 ################################################################################
 # retrieveDocument
@@ -140,7 +682,7 @@ def createSubDocument(mainCollection, UserId, collectionID, documentID, creation
 #  - (string) collectionID <- Database collection name (ID)
 #  - (string) documentID <- Database document name (ID)
 # Output:
-#  - (doc_ref) document reference
+#  - (tuple) document path
 #  - (doc) document itself (if it exists)
 #  - (string) error
 def retrieveDocument(collectionID, documentID, returnErrorOnNull=False):
@@ -153,19 +695,47 @@ def retrieveDocument(collectionID, documentID, returnErrorOnNull=False):
     debug(err)
     return None, None, err
 
-  doc_ref = db.collection(collectionID).document(documentID)
-  doc = doc_ref.get()
+  session = documentSession()
+  doc = session.get((collectionID, documentID))
   if not doc.exists:
     if not returnErrorOnNull:
-      doc_ref.set({})
-      doc_ref = db.collection(collectionID).document(documentID)
-      doc = doc_ref.get()
+      session.set((collectionID, documentID), {})
+      err = session.autoCommit()
+      if err:
+        return None, None, err
+      doc = session.get((collectionID, documentID))
     else:
       err = f'[retrieveDocument - ERROR]: Document {documentID} does not exist in collection {collectionID}.'
       debug(err)
       return None, None, err
 
-  return doc_ref, doc, ''
+  return doc.reference, doc, ''
+
+################################################################################
+# retrieveDocuments
+# Retrieve several documents at once, so their reads take one round trip
+# rather than one each.
+# Unlike retrieveDocument, documents that do not exist are returned (with
+# exists set to False) rather than created.
+# Input:
+#  - (list) documents <- (collectionID, documentID) of each document
+# Output:
+#  - (list) (document path, document) of each document, in the same order
+#  - (string) error
+def retrieveDocuments(documents):
+  debug(f'[retrieveDocuments - INFO]: Starting.')
+  paths = []
+  for collectionID, documentID in documents:
+    collectionID = f'{collectionID}'
+    documentID = f'{documentID}'
+    if not (collectionID in collectionIDs):
+      err = f'[retrieveDocuments - ERROR]: Collection name {collectionID} is not a known collection.'
+      debug(err)
+      return None, err
+    paths.append((collectionID, documentID))
+
+  docs = documentSession().getMany(paths)
+  return [(doc.reference, doc) for doc in docs], ''
 
 ################################################################################
 # deleteDocument
@@ -180,17 +750,14 @@ def deleteDocument(collectionID, documentID):
   collectionID = f'{collectionID}'
   documentID = f'{documentID}'
 
-  doc_ref, doc, err = retrieveDocument(collectionID, documentID)
-  if err:
-    err = f'[deleteDocument - ERROR]: Unable to retrieve document, err: {err}'
+  if not (collectionID in collectionIDs):
+    err = f'[deleteDocument - ERROR]: Collection name {collectionID} is not a known collection.'
     debug(err)
     return err
 
-  if not doc.exists:
-    return ''
-
-  doc_ref.delete()
-  return ''
+  session = documentSession()
+  session.delete((collectionID, documentID))
+  return session.autoCommit()
 
 ################################################################################
 # updateDocument
@@ -207,14 +774,14 @@ def updateDocument(collectionID, documentID, updateData):
   documentID = f'{documentID}'
 
   doc_ref, doc, err = retrieveDocument(collectionID, documentID)
-
-  if not doc.exists:
-    err = f'[updateDocument - ERROR]: Document {documentID} does not exist in collection {collectionID}.'
+  if err:
+    err = f'[updateDocument - ERROR]: Unable to retrieve document, err: {err}'
     debug(err)
     return err
 
-  doc_ref.update(updateData)
-  return ''
+  session = documentSession()
+  session.update((collectionID, documentID), updateData)
+  return session.autoCommit()
 
 ################################################################################
 # Helper Functions
@@ -228,8 +795,7 @@ def updateDocument(collectionID, documentID, updateData):
 #   - (string) error
 def getIngredientInformation(ingredient_id):
   debug(f'[getIngredientInformation - INFO]: Starting.')
-  ingredients_dict = g.ic_data[ingredient_id]
-  ingredientName = ingredients_dict["name"].replace('_', ' ')
+  ingredientName = getCatalog().clusterName(ingredient_id).replace('_', ' ')
   return ingredientName, ''
 
 ################################################################################
@@ -242,31 +808,37 @@ def getIngredientInformation(ingredient_id):
 #   - (string) error
 def getRecipeInformation(recipe_id):
   debug(f'[getRecipeInformation - INFO]: Starting.')
-  recipes_dict = g.r_data[recipe_id]
+  recipe_card, err = getRecipeCard(recipe_id)
+  if err:
+    return None, err
+  return json.loads(recipe_card), ''
 
-  # Change the ingredient ids to ingredient names
-  ingredientNames = []
-  for ingredient_id in recipes_dict["ingredient_ids"]:
-    # Retrieve the recipe's ingredient information
-    if ingredient_id == None:
-      continue
-    ingredients_dict = g.i_data[str(ingredient_id)]
-    ingredientName = ingredients_dict["name"].replace('_', ' ').capitalize()
-    if not (ingredientName in ingredientNames):
-      ingredientNames.append(ingredientName)
-  recipes_dict["ingredient_names"] = ingredientNames
-
-  # Remove the image field
-  del recipes_dict["image"]
-  # Remove the ingredient_ids field
-  del recipes_dict["ingredient_ids"]
-  # Remove the surprises field
-  del recipes_dict["surprises"]
-  # Remove the url field
-  del recipes_dict["url"]
-  # Remove the vector field
-  del recipes_dict["vector"]
-  # Remove the vegetarian field
-  del recipes_dict["vegetarian"]
-
-  return recipes_dict, ''
+################################################################################
+# getRecipeCard
+# Returns the recipe info needed by the front end as pre-encoded json,
+# ready to be put into a response with recipeCardsResponse.
+# - Input:
+#   - (string) recipe_id
+# - Output:
+#   - (bytes) recipe's json encoded information,
+#   - (string) error
+def getRecipeCard(recipe_id):
+  try:
+    return getCatalog().recipeCard(recipe_id), ''
+  except KeyError:
+    err = f'Recipe {recipe_id} does not exist.'
+    debug(f'[getRecipeCard - ERROR]: {err}')
+    return None, err
+
+################################################################################
+# recipeCardsResponse
+# Builds a json response of recipe id -> recipe card by joining the
+# pre-encoded cards, rather than decoding and re-encoding them.
+# - Input:
+#   - (dict) recipe id -> recipe card bytes
+# - Output:
+#   - (Response) json response
+def recipeCardsResponse(recipe_cards):
+  body = b','.join(json.dumps(str(recipe_id)).encode('utf-8')+b':'+recipe_card
+                   for recipe_id, recipe_card in sorted(recipe_cards.items(), key=lambda item: str(item[0])))
+  return Response(b'{'+body+b'}', mimetype='application/json')
@@ -0,0 +1,113 @@
+################################################################################
+# Q-Chef Server
+# Authors: Q-Chef Backend Programmers
+# Updated: 20261018
+
+import random
+import threading
+import time
+
+from app import storage
+from firebase_admin import firestore
+from func import debug, documentSession, mergeSubDocument
+
+################################################################################
+# Constants
+################################################################################
+# The number of users in each experiment group is counted over
+# GROUP_COUNTER_SHARDS documents, server/groupCounts/shards/<shard>, each
+# holding {group: count}, so signups do not all write to one document.
+# server/settings' groupNum holds the counts from before the shards.
+GROUP_COUNTER_SHARDS = 10
+GROUP_COUNTER_TTL = 30 # seconds between re-reading the shards
+GROUP_COUNTER_PATH = ('server', 'groupCounts', 'shards')
+
+################################################################################
+# GroupCounters
+################################################################################
+# GroupCounters
+# Sharded counter of the users in each experiment group. Counts are read by
+# summing the shards at most every ttl seconds (the total is shared by the
+# whole process), plus this process' own committed increments since then.
+# While one thread re-reads the shards, the others use the previous total.
+class GroupCounters:
+  def __init__(self, shards=GROUP_COUNTER_SHARDS, ttl=GROUP_COUNTER_TTL):
+    self.shards = shards
+    self.ttl = ttl
+    self._totals = None
+    self._expires = 0
+    self._lock = threading.Lock()
+    self._refresh_lock = threading.Lock()
+
+  #-----------------------------------------------------------------------------
+  # Sums the shards, read in one round trip. The total is kept for the whole
+  # process rather than a request, so the shards are read from storage
+  # directly.
+  def _aggregate(self):
+    paths = [GROUP_COUNTER_PATH + (str(shard),) for shard in range(self.shards)]
+    try:
+      shards = storage.getDocuments(paths)
+    except NotImplementedError:
+      shards = [storage.getDocument(path) for path in paths]
+    totals = {}
+    for counts in shards:
+      for group, count in (counts or {}).items():
+        totals[group] = totals.get(group, 0) + count
+    return totals
+
+  #-----------------------------------------------------------------------------
+  # Re-reads the shards if the total is out of date. Only one thread reads
+  # them, the others wait only if there is no total yet.
+  def _refresh(self):
+    if self._totals is not None and time.time() <= self._expires:
+      return
+    if not self._refresh_lock.acquire(blocking=self._totals is None):
+      return
+    try:
+      if self._totals is not None and time.time() <= self._expires:
+        return
+      try:
+        totals = self._aggregate()
+      except Exception as e:
+        debug(f'[GroupCounters - WARN]: Unable to sum the group counter shards, err = {e}')
+        totals = None
+      with self._lock:
+        if totals is not None:
+          self._totals = totals
+          self._expires = time.time() + self.ttl
+        elif self._totals is None:
+          self._totals = {}
+    finally:
+      self._refresh_lock.release()
+
+  #-----------------------------------------------------------------------------
+  # Returns {group: number of users}, including the settings' groupNum.
+  def counts(self, server_settings):
+    self._refresh()
+    with self._lock:
+      totals = dict(self._totals)
+    counts = {str(group): count for group, count in server_settings.get('groupNum', {}).items()}
+    for group, count in totals.items():
+      counts[group] = counts.get(group, 0) + count
+    return counts
+
+  #-----------------------------------------------------------------------------
+  # Counts a new user in the group, as part of the request's document session.
+  # The process' total only counts it once the session has been committed.
+  # Returns an error string.
+  def increment(self, group):
+    group = str(group)
+    shard = str(random.randrange(self.shards))
+    err = mergeSubDocument(GROUP_COUNTER_PATH[0], GROUP_COUNTER_PATH[1], GROUP_COUNTER_PATH[2], shard, {group: firestore.Increment(1)})
+    if err:
+      return err
+    documentSession().afterCommit(lambda: self._countLocal(group))
+    return ''
+
+  def _countLocal(self, group):
+    with self._lock:
+      if self._totals is not None:
+        self._totals[group] = self._totals.get(group, 0) + 1
+
+# Process-wide counters used by routes.createUserProfile
+group_counters = GroupCounters()
@@ -0,0 +1,50 @@
+################################################################################
+# Q-Chef Server
+# Authors: Q-Chef Backend Programmers
+# Updated: 20261018
+
+# Gunicorn settings, read from the working directory when the server starts.
+
+import gc
+
+################################################################################
+# Settings
+################################################################################
+# Imports app.py (which warms up the catalog and models, see lifecycle.py)
+# once in the master before forking, so each worker starts warm and shares
+# the loaded pages with the master rather than loading its own copy.
+preload_app = True
+
+# This file is read in the master before the app is preloaded, so the
+# collector is turned off here, before the catalog and models are loaded.
+# It stays off in the master, and is turned back on in each worker by
+# post_fork (see ServerLifecycle.freeze).
+gc.disable()
+
+# Seconds a worker has to finish its requests and flush the write queue
+# (WRITE_QUEUE_FLUSH_TIMEOUT) after SIGTERM before it is killed. Cloud Run
+# kills the container 10 seconds after SIGTERM.
+graceful_timeout = 8
+
+################################################################################
+# Server Hooks
+################################################################################
+# Runs in the master after the app is loaded and before any worker forks.
+def when_ready(server):
+  from lifecycle import server_lifecycle
+  if not server_lifecycle.isReady():
+    server.log.warning(f'Starting workers before the server is warm, err = {server_lifecycle.error}')
+
+# Runs in the master just before each worker forks.
+def pre_fork(server, worker):
+  from lifecycle import server_lifecycle
+  server_lifecycle.freeze()
+
+# Runs in each worker just after it forks.
+def post_fork(server, worker):
+  gc.enable()
+
+# Finishes the queued writes before a worker shuts down.
+def worker_exit(server, worker):
+  from write_queue import write_queue, WRITE_QUEUE_FLUSH_TIMEOUT
+  write_queue.flush(WRITE_QUEUE_FLUSH_TIMEOUT)
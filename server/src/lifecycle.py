@@ -0,0 +1,91 @@
+################################################################################
+# Q-Chef Server
+# Authors: Q-Chef Backend Programmers
+# Updated: 20261018
+
+import gc
+import threading
+import time
+
+import numpy as np
+
+from catalog import getCatalog
+from scoring import scoreRecipes
+from surprise_models import model_registry
+
+################################################################################
+# ServerLifecycle
+################################################################################
+# ServerLifecycle
+# Warms the process before it takes traffic: loads the catalog and the
+# surprise models and runs the scoring code once, so the first meal plan
+# request does not pay for them. With gunicorn's preload_app (see
+# gunicorn.conf.py) this happens once in the master, and the workers fork
+# with everything loaded. Nothing here touches Firestore, as a gRPC channel
+# opened before a fork can not be used by the children.
+# /readyz reports ready once warm() has succeeded.
+class ServerLifecycle:
+  def __init__(self):
+    self.created_at = time.time()
+    self.warmed_at = None
+    self.warm_seconds = None
+    self.frozen_objects = 0
+    self.error = ''
+    self._ready = False
+    self._lock = threading.Lock()
+
+  #-----------------------------------------------------------------------------
+  # Loads and warms everything the requests share. Safe to call more than
+  # once, only the first successful call does any work.
+  # - Output:
+  #   - (string) error
+  def warm(self):
+    with self._lock:
+      if self._ready:
+        return ''
+      start = time.time()
+      try:
+        catalog = getCatalog()
+        err = model_registry.load()
+        if err:
+          raise RuntimeError(err)
+        # Runs the sparse mat-vec once, so scipy/BLAS initialise now
+        scoreRecipes(np.zeros(len(catalog.columns['i_ids'])))
+      except Exception as e:
+        self.error = f'Unable to warm up the server, err = {e}'
+        print(f'[ServerLifecycle - ERROR]: {self.error}')
+        return self.error
+      self.error = ''
+      self.warmed_at = time.time()
+      self.warm_seconds = self.warmed_at - start
+      self._ready = True
+      print(f'[ServerLifecycle - INFO]: Warmed up in {self.warm_seconds:.3f}s')
+    return ''
+
+  #-----------------------------------------------------------------------------
+  # Moves every object allocated so far (the modules, catalog and models)
+  # out of the collector's generations, just before a worker forks, so the
+  # worker's collections never write to their pages and the pages stay
+  # shared with the master. This follows the gc module's documented
+  # pattern, with gunicorn.conf.py turning the collector off early in the
+  # master (a collection there would free objects and leave holes in the
+  # shared pages, which the workers would then allocate into and copy) and
+  # back on in each worker after the fork.
+  def freeze(self):
+    gc.freeze()
+    self.frozen_objects = gc.get_freeze_count()
+    print(f'[ServerLifecycle - INFO]: Froze {self.frozen_objects} objects before forking')
+
+  def isReady(self):
+    return self._ready
+
+  def status(self):
+    return {'ready': self._ready,
+            'error': self.error,
+            'uptime_seconds': time.time() - self.created_at,
+            'warm_seconds': self.warm_seconds,
+            'frozen_objects': self.frozen_objects,
+            'models_loaded': model_registry.isLoaded()}
+
+# Process-wide lifecycle, warmed by app.py
+server_lifecycle = ServerLifecycle()
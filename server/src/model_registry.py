@@ -0,0 +1,128 @@
+################################################################################
+# Q-Chef Server
+# Authors: Q-Chef Backend Programmers
+# Updated: 20261018
+
+import hashlib
+import os
+import threading
+import time
+import traceback
+
+from joblib import load
+
+################################################################################
+# Constants
+################################################################################
+# How often (in seconds) the model files are checked for changes on disk.
+MODEL_CHECK_INTERVAL = 30
+
+################################################################################
+# ModelRegistry
+################################################################################
+# ModelRegistry
+# Loads a set of joblib models once per process and shares them between
+# request threads. A model whose file changes on disk is reloaded (and
+# warmed up) by the next lookup, while other threads keep using the old
+# models, then swapped in atomically so requests always see a complete set.
+# - Input:
+#   - (dict) model name -> joblib file name,
+#   - (function) warmup(model), run once after each (re)load
+class ModelRegistry:
+  def __init__(self, model_fns, warmup=None, check_interval=MODEL_CHECK_INTERVAL):
+    self.model_fns = dict(model_fns)
+    self.warmup = warmup
+    self.check_interval = check_interval
+    self._models = None
+    self._metadata = {}
+    self._last_check = 0
+    self._lock = threading.Lock()
+
+  #-----------------------------------------------------------------------------
+  # Loads and warms up one model.
+  # Returns (model, metadata) or raises if the file can not be loaded.
+  def _loadModel(self, model_key):
+    model_fn = self.model_fns[model_key]
+    start = time.time()
+    stat = os.stat(model_fn)
+    with open(model_fn, 'rb') as f:
+      version = hashlib.sha1(f.read()).hexdigest()[:12]
+    model = load(model_fn)
+    loaded = time.time()
+    if self.warmup is not None:
+      self.warmup(model)
+    warmed = time.time()
+    metadata = {'file': model_fn,
+                'version': version,
+                'mtime': stat.st_mtime,
+                'size': stat.st_size,
+                'loaded_at': loaded,
+                'load_seconds': loaded - start,
+                'warmup_seconds': warmed - loaded}
+    print(f'[ModelRegistry - INFO]: Loaded {model_fn} (version {version}) in {warmed - start:.3f}s')
+    return model, metadata
+
+  #-----------------------------------------------------------------------------
+  # Loads every model. Returns an error string if any of them fail.
+  def load(self):
+    with self._lock:
+      if self._models is not None:
+        return ''
+      models = {}
+      metadata = {}
+      for model_key, model_fn in self.model_fns.items():
+        try:
+          models[model_key], metadata[model_key] = self._loadModel(model_key)
+        except:
+          traceback.print_exc()
+          return f'Failed to load model from file. Does {model_fn} exist?'
+      self._metadata = metadata
+      self._models = models
+      self._last_check = time.time()
+    return ''
+
+  #-----------------------------------------------------------------------------
+  # Reloads any model whose file has changed since it was loaded.
+  # A failed reload keeps serving the previously loaded model.
+  def reloadChanged(self):
+    # Only one thread reloads, the others carry on with the current models.
+    if not self._lock.acquire(blocking=False):
+      return
+    try:
+      self._last_check = time.time()
+      models = dict(self._models)
+      metadata = dict(self._metadata)
+      changed = False
+      for model_key, model_fn in self.model_fns.items():
+        try:
+          if os.stat(model_fn).st_mtime == metadata[model_key]['mtime']:
+            continue
+          models[model_key], metadata[model_key] = self._loadModel(model_key)
+          changed = True
+        except:
+          traceback.print_exc()
+          print(f'[ModelRegistry - ERROR]: Unable to reload {model_fn}, keeping version {metadata[model_key]["version"]}')
+      if changed:
+        self._metadata = metadata
+        self._models = models
+    finally:
+      self._lock.release()
+
+  #-----------------------------------------------------------------------------
+  # Returns (dict of models, error), loading them on first use.
+  def models(self):
+    if self._models is None:
+      err = self.load()
+      if err:
+        return None, err
+    elif time.time() - self._last_check > self.check_interval:
+      self.reloadChanged()
+    return self._models, ''
+
+  #-----------------------------------------------------------------------------
+  # Returns the load time and version information of every loaded model.
+  def metadata(self):
+    return {k: dict(v) for k, v in self._metadata.items()}
+
+  def isLoaded(self):
+    return self._models is not None
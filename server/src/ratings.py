@@ -5,6 +5,9 @@
 
 from func import *
 from surprise_models import *
+from scoring import ingredientRatingVector, scoreRecipes
+from recipe_cache import recommendation_cache, recommendationKey
+from server_settings import settings_service
 from scipy.stats import gmean
 from sklearn.preprocessing import minmax_scale
 import numpy as np
@@ -24,6 +27,10 @@ rating_types = ['taste',
                 'familiarity',
                 'surprise']
 
+# Prefixes of the user's rating maps, e.g. 'ic_' for ic_taste.
+ingredient_rating_levels = ['i_', 'is_', 'ic_']
+recipe_rating_levels = ['r_']
+
 ################################################################################
 # Helper Functions
 ################################################################################
@@ -50,9 +57,10 @@ def getIngredientRating(user_dict, ingredient_id, rating_type):
     debug(err)
     return None, err
 
+  catalog = getCatalog()
   i_id = ingredient_id
-  is_id = str(g.i_data[i_id]['subcluster'])
-  ic_id = str(g.i_data[i_id]['cluster'])
+  is_id = str(catalog.ingredientSubcluster(i_id))
+  ic_id = str(catalog.ingredientCluster(i_id))
   try:
     ingredientTasteRating = user_dict['i_'+rating_type][i_id]['rating']
   except:
@@ -86,7 +94,7 @@ def getIngredientRating(user_dict, ingredient_id, rating_type):
 #   - (float) estimated ingredient cluster preference,
 def getIngredientRatingByNeighbour(ingredient_id, ratings, weights=[0.5, 0.3, 0.2], discount_factor = 0.75):
   debug(f'[getIngredientRatingByNeighbour - INFO]: Starting for ingredient {ingredient_id}.')
-  my_neighbours = g.neighbours[int(ingredient_id)]
+  my_neighbours = getCatalog().clusterNeighbours(ingredient_id)
   debug(f'[getIngredientRatingByNeighbour - DATA]: Retrieved neghbours for ingredient {ingredient_id} of: {my_neighbours}')
   debug(f'[getIngredientRatingByNeighbour - DATA]: Provided ratings ingredient {ingredient_id} of: {ratings}')
   names = ['most_similar_id', 'second_most_similar_id', 'third_most_similar_id']
@@ -131,9 +139,8 @@ def getRecipeRating(user_dict, recipe_id, rating_type):
     return None, err
 
   # Obtain all of the recipe ingredients
-  recipe_dict = g.r_data[recipe_id]
   debug(f'[getRecipeRating - {rating_type} - DATA]: recipe_id = {recipe_id}')
-  ingredient_ids = recipe_dict["ingredient_ids"]
+  ingredient_ids = getCatalog().recipeIngredientIDs(recipe_id)
   debug(f'[getRecipeRating - {rating_type} - DATA]: ingredient_ids = {ingredient_ids}')
   sumIngredientRatings = 0
   numIngredientRatings = 0
@@ -160,6 +167,32 @@ def getRecipeRating(user_dict, recipe_id, rating_type):
 
   return sumIngredientRatings/numIngredientRatings, ''
 
+################################################################################
+# getRecipeRatings
+# Vectorised getRecipeRating for every recipe in the catalog.
+# - Input:
+#   - (dict) user_dict,
+#   - (string) rating_type
+# - Output:
+#   - (np.array) recipe preferences aligned with getCatalog().recipeIDs(),
+#     NaN where no rating is available,
+#   - (string) error
+def getRecipeRatings(user_dict, rating_type):
+  rating_type = rating_type.lower()
+  debug(f'[getRecipeRatings - {rating_type} - INFO]: Starting.')
+
+  if not (rating_type in rating_types):
+    err = f'[getRecipeRatings - {rating_type} - ERROR]: rating_type {rating_type} is not a known rating type.'
+    debug(err)
+    return None, err
+
+  neighbour_estimator = None
+  if rating_type == "taste" and USE_VECTOR_ESTIMATOR:
+    neighbour_estimator = getIngredientRatingByNeighbour
+  ingredient_ratings = ingredientRatingVector(user_dict, rating_type, neighbour_estimator)
+  recipe_ratings, _ = scoreRecipes(ingredient_ratings)
+  return recipe_ratings, ''
+
 ################################################################################
 # getTasteRecipes
 # Returns a constant times wanted number of recipes 
@@ -167,7 +200,7 @@ def getRecipeRating(user_dict, recipe_id, rating_type):
 # - Input:
 #   - (dict) user_dict
 # - Output:
-#   - (dict) recipes and their information,
+#   - (dict) recipe id -> pre-encoded recipe card (see recipeCardsResponse),
 #   - (string) error
 def getTasteRecipes(user_dict):
   debug(f'[getTasteRecipes - INFO]: Starting.')
@@ -181,19 +214,21 @@ def getTasteRecipes(user_dict):
   # Retrieve the user's info
   user_recipes = list(user_dict['r_taste'].keys())
   
-  # Retrieve the recipe collection
+  # Score the whole recipe collection at once
   possibleRecipes = []
-  recipe_ids = g.r_data.keys()
+  recipe_ids = getCatalog().recipeIDs()
+  recipePrefs, err = getRecipeRatings(user_dict, 'taste')
+  if err:
+    return None, err
   err = f'[getTasteRecipes - HELP]: For user {user_id}, recipe {user_recipes} have already been rated.'
   debug(err)
-  for recipe_id in recipe_ids:
+  for recipe_id, userRecipePref in zip(recipe_ids, recipePrefs.tolist()):
     if recipe_id in user_recipes:
       err = f'[getTasteRecipes - INFO]: For user {user_id}, recipe {recipe_id} has already been rated, therefore continuing...'
       debug(err)
       continue
-    userRecipePref, err = getRecipeRating(user_dict, recipe_id, 'taste')
-    if err:
-      err = f'[getTasteRecipes - ERROR]: Unable to find user {user_id} taste preference for recipe {recipe_id}, err = {err}'
+    if np.isnan(userRecipePref):
+      err = f'[getTasteRecipes - ERROR]: Unable to find user {user_id} taste preference for recipe {recipe_id}'
       debug(err)
       continue # Just ignore this recipe then.
     possibleRecipes.append((userRecipePref, recipe_id))
@@ -208,12 +243,12 @@ def getTasteRecipes(user_dict):
   recipe_info = {}
   for pref, recipe_id in possibleRecipes:
     # Get the recipe information
-    recipeInfo, err = getRecipeInformation(recipe_id)
+    recipeCard, err = getRecipeCard(recipe_id)
     if err:
       err = f'[getTasteRecipes - WARN]: Unable to get recipe {recipe_id} information, err = {err}. Skipping...'
       debug(err)
       continue
-    recipe_info[recipe_id] = recipeInfo
+    recipe_info[recipe_id] = recipeCard
 
   return recipe_info, ''
 
@@ -224,7 +259,7 @@ def getTasteRecipes(user_dict):
 # - Input:
 #   - (dict) user_dict
 # - Output:
-#   - (dict) recipes and their information,
+#   - (dict) recipe id -> pre-encoded recipe card (see recipeCardsResponse),
 #   - (string) error
 def getTasteAndSurpRecipes(user_dict, server_dict, drop_thresh = 0.25):
   if "history" in user_dict.keys():
@@ -254,17 +289,19 @@ def getTasteAndSurpRecipes(user_dict, server_dict, drop_thresh = 0.25):
   userRecipeSurps = []
   userRecipePrefs = []
   kept_recipe_ids = []
-  recipe_ids = g.r_data.keys()
+  recipe_ids = getCatalog().recipeIDs()
+  recipePrefs, err = getRecipeRatings(user_dict, 'taste')
+  if err:
+    return None, err
   err = f'[getTasteAndSurpRecipes - HELP]: For user {user_id}, recipe {user_recipes} have already been rated.'
   debug(err)
-  for recipe_id in recipe_ids:
+  for recipe_id, userRecipePref in zip(recipe_ids, recipePrefs.tolist()):
     if recipe_id in user_recipes:
       err = f'[getTasteAndSurpRecipes - INFO]: For user {user_id}, recipe {recipe_id} has already been rated, therefore continuing...'
       debug(err)
       continue
-    userRecipePref, err = getRecipeRating(user_dict, recipe_id, 'taste')
-    if err:
-      err = f'[getTasteAndSurpRecipes - ERROR]: Unable to find user {user_id} taste preference for recipe {recipe_id}, err = {err}'
+    if np.isnan(userRecipePref):
+      err = f'[getTasteAndSurpRecipes - ERROR]: Unable to find user {user_id} taste preference for recipe {recipe_id}'
       debug(err)
       continue  # Just ignore this recipe then.
 
@@ -319,13 +356,13 @@ def getTasteAndSurpRecipes(user_dict, server_dict, drop_thresh = 0.25):
   recipe_info = {}
   for recipe_id in chosenRecipeIDs:
     # Get the recipe information
-    recipeInfo, err = getRecipeInformation(recipe_id)
+    recipeCard, err = getRecipeCard(recipe_id)
     if err:
       err = f'[getTasteAndSurpRecipes - WARN]: Unable to get recipe {recipe_id} information, err = {err}. Skipping...'
       debug(err)
       continue
-    recipe_info[recipe_id] = recipeInfo
-  debug(f"[getTasteAndSurpRecipes - DATA]: Returning recipe_info: {recipe_info}")
+    recipe_info[recipe_id] = recipeCard
+  debug(f"[getTasteAndSurpRecipes - DATA]: Returning recipe_info: {list(recipe_info.keys())}")
   return recipe_info, ''
 
 ################################################################################
@@ -335,7 +372,7 @@ def getTasteAndSurpRecipes(user_dict, server_dict, drop_thresh = 0.25):
 # - Input:
 #   - (dict) user_dict
 # - Output:
-#   - (dict) recipes and their information,
+#   - (dict) recipe id -> pre-encoded recipe card (see recipeCardsResponse),
 #   - (string) error
 def getSurpRecipes(user_dict):
   debug(f'[getSurpRecipes - INFO]: Starting.')
@@ -352,7 +389,7 @@ def getSurpRecipes(user_dict):
 
   # Retrieve the recipe collection
   possibleRecipes = []
-  recipe_ids = g.r_data.keys()
+  recipe_ids = getCatalog().recipeIDs()
   err = f'[getSurpRecipes - HELP]: For user {user_id}, recipe {user_recipes} have already been rated.'
   debug(err)
   for recipe_id in recipe_ids:
@@ -378,12 +415,12 @@ def getSurpRecipes(user_dict):
   recipe_info = {}
   for pref, recipe_id in possibleRecipes:
     # Get the recipe information
-    recipeInfo, err = getRecipeInformation(recipe_id)
+    recipeCard, err = getRecipeCard(recipe_id)
     if err:
       err = f'[getTasteAndSurpRecipes - WARN]: Unable to get recipe {recipe_id} information, err = {err}. Skipping...'
       debug(err)
       continue
-    recipe_info[recipe_id] = recipeInfo
+    recipe_info[recipe_id] = recipeCard
 
   return recipe_info, ''
 
@@ -441,11 +478,13 @@ def paretoRecipeSort(possibleRecipesDict,numWanted):
 ################################################################################
 # getRecipes
 # Returns a constant times wanted number of recipes.
+# Results are cached per user until their ratings, history or the
+# recommendation settings change (see recipe_cache.py).
 # - Input:
 #   - (dict) user_dict,
 #   - (dict) server_settings
 # - Output:
-#   - (dict) recipes and their information,
+#   - (dict) recipe id -> pre-encoded recipe card (see recipeCardsResponse),
 #   - (string) error
 def getRecipes(user_dict, server_settings):
   debug(f'[getRecipes - INFO]: Starting.')
@@ -456,12 +495,35 @@ def getRecipes(user_dict, server_settings):
 
 
 
-  # Retrieve the server document
-  server_doc_ref, server_doc, err = retrieveDocument('server', 'settings')
-  if err:
-    return None, err
-  server_dict = server_doc.to_dict()
+  # Use the caller's copy of the server settings, or the settings service's
+  server_dict = server_settings
+  if server_dict is None:
+    server_dict, err = settings_service.get()
+    if err:
+      return None, err
+
+  user_id = user_dict.get('user_id')
+  cache_key = recommendationKey(user_dict, server_dict, getCatalog().version)
+  recipes = recommendation_cache.get(user_id, cache_key)
+  if recipes is not None:
+    debug(f'[getRecipes - REQU]: Returning cached recipes for {user_id}')
+    return recipes, ''
+
+  recipes, err = selectRecipes(user_dict, server_dict)
+  if not err:
+    recommendation_cache.put(user_id, cache_key, recipes)
+  return recipes, err
 
+################################################################################
+# selectRecipes
+# Picks the recipe selection method from the server settings.
+# - Input:
+#   - (dict) user_dict,
+#   - (dict) server_dict
+# - Output:
+#   - (dict) recipe id -> pre-encoded recipe card (see recipeCardsResponse),
+#   - (string) error
+def selectRecipes(user_dict, server_dict):
   ## Check current hard_code server setting override.
   if len(EXPERIMENTAL_STATE_OVERRIDE):
     if EXPERIMENTAL_STATE_OVERRIDE == 'experimental':
@@ -528,8 +590,8 @@ def updateSingleIngredientRating(user_dict, ingredient_id, ratings, rating_types
     debug(err)
     return None, err
 
-  # Retrieve the ingredients document
-  ingredients_dict = g.i_data[ingredient_id]
+  # Retrieve the ingredient's subcluster and cluster
+  catalog = getCatalog()
   # Update the ingredient rating
   for rating_type in rating_types:
     rating = ratings[rating_type]
@@ -549,7 +611,7 @@ def updateSingleIngredientRating(user_dict, ingredient_id, ratings, rating_types
       user_dict['i_'+rating_type][ingredient_id] = {'rating': rating, 'n_ratings': 1}
 
     # Update the ingredient subcluster rating
-    subcluster_id = str(ingredients_dict["subcluster"])
+    subcluster_id = str(catalog.ingredientSubcluster(ingredient_id))
     if subcluster_id != None:
       try:
         r = user_dict['is_'+rating_type][subcluster_id]['rating']
@@ -561,7 +623,7 @@ def updateSingleIngredientRating(user_dict, ingredient_id, ratings, rating_types
         user_dict['is_'+rating_type][subcluster_id] = {'rating': rating, 'n_ratings': 1}
 
     # Update the ingredient cluster rating
-    cluster_id = str(ingredients_dict["cluster"])
+    cluster_id = str(catalog.ingredientCluster(ingredient_id))
     if cluster_id != None:
       try:
         r = user_dict['ic_'+rating_type][cluster_id]['rating']
@@ -575,6 +637,42 @@ def updateSingleIngredientRating(user_dict, ingredient_id, ratings, rating_types
   # Update the user's document by just returning to the upper level func
   return user_dict, ''
 
+################################################################################
+# ratingSnapshot
+# Takes a shallow copy of the user's rating maps, for ratingDelta to compare
+# against. The updates replace a rating entry rather than changing it, so
+# the copied maps still hold the original entries.
+# - Input:
+#   - (dict) user_dict,
+#   - (array - string) levels, e.g. ['i_', 'is_', 'ic_'],
+#   - (array - string) rating_types
+# - Output:
+#   - (dict) rating map name -> copy of the rating map
+def ratingSnapshot(user_dict, levels, rating_types):
+  return {level+rating_type: dict(user_dict.get(level+rating_type) or {}) for level in levels for rating_type in rating_types}
+
+################################################################################
+# ratingDelta
+# Returns the field path updates that turn the snapshot's ratings into the
+# user_dict's, e.g. {'ic_taste.219': {'rating': 0.5, 'n_ratings': 2}}, so
+# only the rated entries are written. Each entry's rating and n_ratings are
+# written together as absolute values, so they always match each other
+# (concurrent ratings of the same entry are last writer wins, as for the
+# whole document).
+# - Input:
+#   - (dict) snapshot, from ratingSnapshot,
+#   - (dict) user_dict
+# - Output:
+#   - (dict) field path -> value
+def ratingDelta(snapshot, user_dict):
+  delta = {}
+  for field, old_ratings in snapshot.items():
+    for key, entry in (user_dict.get(field) or {}).items():
+      if entry is old_ratings.get(key):
+        continue
+      delta[f'{field}.{key}'] = entry
+  return delta
+
 ################################################################################
 # updateIngredientClusterRatings
 # Updates the user's rating of the given ingredient clusters.
@@ -600,6 +698,7 @@ def updateIngredientClusterRatings(data, rating_types):
   if err:
     return err
   user_dict = doc.to_dict()
+  snapshot = ratingSnapshot(user_dict, ['ic_'], rating_types)
 
   # Update the ic values
   ic_ids = data[rating_types[0]+'_ratings']
@@ -617,8 +716,9 @@ def updateIngredientClusterRatings(data, rating_types):
       except:
         user_dict['ic_'+rating_type][ic_id] = {'rating': rating, 'n_ratings': 1}
 
-  # Update the user document
-  err = updateDocument('users', user_id, user_dict)
+  # Update just the rated clusters in the user document
+  err = updateDocument('users', user_id, ratingDelta(snapshot, user_dict))
+  recommendation_cache.invalidate(user_id)
   if err:
     err = f'[updateIngredientClusterRatings - ERROR]: Unable to update user document with ratings for ingredient clusters rated, err: {err}'
     debug(err)
@@ -654,10 +754,8 @@ def updateSingleRecipeRating(user_dict, recipe_id, ratings, rating_types):
   except:
     pass
 
-  # Retrieve the recipe document
-  try:
-    recipe_dict = g.r_data[recipe_id]
-  except:
+  # Check the recipe exists
+  if not getCatalog().hasRecipe(recipe_id):
     err = f'[updateSingleRecipeRating - ERROR]: recipe {recipe_id} does not seem to exist.'
     debug(err)
     return err
@@ -678,7 +776,7 @@ def updateSingleRecipeRating(user_dict, recipe_id, ratings, rating_types):
       user_dict['r_'+rating_type][recipe_id] = {'rating': rating, 'n_ratings': 1}
 
   # Update the ingredients.
-  ingredient_ids = recipe_dict["ingredient_ids"]
+  ingredient_ids = getCatalog().recipeIngredientIDs(recipe_id)
   for ingredient_id in ingredient_ids:
     if not ingredient_id:
       continue # skip 'None' ingredient id
@@ -717,6 +815,7 @@ def updateRecipeRatings(data, rating_types):
 
   # Retrieve the user document
   user_dict = user_doc.to_dict()
+  snapshot = ratingSnapshot(user_dict, recipe_rating_levels+ingredient_rating_levels, rating_types)
   recipe_ids = data[rating_types[0]+'_ratings']
   err = f'[updateRecipeRatings - INFO]: For user {user_id}, saving  {recipe_ids} ratings.'
   debug(err)
@@ -734,8 +833,9 @@ def updateRecipeRatings(data, rating_types):
       err = f'[updateRecipeRatings - WARN]: Unable to update ratings for recipe {recipe_id}, err: {err}'
       debug(err)
       continue
-  # Update the user document to be the new user dictionary
-  err = updateDocument('users', user_id, user_dict)
+  # Update just the rated recipes and ingredients in the user document
+  err = updateDocument('users', user_id, ratingDelta(snapshot, user_dict))
+  recommendation_cache.invalidate(user_id)
   if err:
     err = f'[updateRecipeRatings - ERROR]: Unable to update user document with ratings for recipes and ingredients, err: {err}'
     debug(err)
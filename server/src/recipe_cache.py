@@ -0,0 +1,97 @@
+################################################################################
+# Q-Chef Server
+# Authors: Q-Chef Backend Programmers
+# Updated: 20261018
+
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+################################################################################
+# Constants
+################################################################################
+RECOMMENDATION_CACHE_SIZE = 1024 # users
+RECOMMENDATION_CACHE_TTL = 15*60 # seconds
+
+# Server settings that change which recipes getRecipes returns.
+recommendation_settings = ['experimentalState',
+                           'returnTaste',
+                           'returnSurprise',
+                           'comboAlgo']
+
+# User document fields that change which recipes getRecipes returns.
+recommendation_user_fields = ['i_taste', 'is_taste', 'ic_taste', 'r_taste',
+                              'i_familiarity', 'is_familiarity', 'ic_familiarity', 'r_familiarity',
+                              'i_surprise', 'is_surprise', 'ic_surprise', 'r_surprise',
+                              'group', 'history']
+
+################################################################################
+# Helper Functions
+################################################################################
+# recommendationKey
+# Returns a hash of everything getRecipes' result depends on.
+# - Input:
+#   - (dict) user_dict,
+#   - (dict) server_dict, the server settings document,
+#   - (string) catalog_version
+# - Output:
+#   - (string) key
+def recommendationKey(user_dict, server_dict, catalog_version):
+  key_data = {'user': {f: user_dict.get(f) for f in recommendation_user_fields},
+              'server': {f: server_dict.get(f) for f in recommendation_settings},
+              'catalog': catalog_version}
+  key_json = json.dumps(key_data, sort_keys=True, default=str)
+  return hashlib.sha1(key_json.encode('utf-8')).hexdigest()
+
+################################################################################
+# RecommendationCache
+################################################################################
+# RecommendationCache
+# Bounded LRU cache of the latest getRecipes result per user. An entry is
+# only returned if it was stored under the same recommendationKey and is
+# younger than the ttl.
+class RecommendationCache:
+  def __init__(self, max_size=RECOMMENDATION_CACHE_SIZE, ttl=RECOMMENDATION_CACHE_TTL):
+    self.max_size = max_size
+    self.ttl = ttl
+    self.hits = 0
+    self.misses = 0
+    self.invalidations = 0
+    self._entries = OrderedDict() # user_id -> (key, expires, recipes)
+    self._lock = threading.Lock()
+
+  def get(self, user_id, key):
+    with self._lock:
+      entry = self._entries.get(user_id)
+      if entry is None or entry[0] != key or entry[1] < time.time():
+        self.misses += 1
+        return None
+      self._entries.move_to_end(user_id)
+      self.hits += 1
+      return entry[2]
+
+  def put(self, user_id, key, recipes):
+    with self._lock:
+      self._entries[user_id] = (key, time.time() + self.ttl, recipes)
+      self._entries.move_to_end(user_id)
+      while len(self._entries) > self.max_size:
+        self._entries.popitem(last=False)
+
+  def invalidate(self, user_id):
+    with self._lock:
+      if self._entries.pop(user_id, None) is not None:
+        self.invalidations += 1
+
+  def stats(self):
+    with self._lock:
+      return {'size': len(self._entries),
+              'max_size': self.max_size,
+              'ttl': self.ttl,
+              'hits': self.hits,
+              'misses': self.misses,
+              'invalidations': self.invalidations}
+
+# Process-wide cache used by ratings.getRecipes
+recommendation_cache = RecommendationCache()
@@ -4,6 +4,7 @@
 # Updated: 20200612
 
 from func import *
+from app import blob_store
 from PIL import Image, ImageOps, ImageDraw
 from io import BytesIO
 import base64
@@ -16,9 +17,100 @@ review_types = ['cook_ratings',
                 'how_response',
                 'why_response',
                 'image']
+# Given for each reviewed recipe (the recipes in cook_ratings)
+recipe_review_types = review_types + ['taste_ratings',
+                                      'familiarity_ratings']
+image_data_urls = {'data:image/jpeg': 'data:image/jpeg;base64,',
+                   'data:image/png': 'data:image/png;base64,'}
 
 ################################################################################
 # Helper Functions
+################################################################################
+# checkRecipeReviews
+# Checks that every part of the review has been given for every recipe,
+# and that its photos can be read, so the review can be saved later (from
+# the write queue) without failing on its data.
+# - Input:
+#   - (dict) data containing user_id, recipe_ids, cook_ratings, why and how responses, and image strings.
+# - Output:
+#   - (string) error
+def checkRecipeReviews(data):
+  for review_type in recipe_review_types:
+    if not (review_type in data.keys()) or not isinstance(data[review_type], dict):
+      err = f'[checkRecipeReviews - ERROR]: review_type {review_type} has not been given.'
+      debug(err)
+      return err
+  for recipe_id in data['cook_ratings'].keys():
+    for review_type in recipe_review_types:
+      if not (recipe_id in data[review_type]):
+        err = f'[checkRecipeReviews - ERROR]: review_type {review_type} has not been given for recipe {recipe_id}.'
+        debug(err)
+        return err
+    image_base64 = reviewImageBase64(data['image'][recipe_id])
+    if image_base64 is None:
+      continue
+    try:
+      Image.open(BytesIO(base64.b64decode(image_base64, validate=True))).verify()
+    except Exception as e:
+      err = f'[checkRecipeReviews - ERROR]: The image for recipe {recipe_id} can not be read, err: {e}'
+      debug(err)
+      return err
+  return ''
+
+################################################################################
+# reviewImageBase64
+# Returns the base64 data of a jpeg/png data url, or None for anything else
+# (no image, or an image that is stored as given).
+def reviewImageBase64(image):
+  if not isinstance(image, str):
+    return None
+  for data_url, prefix in image_data_urls.items():
+    if image.startswith(data_url):
+      return image.replace(prefix, '')
+  return None
+
+################################################################################
+# storeReviewImage
+# Resizes the review's photo and puts it in the blob store, so the review
+# document only holds its key and size. The photo can then be fetched
+# through the review_image endpoint.
+# - Input:
+#   - (string) image, a jpeg/png data url, or None,
+#   - (string) user_id,
+#   - (string) recipe_id
+# - Output:
+#   - (dict) review fields: image_key, image_width and image_height, plus
+#     image for anything that is not a data url (stored as given),
+#   - (string) error
+def storeReviewImage(image, user_id, recipe_id):
+  image_info = {'image': None, 'image_key': None, 'image_width': None, 'image_height': None}
+  if image is None:
+    return image_info, ''
+
+  image_base64 = reviewImageBase64(image)
+  if image_base64 is None:
+    print(f'[storeReviewImage - HELP]: No image format detected for user {user_id} and recipe {recipe_id}.')
+    image_info['image'] = image
+    return image_info, ''
+  print(f'[storeReviewImage - HELP]: Beginning image resize for user {user_id} and recipe {recipe_id}.')
+
+  try:
+    im = Image.open(BytesIO(base64.b64decode(image_base64)))
+    im.thumbnail((1280,1280))
+    if im.mode not in ('RGB', 'L'):
+      im = im.convert('RGB')
+
+    output = BytesIO()
+    im.save(output, format='JPEG')
+    im_data = output.getvalue()
+    image_info['image_key'] = blob_store.put(im_data, 'image/jpeg')
+  except Exception as e:
+    return image_info, f'{e}'
+  image_info['image_width'], image_info['image_height'] = im.size
+
+  print(f'[storeReviewImage - HELP]: Stored {len(im_data)} byte {im.size} image {image_info["image_key"]} for user {user_id} and recipe {recipe_id}')
+  return image_info, ''
+
 ################################################################################
 # updateRecipeReviews
 # Updates the user's review of a recipe
@@ -32,11 +124,9 @@ def updateRecipeReviews(data):
   user_id = data['userID']
   print(f'[updateRecipeReviews - PRINT]: Starting review update for {user_id}')
 
-  for review_type in review_types:
-    if not (review_type in data.keys()):
-      err = f'[updateRecipeReviews - ERROR]: review_type {review_type} has not been given.'
-      debug(err)
-      return err
+  err = checkRecipeReviews(data)
+  if err:
+    return err
 
   # Retrieve the user document
   user_doc_ref, user_doc, err = retrieveDocument('reviews', user_id)
@@ -56,42 +146,13 @@ def updateRecipeReviews(data):
 
   for recipe_id in recipe_ids:
     #try:
-    if data['image'][recipe_id] is not None:
-      # resize image
-      if data['image'][recipe_id].startswith("data:image/jpeg"):
-        print(f'[updateRecipeReviews - HELP]: Beginning image resize for user {user_id} and recipe {recipe_id}. JPEG detected.')
-        image_base64 = data['image'][recipe_id].replace("data:image/jpeg;base64,", "")
-      elif data['image'][recipe_id].startswith("data:image/png"):
-        print(f'[updateRecipeReviews - HELP]: Beginning image resize for user {user_id} and recipe {recipe_id}. PNG detected.')
-        image_base64 = data['image'][recipe_id].replace("data:image/png;base64,", "")
-      else:
-        print(f'[updateRecipeReviews - HELP]: Beginning image resize for user {user_id} and recipe {recipe_id}. No format detected.')
-        image_base64 = ""
-
-      print(f'[updateRecipeReviews - HELP]: image_base64: {image_base64}')
-      if image_base64 != "":
-        print(f'[updateRecipeReviews - HELP]: In image resize for user {user_id} and recipe {recipe_id}.')
-        im = Image.open(BytesIO(base64.b64decode(image_base64)))
-        #image_resized = ImageOps.fit(im, mask.size, centering=(0.5,0.5))
-        im.thumbnail((1280,1280))
-
-        output = BytesIO()
-        #image_resized.save(output, format='JPEG')
-        im.save(output, format='JPEG')
-        im_data = output.getvalue()
-        base64_bytes = base64.b64encode(im_data)
-        base64_message = base64_bytes.decode('ascii')
-        data_url = 'data:image/jpeg;base64,' + base64_message
-      else:
-        data_url = data['image'][recipe_id]
-
-      print(f'[updateRecipeReviews - HELP]: Completed image resize for user {user_id} and recipe {recipe_id}')
-    else:
-      data_url = None
-
-
-    print(f'[updateRecipeReviews - HELP]: data_url: {data_url}')
-    # debug(f"[{data_url} - INFO]: RESIZED IMAGE")
+    # A photo that can not be stored does not stop its review being saved,
+    # the review is saved with image_key None.
+    image_info, err = storeReviewImage(data['image'][recipe_id], user_id, recipe_id)
+    if err:
+      err = f'[updateRecipeReviews - ERROR]: Unable to store the image for recipe {recipe_id}, saving the review without it, err: {err}'
+      debug(err)
+
     recipe_review = {}
     recipe_review['recipe_id'] = recipe_id
     recipe_review['cook_rating'] = data['cook_ratings'][recipe_id]
@@ -99,25 +160,20 @@ def updateRecipeReviews(data):
     recipe_review['taste_ratings'] = data['taste_ratings'][recipe_id]
     recipe_review['how'] = data['how_response'][recipe_id]
     recipe_review['why'] = data['why_response'][recipe_id]
-    recipe_review['image'] = data_url
+    recipe_review.update(image_info)
 
     print(f'[updateRecipeReviews - HELP]: Beginning review update for user {user_id} and recipe {recipe_id}')
 
-    size = str(sys.getsizeof(data_url))
-    print(f'[updateRecipeReviews - HELP]: Final size of image is {size}')
-
     err = createSubDocument('reviews', user_id, recipe_id, 'review', recipe_review)
    
     debug(err)
     if err:
       err = f'[updateRecipeReviews - ERROR]: Unable to update user review document with ratings for recipes, err: {err}'
       debug(err)
+      return err
     # except:
     #   err = f'[updateRecipeReviews - ERROR]: unable to properly save review for recipe {recipe_id}'
     #   debug(err)
-  debug(err)
-  if err:
-    return err
   # Update the user's review document
   # get user review document
   return ''
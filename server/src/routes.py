@@ -6,16 +6,25 @@
 import time
 import json
 import csv
+import copy
 import random
+import functools
+import hmac
 
 import datetime
 
-from app import app, auth_app
+from app import app, auth_app, blob_store, INTERNAL_TOKEN
 from flask import make_response, request, jsonify, render_template, redirect, url_for, send_file, abort
 from flask_cors import CORS, cross_origin
 from firebase_admin import auth
 
+from catalog import getCatalog
 from func import *
+from server_settings import settings_service
+from write_queue import write_queue
+from session_cache import session_cache
+from lifecycle import server_lifecycle
+from group_counters import group_counters
 from actions import *
 from ratings import *
 from reviews import *
@@ -79,95 +88,100 @@ def info():
 def info_survey():
   return send_file('Participant Information Statement - Survey.pdf', attachment_filename='Participant Information Statement - Survey.pdf')
 
+################################################################################
+# internalOnly
+# Decorator for the endpoints that report the server's internals (file
+# paths, model versions, cache and queue state). They are only answered for
+# requests with the QCHEF_INTERNAL_TOKEN, and are not found without it.
+def internalOnly(endpoint):
+  @functools.wraps(endpoint)
+  def wrapper(*args, **kwargs):
+    token = request.headers.get('Authorization', '').replace('Bearer ', '')
+    if not (INTERNAL_TOKEN and hmac.compare_digest(token.encode('utf-8'), INTERNAL_TOKEN.encode('utf-8'))):
+      debug(f'[internalOnly - WARN]: Refused an unauthorised request for {request.path}')
+      abort(404)
+    return endpoint(*args, **kwargs)
+  return wrapper
+
+################################################################################
+# Returns the load time and version of each of the surprise models
+@app.route('/model_info')
+@cross_origin()
+@internalOnly
+def model_info():
+  return jsonify(model_registry.metadata())
+
+################################################################################
+# Returns the hit/miss counters of the recommendation cache
+@app.route('/cache_info')
+@cross_origin()
+@internalOnly
+def cache_info():
+  return jsonify(recommendation_cache.stats())
+
+################################################################################
+# Returns the depth, lag and counters of the write-behind queue
+@app.route('/queue_info')
+@cross_origin()
+@internalOnly
+def queue_info():
+  return jsonify(write_queue.stats())
+
+################################################################################
+# Returns the size, revocation check age and counters of the session cache
+@app.route('/session_info')
+@cross_origin()
+@internalOnly
+def session_info():
+  return jsonify(session_cache.stats())
+
+################################################################################
+# Liveness check, the process is up and serving requests
+@app.route('/healthz')
+def healthz():
+  return jsonify({'status': 'ok'})
+
+################################################################################
+# Readiness check, 200 once the catalog and models are loaded and warm,
+# otherwise 503 so the instance is not sent traffic yet
+@app.route('/readyz')
+def readyz():
+  status = server_lifecycle.status()
+  return jsonify(status), 200 if status['ready'] else 503
+
 ################################################################################
 # Before Request Functions
 ################################################################################
+# Makes sure the process-wide recipe and ingredient catalog is loaded.
+# The catalog is shared between requests, see catalog.getCatalog.
 def before_request_func():
-  def get_i_data():
-    debug(f'[get_i_data - INFO]: Starting.')
-    if 'i_data' not in g:
-      data = {}
-      with open('./data/qchef_ingredients.json', 'r') as f:
-        data = json.load(f)
-      g.i_data = data
-      return g.i_data
-
-  def get_is_data():
-    debug(f'[get_is_data - INFO]: Starting.')
-    if 'is_data' not in g:
-      data = {}
-      with open('./data/qchef_ingredient_subclusters.json', 'r') as f:
-        data = json.load(f)
-      g.is_data = data
-      return g.is_data
-
-  def get_ic_data():
-    debug(f'[get_ic_data - INFO]: Starting.')
-    if 'ic_data' not in g:
-      data = {}
-      with open('./data/qchef_ingredient_clusters.json', 'r') as f:
-        data = json.load(f)
-      g.ic_data = data
-      return g.ic_data
-
-  def get_r_data():
-    debug(f'[get_r_data - INFO]: Starting.')
-    if 'r_data' not in g:
-      data = {}
-      with open('./data/qchef_recipes.json', 'r') as f:
-        data = json.load(f)
-      g.r_data = data
-      return g.r_data
-
-  def get_surp_data():
-    debug(f'[get_surp_data - INFO]: Starting.')
-    if 'surp_data' not in g:
-      data = {}
-      with open('./data/qchef_recipe_surprises.csv', 'r') as f:
-        reader = csv.reader(f)
-        for row in reader:
-          rid = row[0].split("_")[-1]
-          if len(rid)<5:
-            rid = "0"+rid
-          data[rid] = {"surprise_100": float(row[1]), "surprise_95": float(row[2]), "surprise_90": float(row[3]), "surprise_50": float(row[4])}
-      g.surp_data = data
-      return g.surp_data
-
-  def get_nov_data():
-    debug(f'[get_nov_data - INFO]: Starting.')
-    if 'nov_data' not in g:
-      data = {}
-      with open('./data/qchef_recipe_novelties.csv', 'r') as f:
-        reader = csv.reader(f)
-        for row in reader:
-          rid = row[0].split("_")[-1]
-          if len(rid)<5:
-            rid = "0"+rid
-          data[rid] = {"novelty_100": float(row[1]), "novelty_95": float(row[2]), "novelty_90": float(row[3]), "novelty_50": float(row[4])}
-      g.nov_data = data
-      return g.nov_data
-
-  def get_neighbours_data():
-    debug(f'[get_neghbours_data - INFO]: Starting.')
-    if "neighbours" not in g:
-      with open('./data/qchef_ingredient_cluster_neighbours.csv') as test_neighbours_file:
-          neighbours_data = list(csv.DictReader(test_neighbours_file))
-      g.neighbours = neighbours_data
-      debug(f'[get_neghbours_data - INFO]: {g.neighbours}')
-
-  get_i_data()
-  get_is_data()
-  get_ic_data()
-  get_r_data()
-  get_surp_data()
-  get_nov_data()
-  get_neighbours_data()
+  getCatalog()
+
+################################################################################
+# After Request Functions
+################################################################################
+# Writes the document changes made during the request in one batch.
+# Changes made by a request that failed are dropped.
+@app.after_request
+def after_request_func(response):
+  func_name = "after_request_func"
+  if response.status_code >= 500:
+    discardDocumentSession()
+    return response
+  err = commitDocumentSession()
+  if err:
+    err = f"[{func_name} - ERROR]: Unable to save the request's changes, err = {err}"
+    debug(err)
+    return make_response(err, 500)
+  return response
 
 ################################################################################
 # Authentication
 ################################################################################
 # Returns (request_data, user_id, err)
-def authentication(request, server_settings):
+# Session cookies are checked for revocation at most
+# session_cache.revocation_interval seconds ago, or now if check_revoked is set.
+def authentication(request, server_settings, check_revoked=False):
   request_data = json.loads(request.data)
   id_token = ''
   user_id = None
@@ -193,11 +207,11 @@ def authentication(request, server_settings):
     # Allow there to be no manual override of ID
     pass
 
-  return authCookies(request_data)
+  return authCookies(request_data, check_revoked)
 
 ################################################################################
 # Returns (request_data, user_id, err)
-def authCookies(request_data):
+def authCookies(request_data, check_revoked=False):
   session_cookie = ''
   user_id = None
   err = ''
@@ -211,20 +225,161 @@ def authCookies(request_data):
     # else return an error
     return request_data, user_id, err
 
-  # Verify the cookie while checking if the cookie is revoked by
-  # passing check_revoked=True.
-  try:
-    # Validate the cookie
-    decoded_cookie = auth.verify_session_cookie(session_cookie, app=auth_app, check_revoked=True)
-    # Token is valid and not revoked.
-    user_id = decoded_cookie['uid']
-    request_data['userID'] = user_id
-  except Exception as e:
-    err = f'Unable to authenticate the user, err = {e}'
-
-  # else return an error
+  # Verify the cookie, using the cached claims if it was verified and checked
+  # for revocation recently enough.
+  decoded_cookie, err = session_cache.verify(session_cookie, check_revoked)
+  if err:
+    # else return an error
+    return request_data, user_id, err
+
+  # Token is valid and not revoked.
+  user_id = decoded_cookie['uid']
+  request_data['userID'] = user_id
   return request_data, user_id, err
 
+################################################################################
+# Request Pipeline
+################################################################################
+# The inputs an endpoint can ask requestPipeline for, and the inputs each
+# one needs resolved first.
+pipeline_inputs = {'settings': [],
+                   'user': [],
+                   'catalog': [],
+                   'user_doc': ['user', 'settings'],
+                   'history': ['user']}
+
+#-------------------------------------------------------------------------------
+# The inputs resolved by requestPipeline, handed to the endpoint:
+#  - (string) func_name <- the endpoint's name
+#  - (dict) server_settings <- 'settings', shared between requests, so copy it before changing it
+#  - (dict) request_data, (string) user_id <- 'user'
+#  - (LocalDocument) user_doc <- 'user_doc'
+#  - (dict) user_dict <- 'user_doc', a copy of the user's document with their user_id
+#  - (LocalDocument) user_history <- 'history', the user's actions document
+class RequestContext:
+  def __init__(self, func_name):
+    self.func_name = func_name
+    self.server_settings = None
+    self.request_data = None
+    self.user_id = None
+    self.user_doc = None
+    self.user_dict = None
+    self.user_history = None
+
+#-------------------------------------------------------------------------------
+# Returns the inputs and the inputs they need, in the order to resolve them.
+# needs = pipelineNeeds(['user_doc'])
+def pipelineNeeds(inputs):
+  needs = []
+  for name in inputs:
+    if not (name in pipeline_inputs):
+      raise ValueError(f'Unknown request pipeline input {name}, expected one of {list(pipeline_inputs)}.')
+    for need in pipelineNeeds(pipeline_inputs[name]) + [name]:
+      if not (need in needs):
+        needs.append(need)
+  return needs
+
+#-------------------------------------------------------------------------------
+# Returns the (collectionID, documentID) of the documents the inputs read:
+# the server settings if there is no up to date copy in memory, and the
+# user's documents.
+# documents = pipelineDocuments(needs, user_id, server_settings)
+def pipelineDocuments(needs, user_id, server_settings):
+  documents = []
+  if 'settings' in needs and server_settings is None:
+    documents.append((settings_service.collection_id, settings_service.document_id))
+  if user_id is not None and 'user_doc' in needs:
+    documents.append(('users', user_id))
+  if user_id is not None and 'history' in needs:
+    documents.append(('actions', user_id))
+  return documents
+
+#-------------------------------------------------------------------------------
+# Resolves the needed inputs into the request context. The documents still
+# to be read (the user's, and the server settings if the in memory copy is
+# out of date) are read together, in one round trip.
+# err = resolvePipeline(ctx, needs, create_user, check_revoked)
+def resolvePipeline(ctx, needs, create_user=False, check_revoked=False):
+  func_name = ctx.func_name
+  if 'settings' in needs:
+    ctx.server_settings = settings_service.cached()
+
+  if 'user' in needs:
+    ctx.request_data, ctx.user_id, err = authentication(request, ctx.server_settings, check_revoked)
+    debug(f"[{func_name} - DATA]: request_data: {ctx.request_data}")
+    if err:
+      err = f"[{func_name} - ERROR]: Authentication error, err = {err}"
+      debug(err)
+      return err
+
+  if 'catalog' in needs:
+    # Run any functions that need to be done before the rest of the request
+    before_request_func()
+
+  user_id = ctx.user_id
+  documents = pipelineDocuments(needs, user_id, ctx.server_settings)
+  if len(documents) > 1:
+    docs, err = retrieveDocuments(documents)
+    if err:
+      err = f"[{func_name} - ERROR]: Unable to retrieve documents for {user_id}, err = {err}."
+      debug(err)
+      return err
+
+  if 'settings' in needs and ctx.server_settings is None:
+    # Attempt to grab server settings document
+    ctx.server_settings, err = getServerSettings()
+    if err:
+      err = f"[{func_name} - ERROR]: Unable to retrieve settings, err = {err}."
+      debug(err)
+      return err
+
+  if 'user_doc' in needs:
+    # Attempt to grab user's document
+    user_doc_ref, ctx.user_doc, err = getUserDocument(user_id, ctx.server_settings, create_flag=create_user)
+    if err:
+      err = f"[{func_name} - ERROR]: Unable to retrieve document for {user_id}, err = {err}."
+      debug(err)
+      return err
+    ctx.user_dict = ctx.user_doc.to_dict()
+    ctx.user_dict['user_id'] = user_id
+
+  if 'history' in needs:
+    # Attempt to grab user's history
+    user_history_ref, ctx.user_history, err = getUserHistoryDocument(user_id)
+    if err:
+      err = f"[{func_name} - ERROR]: Unable to retrieve user history document for {user_id}, err = {err}."
+      debug(err)
+      return err
+  return ''
+
+#-------------------------------------------------------------------------------
+# Decorates an endpoint with the inputs it needs on POST requests, e.g.
+#   @requestPipeline('user_doc', 'catalog', create_user=True)
+#   def endpoint(ctx):
+# The endpoint is called with a RequestContext, or a 500 error is returned
+# if an input can not be resolved. Inputs:
+#  - 'settings': the server settings,
+#  - 'user': the authenticated user and request data,
+#  - 'catalog': the loaded recipe and ingredient catalog,
+#  - 'user_doc': the user's document, created if create_user is set,
+#  - 'history': the user's actions document.
+# Session cookies are checked for revocation now if check_revoked is set.
+def requestPipeline(*inputs, create_user=False, check_revoked=False):
+  needs = pipelineNeeds(inputs)
+  def decorator(endpoint):
+    @functools.wraps(endpoint)
+    def wrapper(*args, **kwargs):
+      ctx = RequestContext(endpoint.__name__)
+      if request.method == 'POST':
+        err = resolvePipeline(ctx, needs, create_user, check_revoked)
+        if err:
+          return err, 500
+      return endpoint(ctx, *args, **kwargs)
+    # Lets asgi.py read the endpoint's documents before calling it
+    wrapper.pipeline_needs = needs
+    return wrapper
+  return decorator
+
 ################################################################################
 # Session URLs
 ################################################################################
@@ -259,23 +414,10 @@ def session_login():
 #   - (string) error
 @app.route('/extend_session', methods=['POST'])
 @cross_origin()
-def extend_session():
+@requestPipeline('user', check_revoked=True)
+def extend_session(ctx):
   debug(f'[extend_session - INFO]: Starting.')
-  func_name = 'extend_session'
-  # Attempt to grab server settings document
-  server_settings, err = getServerSettings()
-  if err:
-    err = f"[{func_name} - ERROR]: Unable to retrieve settings, err = {err}."
-  
-    return err, 500
-
-  request_data, user_id, err = authentication(request, server_settings)
-  debug(f"[{func_name} - DATA]: request_data: {request_data}")
-  if err:
-    err = f"[{func_name} - ERROR]: Authentication error, err = {err}"
-  
-    return err, 500
-
+  user_id = ctx.user_id
   custom_token = auth.create_custom_token(user_id)
  
   response = jsonify({'status': 'success', 'customtoken': custom_token.decode("utf-8") })
@@ -285,16 +427,17 @@ def extend_session():
 ################################################################################
 # Server API Helper Functions
 ################################################################################
-# Obtains the server settings document from the database.
+# Obtains the server settings document, kept in memory by the settings service.
+# The returned dict is shared between requests, so copy it before changing it.
 # server_settings, err = getServerSettings()
 def getServerSettings():
   func_name = "getServerSettings"
-  doc_ref, doc, err = retrieveDocument('server', 'settings')
+  server_settings, err = settings_service.get()
   if err:
     err = f"[{func_name} - ERROR]: Unable to retrieve server settings, err = {err}"
     debug(err)
     return None, err
-  return doc.to_dict(), err
+  return server_settings, err
 
 #-------------------------------------------------------------------------------
 # Obtains the user's document.
@@ -329,12 +472,19 @@ def getUserHistoryDocument(user_id):
   return user_doc_ref, user_doc, err
 
 
+#-------------------------------------------------------------------------------
+# Creates the user's documents and counts them in their group, in one batch.
+# The group is counted in a sharded counter (see group_counters.py), so
+# server/settings is not written.
+# Returns the in memory starting document rather than reading it back.
+# user_doc_ref, user_doc, err = createUserProfile(user_id, server_settings)
 def createUserProfile(user_id, server_settings):
-  # else create_flag: # Create the new documents
-    # known only 2 groups
-  debug(f'begin create user profile')
-  num_group_0 = server_settings['groupNum']['0']
-  num_group_1 = server_settings['groupNum']['1']
+  func_name = "createUserProfile"
+  # known only 2 groups
+  debug(f'[{func_name} - INFO]: Starting.')
+  group_counts = group_counters.counts(server_settings)
+  num_group_0 = group_counts.get('0', 0)
+  num_group_1 = group_counts.get('1', 0)
   if num_group_0 == num_group_1:
     int_user_group = random.choice(user_groups)
   else:
@@ -342,37 +492,48 @@ def createUserProfile(user_id, server_settings):
       int_user_group = 1
     else:
       int_user_group = 0
-  userStartingDoc['group'] = int_user_group
-  
-  err = createDocument('users', user_id, userStartingDoc)
+  user_starting_doc = copy.deepcopy(userStartingDoc)
+  user_starting_doc['group'] = int_user_group
 
+  creations = [('users', user_id, user_starting_doc),
+               ('actions', user_id, {}),
+               ('reviews', user_id, {})]
+  doc_refs, err = createDocuments(creations)
   if err:
-    err = f"[{func_name} - ERROR]: Unable to create user document for {user_id}, err = {err}"
+    err = f"[{func_name} - ERROR]: Unable to create documents for {user_id}, err = {err}"
     debug(err)
     return None, None, err
-    # user document creation successful, update server settings
-  server_settings['groupNum'][str(int_user_group)] += 1
-  err = updateDocument('server', 'settings', server_settings)
+  err = group_counters.increment(int_user_group)
   if err:
-    err = f"[{func_name} - ERROR]: Unable to server settings document, err = {err}"
+    err = f"[{func_name} - ERROR]: Unable to count {user_id} in group {int_user_group}, err = {err}"
     debug(err)
     return None, None, err
 
-  err = createDocument('actions', user_id, {})
-  if err:
-    err = f"[{func_name} - ERROR]: Unable to create action document for {user_id}, err = {err}"
-    debug(err)
-    return None, None, err
-  err = createDocument('reviews', user_id, {})
+  user_doc_ref = doc_refs[('users', str(user_id))]
+  return user_doc_ref, LocalDocument(user_doc_ref, user_starting_doc), ''
+
+
+#-------------------------------------------------------------------------------
+# Saves the user's picked recipes as their latest meal plan, in the
+# request's document session (so retrieve_meal_plan sees it as soon as
+# save_meal_plan has returned).
+# err = saveMealPlan(user_id, user_dict, request_data)
+def saveMealPlan(user_id, user_dict, request_data):
+  func_name = "saveMealPlan"
+  if 'pickedRecipes' in user_dict:
+    pickedRecipes = copy.deepcopy(user_dict['pickedRecipes'])
+  else:
+    pickedRecipes = {'latest':-1}
+  pickedRecipes['latest'] += 1
+  pickedRecipes[str(pickedRecipes['latest'])] = request_data['picked']
+  updateData = {'pickedRecipes': pickedRecipes}
+  err = updateDocument('users', user_id, updateData)
   if err:
-    err = f"[{func_name} - ERROR]: Unable to create review document for {user_id}, err = {err}"
+    err = f"[{func_name} - ERROR]: Unable to update the data {updateData} for user {user_id}, err = {err}"
     debug(err)
-    return None, None, err
+    return err
+  return ''
 
-  user_doc_ref, user_doc, err = getUserDocument(user_id, server_settings)
-  
-  return user_doc_ref, user_doc, err  
- 
 
 ################################################################################
 # Server API URLs
@@ -393,36 +554,15 @@ def createUserProfile(user_id, server_settings):
 #   - (string) error
 @app.route('/onboarding_ingredient_rating', methods=['GET', 'POST'])
 @cross_origin()
-def onboarding_ingredient_rating():
+@requestPipeline('settings', 'user_doc', 'catalog', create_user=True)
+def onboarding_ingredient_rating(ctx):
   func_name = "onboarding_ingredient_rating"
   debug(f"[{func_name} - INFO]: Starting.")
   if request.method == 'POST':
     debug(f"[{func_name} - INFO]: POST request")
 
-    # Attempt to grab server settings document
-    server_settings, err = getServerSettings()
-    if err:
-      err = f"[{func_name} - ERROR]: Unable to retrieve settings, err = {err}."
-      debug(err)
-      return err, 500
-
-    request_data, user_id, err = authentication(request, server_settings)
-    debug(f"[{func_name} - DATA]: request_data: {request_data}")
-    if err:
-      err = f"[{func_name} - ERROR]: Authentication error, err = {err}"
-      debug(err)
-      return err, 500
-    # Run any functions that need to be done before the rest of the request
-    before_request_func()
-
-    # Attempt to grab user's document
-    user_doc_ref, user_doc, err = getUserDocument(user_id, server_settings, create_flag=True)
-    if err:
-      err = f"[{func_name} - ERROR]: Unable to retrieve document for {user_id}, err = {err}."
-      debug(err)
-      return err, 500
-    user_dict = user_doc.to_dict()
-    user_dict['user_id'] = user_id
+    request_data, user_id = ctx.request_data, ctx.user_id
+    server_settings, user_dict = ctx.server_settings, ctx.user_dict
 
     # Update user's document with ingredient ratings
     rating_types = ['taste', 'familiarity']
@@ -438,7 +578,7 @@ def onboarding_ingredient_rating():
       err = f"[{func_name} - ERROR]: Unable to find any recipes for user {user_id}, err = {err}"
       debug(err)
       return err, 500
-    return jsonify(onboarding_recipes2)
+    return recipeCardsResponse(onboarding_recipes2)
 
   debug(f"[{func_name} - INFO]: GET request")
   # Attempt to grab onboarding recipes list.
@@ -477,34 +617,14 @@ def onboarding_ingredient_rating():
 #   - (string) error
 @app.route('/onboarding_recipe_rating', methods=['GET', 'POST'])
 @cross_origin()
-def onboarding_recipe_rating():
+@requestPipeline('user_doc', 'catalog', create_user=True)
+def onboarding_recipe_rating(ctx):
   func_name = "onboarding_recipe_rating"
   debug(f"[{func_name} - INFO]: Starting.")
   if request.method == 'POST':
     debug(f"[{func_name} - INFO]: POST request")
 
-    # Attempt to grab server settings document
-    server_settings, err = getServerSettings()
-    if err:
-      err = f"[{func_name} - ERROR]: Unable to retrieve settings, err = {err}."
-      debug(err)
-      return err, 500
-
-    request_data, user_id, err = authentication(request, server_settings)
-    debug(f"[{func_name} - DATA]: request_data: {request_data}")
-    if err:
-      err = f"[{func_name} - ERROR]: Authentication error, err = {err}"
-      debug(err)
-      return err, 500
-    # Run any functions that need to be done before the rest of the request
-    before_request_func()
- 
-    # Attempt to grab user's document
-    user_doc_ref, user_doc, err = getUserDocument(user_id, server_settings, create_flag=True)
-    if err:
-      err = f"[{func_name} - ERROR]: Unable to retrieve document for {user_id}, err = {err}."
-      debug(err)
-      return err, 500
+    request_data = ctx.request_data
 
     # Update user's document with recipe ratings
     rating_types = ['taste', 'familiarity', 'surprise']
@@ -537,27 +657,14 @@ def onboarding_recipe_rating():
 #   - (string) error
 @app.route('/validation_recipe_rating', methods=['POST'])
 @cross_origin()
-def validation_recipe_rating():
+@requestPipeline('user', 'catalog')
+def validation_recipe_rating(ctx):
   func_name = "validation_recipe_rating"
   debug(f"[{func_name} - INFO]: Starting.")
   if request.method == 'POST':
     debug(f"[{func_name} - INFO]: POST request")
 
-    # Attempt to grab server settings document
-    server_settings, err = getServerSettings()
-    if err:
-      err = f"[{func_name} - ERROR]: Unable to retrieve settings, err = {err}."
-      debug(err)
-      return err, 500
-
-    request_data, user_id, err = authentication(request, server_settings)
-    debug(f"[{func_name} - DATA]: request_data: {request_data}")
-    if err:
-      err = f"[{func_name} - ERROR]: Authentication error, err = {err}"
-      debug(err)
-      return err, 500
-    # Run any functions that need to be done before the rest of the request
-    before_request_func()
+    request_data = ctx.request_data
 
     # Update user's document with recipe ratings
     rating_types = ['taste', 'familiarity', 'surprise']
@@ -580,48 +687,15 @@ def validation_recipe_rating():
 #   - (json)
 @app.route('/get_meal_plan_selection', methods=['POST'])
 @cross_origin()
-def get_meal_plan_selection():
+@requestPipeline('settings', 'user_doc', 'history', 'catalog')
+def get_meal_plan_selection(ctx):
   func_name = "get_meal_plan_selection"
   debug(f"[{func_name} - ALWAYS]: Starting.")
   if request.method == 'POST':
     debug(f"[{func_name} - ALWAYS]: POST request")
-
-    # Attempt to grab server settings document
-    server_settings, err = getServerSettings()
-    if err:
-      err = f"[{func_name} - ERROR]: Unable to retrieve settings, err = {err}."
-      debug(err)
-      return err, 500
-
-    request_data, user_id, err = authentication(request, server_settings)
-    debug(f"[{func_name} - ALWAYS]: Auth request_data: {request_data}")
-    if err:
-      err = f"[{func_name} - ERROR]: Authentication error, err = {err}"
-      debug(err)
-      return err, 500
-    # Run any functions that need to be done before the rest of the request
-    before_request_func()
-
-    # Attempt to grab user's document
-    user_doc_ref, user_doc, err = getUserDocument(user_id, server_settings)
-    if err:
-      err = f"[{func_name} - ERROR]: Unable to retrieve document for {user_id}, err = {err}."
-      debug(err)
-      return err, 500
-    user_dict = user_doc.to_dict()
-    user_dict['user_id'] = user_id
-    debug(f"[{func_name} - ALWAYS]: User_dict pre history: {user_dict}")
-
-    # Attempt to grab user's history
-    user_history_ref, user_history, err = getUserHistoryDocument(user_id)
-    if err and user_doc is not None:
-      err = f"[{func_name} - ERROR]: Unable to retrieve user history document for {user_id}, err = {err}."
-      debug(err)
-      return err, 500
-    elif err and user_doc is None:
-      user_dict["history"] = {}
-    else:
-      user_dict["history"] = user_history.to_dict()
+    server_settings, user_id = ctx.server_settings, ctx.user_id
+    user_dict = ctx.user_dict
+    user_dict["history"] = ctx.user_history.to_dict()
     debug(f"[{func_name} - ALWAYS]: User_dict post history: {user_dict}")
 
     #num_wanted_recipes = request_data['number_of_recipes']
@@ -635,67 +709,53 @@ def get_meal_plan_selection():
       err = f"[{func_name} - ERROR]: Unable to find any recipes for user {user_id}, err = {err}"
       debug(err)
       return err, 500
-    debug(f"[{func_name} - ALWAYS]: ret_recipes: {ret_recipes}")
-    return jsonify(ret_recipes)
+    debug(f"[{func_name} - ALWAYS]: ret_recipes: {list(ret_recipes.keys())}")
+    return recipeCardsResponse(ret_recipes)
 
 ################################################################################
 # save_meal_plan [POST]
 # POST: End point is for saving the user's chosen recipes.
-# Note: This function is fairly involved and may take some time 
-# (so there is a wait screen in the app).
+# Note: The recipes and action log are saved by the write queue,
+# so this returns as soon as they have been queued.
 # - Input:
 #   - (json) {"userID": <user_id>, "picked": [<recipe_id>, …, <recipe_id>], "action_log": [(<timestamp_epoch_milliseconds>, <recipe_id>, <action>), … ]}
 # - Output:
 #   - (string) error
 @app.route('/save_meal_plan', methods=['POST'])
 @cross_origin()
-def save_meal_plan():
+@requestPipeline('user_doc', 'catalog')
+def save_meal_plan(ctx):
   func_name = "save_meal_plan"
   debug(f"[{func_name} - INFO]: Starting.")
   if request.method == 'POST':
     debug(f"[{func_name} - INFO]: POST request")
 
-    # Attempt to grab server settings document
-    server_settings, err = getServerSettings()
-    if err:
-      err = f"[{func_name} - ERROR]: Unable to retrieve settings, err = {err}."
-      debug(err)
-      return err, 500
+    request_data, user_id = ctx.request_data, ctx.user_id
 
-    request_data, user_id, err = authentication(request, server_settings)
-    debug(f"[{func_name} - DATA]: request_data: {request_data}")
+    for key in ['picked', 'action_log']:
+      if not (key in request_data):
+        err = f"[{func_name} - ERROR]: No {key} given for user {user_id}."
+        debug(err)
+        return err, 500
+    err = checkActionLog(request_data['action_log'])
     if err:
-      err = f"[{func_name} - ERROR]: Authentication error, err = {err}"
+      err = f"[{func_name} - ERROR]: Invalid action log for user {user_id}, err = {err}"
       debug(err)
-      return err, 500
-    # Run any functions that need to be done before the rest of the request
-    before_request_func()
+      return err, 400
 
-    # Attempt to grab user's document
-    user_doc_ref, user_doc, err = getUserDocument(user_id, server_settings)
+    # The meal plan is saved with the request, as the client reads it back next
+    err = saveMealPlan(user_id, ctx.user_dict, request_data)
     if err:
-      err = f"[{func_name} - ERROR]: Unable to retrieve document for {user_id}, err = {err}."
+      err = f"[{func_name} - ERROR]: Unable to save the meal plan for user {user_id}, err = {err}"
       debug(err)
       return err, 500
-    user_dict = user_doc.to_dict()
-    user_dict['user_id'] = user_id
 
-    if 'pickedRecipes' in user_dict:
-      pickedRecipes = user_dict['pickedRecipes']
-    else:
-      pickedRecipes = {'latest':-1}
-    pickedRecipes['latest'] += 1
-    pickedRecipes[str(pickedRecipes['latest'])] = request_data['picked']
-    updateData = {'pickedRecipes': pickedRecipes}
-    err = updateDocument('users', user_id, updateData)
+    # The client does not need to wait for the action log to be saved
+    err = write_queue.enqueue(user_id, 'updateActionLog', updateActionLog, request_data)
     if err:
-      err = f"[{func_name} - ERROR]: Unable to update the data {updateData} for user {user_id}, err = {err}"
-      debug(err)
-      return err, 500
-
-    err = updateActionLog(request_data)
+      err = updateActionLog(request_data)
     if err:
-      err = f"[{func_name} - ERROR]: Unable to update recipe(s) action log, err = {err}"
+      err = f"[{func_name} - ERROR]: Unable to update recipe(s) action log for user {user_id}, err = {err}"
       debug(err)
       return err, 500
     return ''
@@ -709,36 +769,14 @@ def save_meal_plan():
 #   - (json)
 @app.route('/retrieve_meal_plan', methods=['POST'])
 @cross_origin()
-def retrieve_meal_plan():
+@requestPipeline('user_doc', 'catalog', create_user=True)
+def retrieve_meal_plan(ctx):
   func_name = "retrieve_meal_plan"
   debug(f"[{func_name} - INFO]: Starting.")
   if request.method == 'POST':
     debug(f"[{func_name} - INFO]: POST request")
 
-    # Attempt to grab server settings document
-    server_settings, err = getServerSettings()
-    if err:
-      err = f"[{func_name} - ERROR]: Unable to retrieve settings, err = {err}."
-      debug(err)
-      return err, 500
-
-    request_data, user_id, err = authentication(request, server_settings)
-    debug(f"[{func_name} - DATA]: request_data: {request_data}")
-    if err:
-      err = f"[{func_name} - ERROR]: Authentication error, err = {err}"
-      debug(err)
-      return err, 500
-    # Run any functions that need to be done before the rest of the request
-    before_request_func()
-
-    # Attempt to grab user's document
-    user_doc_ref, user_doc, err = getUserDocument(user_id, server_settings, create_flag=True)
-    if err:
-      err = f"[{func_name} - ERROR]: Unable to retrieve document for {user_id}, err = {err}."
-      debug(err)
-      return err, 500
-    user_dict = user_doc.to_dict()
-    user_dict['user_id'] = user_id
+    user_id, user_dict = ctx.user_id, ctx.user_dict
 
     if not len(user_dict["ic_surprise"]):
       err = f"[{func_name} - ERROR]: {user_id} onboarding incomplete."
@@ -756,14 +794,14 @@ def retrieve_meal_plan():
     recipe_ids = pickedRecipes[str(pickedRecipes['latest'])]
     for recipe_id in recipe_ids:
       # Get the recipe information
-      recipeInfo, err = getRecipeInformation(recipe_id)
+      recipeCard, err = getRecipeCard(recipe_id)
       if err:
         err = f"[{func_name} - ERROR]: Unable to get recipe {recipe_id} information, err = {err}"
         debug(err)
         continue
-      recipe_info[recipe_id] = recipeInfo
+      recipe_info[recipe_id] = recipeCard
 
-    return jsonify(recipe_info)
+    return recipeCardsResponse(recipe_info)
 
 ################################################################################
 # review_recipe [POST]
@@ -774,27 +812,21 @@ def retrieve_meal_plan():
 #   - (json)
 @app.route('/review_recipe', methods=['POST'])
 @cross_origin()
-def review_recipe():
+@requestPipeline('user', 'catalog')
+def review_recipe(ctx):
   func_name = "review_recipe"
   debug(f"[{func_name} - INFO]: Starting.")
   if request.method == 'POST':
     debug(f"[{func_name} - INFO]: POST request")
 
-    # Attempt to grab server settings document
-    server_settings, err = getServerSettings()
-    if err:
-      err = f"[{func_name} - ERROR]: Unable to retrieve settings, err = {err}."
-      debug(err)
-      return err, 500
+    request_data, user_id = ctx.request_data, ctx.user_id
 
-    request_data, user_id, err = authentication(request, server_settings)
-    debug(f"[{func_name} - DATA]: request_data: {request_data}")
+    # The review is saved after the response, so it is checked now
+    err = checkRecipeReviews(request_data)
     if err:
-      err = f"[{func_name} - ERROR]: Authentication error, err = {err}"
+      err = f"[{func_name} - ERROR]: Invalid recipe(s) review, err = {err}"
       debug(err)
-      return err, 500
-    # Run any functions that need to be done before the rest of the request
-    before_request_func()
+      return err, 400
 
     # Update user's document with recipe ratings
     rating_types = ['taste', 'familiarity']
@@ -804,13 +836,47 @@ def review_recipe():
       debug(err)
       return err, 500
 
-    err = updateRecipeReviews(request_data)
+    # The client does not need to wait for the reviews (and their images) to be saved
+    err = write_queue.enqueue(user_id, 'updateRecipeReviews', updateRecipeReviews, request_data)
+    if err:
+      err = updateRecipeReviews(request_data)
     if err:
       err = f"[{func_name} - ERROR]: Unable to update recipe(s) review, err = {err}"
       debug(err)
       return err, 500
     return ""
 
+################################################################################
+# review_image [GET]
+# GET: End point returns a review's photo, using the image_key saved in the
+# review. Keys are the photo's sha256, so the response never changes, but
+# the photos are the users' own, so it needs a session cookie (as the
+# Authorization header) like the other endpoints, and is only cached by
+# the browser.
+# - Input:
+#   - (string) image_key
+# - Output:
+#   - (image/jpeg)
+@app.route('/review_image/<image_key>', methods=['GET'])
+@cross_origin()
+def review_image(image_key):
+  func_name = "review_image"
+  debug(f"[{func_name} - INFO]: Starting.")
+  request_data, user_id, err = authCookies({})
+  if err:
+    err = f"[{func_name} - ERROR]: Unable to authenticate the user, err = {err}"
+    debug(err)
+    return err, 401
+  image_data, content_type = blob_store.get(image_key)
+  if image_data is None:
+    err = f"[{func_name} - ERROR]: No image {image_key}."
+    debug(err)
+    return err, 404
+  response = make_response(image_data)
+  response.headers['Content-Type'] = content_type
+  response.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+  return response
+
 ################################################################################
 # lookup_user_predicted [POST]
 # POST: End point returns the predicted ratings that the user has.
@@ -820,35 +886,14 @@ def review_recipe():
 #   - (json)
 @app.route('/lookup_user_predicted', methods=['POST'])
 @cross_origin()
-def lookup_user_predicted():
+@requestPipeline('user_doc', 'catalog')
+def lookup_user_predicted(ctx):
   func_name = "lookup_user_predicted"
   debug(f"[{func_name} - INFO]: Starting.")
   if request.method == 'POST':
     debug(f"[{func_name} - INFO]: POST request")
 
-    # Attempt to grab server settings document
-    server_settings, err = getServerSettings()
-    if err:
-      err = f"[{func_name} - ERROR]: Unable to retrieve settings, err = {err}."
-      debug(err)
-      return err, 500
-
-    request_data, user_id, err = authentication(request, server_settings)
-    debug(f"[{func_name} - DATA]: request_data: {request_data}")
-    if err:
-      err = f"[{func_name} - ERROR]: Authentication error, err = {err}"
-      debug(err)
-      return err, 500
-    # Run any functions that need to be done before the rest of the request
-    before_request_func()
-
-    # Attempt to grab user's document
-    user_doc_ref, user_doc, err = getUserDocument(user_id, server_settings)
-    if err:
-      err = f"[{func_name} - ERROR]: Unable to retrieve document for {user_id}, err = {err}."
-      debug(err)
-      return err, 500
-    user_dict = user_doc.to_dict()
+    request_data, user_dict = ctx.request_data, ctx.user_dict
 
     user_ratings = {}
 
@@ -870,7 +915,7 @@ def lookup_user_predicted():
 
       # Find the ingredients and the user's ratings of them
       user_ingredient_ratings = {}
-      i_ids = g.r_data[r_id]["ingredient_ids"]
+      i_ids = getCatalog().recipeIngredientIDs(r_id)
       for i_id in i_ids:
         # Change into a string (just in case)
         i_id = str(i_id)
@@ -896,35 +941,14 @@ def lookup_user_predicted():
 #   - (json)
 @app.route('/lookup_user_saved', methods=['POST'])
 @cross_origin()
-def lookup_user_saved():
+@requestPipeline('user_doc', 'catalog')
+def lookup_user_saved(ctx):
   func_name = "lookup_user_saved"
   debug(f"[{func_name} - INFO]: Starting.")
   if request.method == 'POST':
     debug(f"[{func_name} - INFO]: POST request")
 
-    # Attempt to grab server settings document
-    server_settings, err = getServerSettings()
-    if err:
-      err = f"[{func_name} - ERROR]: Unable to retrieve settings, err = {err}."
-      debug(err)
-      return err, 500
-
-    request_data, user_id, err = authentication(request, server_settings)
-    debug(f"[{func_name} - DATA]: request_data: {request_data}")
-    if err:
-      err = f"[{func_name} - ERROR]: Authentication error, err = {err}"
-      debug(err)
-      return err, 500
-    # Run any functions that need to be done before the rest of the request
-    before_request_func()
-
-    # Attempt to grab user's document
-    user_doc_ref, user_doc, err = getUserDocument(user_id, server_settings)
-    if err:
-      err = f"[{func_name} - ERROR]: Unable to retrieve document for {user_id}, err = {err}."
-      debug(err)
-      return err, 500
-    user_dict = user_doc.to_dict()
+    user_dict = ctx.user_doc.to_dict()
 
     return jsonify(user_dict)
 
@@ -0,0 +1,116 @@
+################################################################################
+# Q-Chef Server
+# Authors: Q-Chef Backend Programmers
+# Updated: 20261018
+
+# Vectorised recipe scoring. A user's rating of every ingredient is
+# resolved once into a dense vector (ingredient -> subcluster -> cluster ->
+# neighbour estimate, as in ratings.getIngredientRating), then the whole
+# catalog is scored with a sparse mat-vec against the catalog's
+# recipe x ingredient matrix.
+
+import numpy as np
+
+from catalog import getCatalog, NO_ID
+
+################################################################################
+# Constants
+################################################################################
+# The ratings engine isn't realising that some people hate individual
+# ingredients a lot. This weight adjusts for that by emphasising negative ratings.
+NEGATIVE_RATING_WEIGHT = 1.5
+
+################################################################################
+# Helper Functions
+################################################################################
+# levelRatings
+# Pulls the 'rating' out of one of the user's rating maps,
+# e.g. user_dict['ic_taste'], skipping any malformed entries.
+# - Input:
+#   - (dict) ratings_map, id -> {'rating', 'n_ratings'}
+# - Output:
+#   - (dict) id -> rating
+def levelRatings(ratings_map):
+  level = {}
+  if not ratings_map:
+    return level
+  for key, entry in ratings_map.items():
+    try:
+      level[key] = float(entry['rating'])
+    except:
+      continue
+  return level
+
+#-------------------------------------------------------------------------------
+# ratingsForIDs
+# Looks up the rating of each raw id (a NO_ID id is looked up as 'None',
+# as str(None) is what the rating updates save it under).
+# - Input:
+#   - (np.array) raw_ids,
+#   - (dict) id -> rating
+# - Output:
+#   - (np.array) ratings, NaN where there is no rating
+def ratingsForIDs(raw_ids, level):
+  if not level:
+    return np.full(len(raw_ids), np.nan, dtype=np.float64)
+  unique_ids, inverse = np.unique(raw_ids, return_inverse=True)
+  unique_ratings = np.array([level.get(str(None) if u == NO_ID else str(u), np.nan) for u in unique_ids.tolist()], dtype=np.float64)
+  return unique_ratings[inverse]
+
+################################################################################
+# ingredientRatingVector
+# Resolves the user's rating of every catalog ingredient, trying the
+# ingredient, then its subcluster, then its cluster and finally (if given)
+# the neighbour estimator on the cluster.
+# - Input:
+#   - (dict) user_dict,
+#   - (string) rating_type,
+#   - (function) neighbour_estimator(ic_id, ic_ratings) or None
+# - Output:
+#   - (np.array) rating per ingredient row, NaN where there is no rating
+def ingredientRatingVector(user_dict, rating_type, neighbour_estimator=None):
+  columns = getCatalog().columns
+
+  ratings = ratingsForIDs(columns['i_cluster'], levelRatings(user_dict.get('ic_'+rating_type)))
+  subcluster_ratings = ratingsForIDs(columns['i_subcluster'], levelRatings(user_dict.get('is_'+rating_type)))
+  ratings = np.where(np.isnan(subcluster_ratings), ratings, subcluster_ratings)
+  ingredient_ratings = ratingsForIDs(columns['i_ids'], levelRatings(user_dict.get('i_'+rating_type)))
+  ratings = np.where(np.isnan(ingredient_ratings), ratings, ingredient_ratings)
+
+  missing = np.isnan(ratings)
+  if neighbour_estimator is None or not missing.any() or not ('ic_'+rating_type in user_dict):
+    return ratings
+
+  # Estimate once per cluster rather than once per ingredient.
+  ic_ratings = user_dict['ic_'+rating_type]
+  unique_ids, inverse = np.unique(columns['i_cluster'][missing], return_inverse=True)
+  estimates = []
+  for ic_id in unique_ids.tolist():
+    try:
+      estimates.append(neighbour_estimator(str(None) if ic_id == NO_ID else str(ic_id), ic_ratings))
+    except:
+      estimates.append(np.nan)
+  ratings[missing] = np.array(estimates, dtype=np.float64)[inverse]
+  return ratings
+
+################################################################################
+# scoreRecipes
+# Averages the ingredient ratings of every recipe in the catalog, skipping
+# unrated ingredients and emphasising negative ratings.
+# - Input:
+#   - (np.array) ingredient_ratings, from ingredientRatingVector
+# - Output:
+#   - (np.array) score per recipe row (aligned with catalog.recipeIDs()), NaN where no ingredient is rated,
+#   - (np.array) number of rated ingredients per recipe row
+def scoreRecipes(ingredient_ratings):
+  recipe_ingredients = getCatalog().recipe_ingredients
+
+  rated = ~np.isnan(ingredient_ratings)
+  weighted = np.where(rated, ingredient_ratings, 0.)
+  weighted = np.where(weighted < 0, weighted*NEGATIVE_RATING_WEIGHT, weighted)
+
+  sums = recipe_ingredients @ weighted
+  counts = recipe_ingredients @ rated.astype(np.float64)
+  scores = np.full(len(sums), np.nan, dtype=np.float64)
+  np.divide(sums, counts, out=scores, where=counts > 0)
+  return scores, counts
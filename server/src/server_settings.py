@@ -0,0 +1,131 @@
+################################################################################
+# Q-Chef Server
+# Authors: Q-Chef Backend Programmers
+# Updated: 20261018
+
+import threading
+import time
+
+from app import storage
+from func import debug, retrieveDocument
+
+################################################################################
+# Constants
+################################################################################
+# How long (in seconds) a polled copy of the settings is used for when the
+# snapshot listener is not available.
+SETTINGS_POLL_TTL = 10
+# How old (in seconds) the settings can get even while listening, as a
+# snapshot listener can stop without the service hearing about it.
+SETTINGS_MAX_AGE = 300
+# How long (in seconds) after a listener stops before listening again.
+SETTINGS_WATCH_RETRY = 60
+
+################################################################################
+# SettingsService
+################################################################################
+# SettingsService
+# Keeps the server/settings document in memory. It is kept up to date by
+# watching the document in the storage backend, or re-read at most every
+# SETTINGS_POLL_TTL seconds if the backend can not watch it or the watch
+# has stopped (Firestore stops it for good on errors it can not recover
+# from). Even while listening, the settings are re-read once they are
+# SETTINGS_MAX_AGE seconds old.
+# The dict returned by get() is shared, so callers must copy it before
+# making any changes.
+class SettingsService:
+  def __init__(self, collection_id='server', document_id='settings', ttl=SETTINGS_POLL_TTL):
+    self.collection_id = collection_id
+    self.document_id = document_id
+    self.ttl = ttl
+    self.listening = False
+    self._started = False
+    self._settings = None
+    self._expires = 0
+    self._updated = 0
+    self._restart_at = 0
+    self._watch = None
+    self._lock = threading.Lock()
+
+  #-----------------------------------------------------------------------------
+  # Starts the snapshot listener, falling back to polling if it fails.
+  def start(self):
+    with self._lock:
+      if self._started:
+        return
+      self._started = True
+      try:
+        self._watch = storage.watchDocument((self.collection_id, self.document_id), self._onChange)
+        self.listening = True
+      except Exception as e:
+        debug(f'[SettingsService - WARN]: Unable to listen to {self.collection_id}/{self.document_id}, polling instead, err = {e}')
+
+  def _onChange(self, settings):
+    if settings is not None:
+      self.set(settings)
+
+  #-----------------------------------------------------------------------------
+  # Checks the snapshot listener is still running. If it has stopped, the
+  # settings are polled until it is started again SETTINGS_WATCH_RETRY
+  # seconds later.
+  def _checkWatch(self):
+    if self.listening and not storage.isWatchActive(self._watch):
+      with self._lock:
+        if not self.listening:
+          return
+        debug(f'[SettingsService - WARN]: Stopped listening to {self.collection_id}/{self.document_id}, polling instead.')
+        self.listening = False
+        self._watch = None
+        self._restart_at = time.time() + SETTINGS_WATCH_RETRY
+    elif not self.listening and self._restart_at and time.time() >= self._restart_at:
+      with self._lock:
+        if self.listening or not self._restart_at:
+          return
+        self._restart_at = 0
+        self._started = False
+      self.start()
+
+  #-----------------------------------------------------------------------------
+  # Replaces the in memory settings, e.g. after the server has written them.
+  def set(self, settings):
+    self._settings = settings
+    self._updated = time.time()
+    self._expires = self._updated + self.ttl
+
+  #-----------------------------------------------------------------------------
+  # Returns the in memory settings if they are up to date, or None if they
+  # need to be read (e.g. with the request's other documents, then set).
+  def cached(self):
+    if not self._started:
+      self.start()
+    self._checkWatch()
+    settings = self._settings
+    if settings is None:
+      return None
+    now = time.time()
+    if self.listening and now - self._updated < SETTINGS_MAX_AGE:
+      return settings
+    if now < self._expires:
+      return settings
+    return None
+
+  #-----------------------------------------------------------------------------
+  # Returns (settings dict, error).
+  def get(self):
+    settings = self.cached()
+    if settings is not None:
+      return settings, ''
+
+    settings = self._settings
+    doc_ref, doc, err = retrieveDocument(self.collection_id, self.document_id)
+    if err:
+      if settings is not None:
+        debug(f'[SettingsService - WARN]: Unable to refresh settings, using the previous copy, err = {err}')
+        return settings, ''
+      return None, err
+    settings = doc.to_dict()
+    self.set(settings)
+    return settings, ''
+
+# Process-wide settings service, shared by routes.py and ratings.py
+settings_service = SettingsService()
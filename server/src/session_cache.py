@@ -0,0 +1,204 @@
+################################################################################
+# Q-Chef Server
+# Authors: Q-Chef Backend Programmers
+# Updated: 20261018
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from app import auth_app
+from firebase_admin import auth
+from func import debug
+
+################################################################################
+# Constants
+################################################################################
+SESSION_CACHE_SIZE = 10000 # session cookies
+# A cached cookie is checked for revocation again after at most this many
+# seconds, so a revoked session is accepted for at most this long.
+SESSION_REVOCATION_INTERVAL = int(os.environ.get('QCHEF_SESSION_REVOCATION_INTERVAL', 300)) # seconds
+# The most cookies the background thread checks each pass, so a pass costs
+# a bounded number of Firebase Auth calls.
+SESSION_CHECKS_PER_PASS = 200
+
+################################################################################
+# Helper Functions
+################################################################################
+# sessionKey
+# Returns the cache key of a session cookie, so the cookies themselves are
+# not used as keys.
+# - Input:
+#   - (string) session_cookie
+# - Output:
+#   - (string) key
+def sessionKey(session_cookie):
+  return hashlib.sha256(session_cookie.encode('utf-8')).hexdigest()
+
+################################################################################
+# SessionCookieCache
+################################################################################
+# SessionCookieCache
+# Bounded LRU cache of verified session cookie claims, kept until the
+# cookie's exp. Every revocation_interval/2 seconds a background thread
+# checks the cached cookies that have been used since their last check
+# (at most max_checks of them, the longest unchecked first), and drops the
+# idle ones that are due for a check. A cookie that has not been checked
+# for revocation_interval seconds (e.g. it was idle, the thread is behind
+# or a check failed) is checked again before it is used.
+class SessionCookieCache:
+  def __init__(self, max_size=SESSION_CACHE_SIZE, revocation_interval=SESSION_REVOCATION_INTERVAL,
+               max_checks=SESSION_CHECKS_PER_PASS):
+    self.max_size = max_size
+    self.revocation_interval = revocation_interval
+    self.max_checks = max_checks
+    self.hits = 0
+    self.misses = 0
+    self.checks = 0
+    self.dropped = 0
+    self._entries = OrderedDict() # key -> {'cookie', 'claims', 'checked', 'used'}
+    self._lock = threading.Lock()
+    self._thread = None
+
+  #-----------------------------------------------------------------------------
+  # Starts the revocation thread (in the process that uses it, i.e. after
+  # gunicorn has forked).
+  def start(self):
+    with self._lock:
+      if self._thread is not None:
+        return
+      self._thread = threading.Thread(target=self._run, name='session-revocation', daemon=True)
+    self._thread.start()
+
+  def _run(self):
+    while True:
+      time.sleep(max(1, self.revocation_interval/2))
+      try:
+        self.checkRevocations(max_age=self.revocation_interval/2)
+      except Exception as e:
+        debug(f'[SessionCookieCache - ERROR]: Unable to check the sessions for revocation, err = {e}')
+
+  #-----------------------------------------------------------------------------
+  # Verifies the cookie's signature and (as Firebase does) that the user has
+  # not been disabled or had their sessions revoked.
+  # Returns the cookie's claims, or raises.
+  def _verify(self, session_cookie):
+    with self._lock:
+      self.checks += 1
+    return auth.verify_session_cookie(session_cookie, app=auth_app, check_revoked=True)
+
+  def _store(self, key, session_cookie, claims):
+    with self._lock:
+      now = time.time()
+      self._entries[key] = {'cookie': session_cookie, 'claims': claims, 'checked': now, 'used': now}
+      self._entries.move_to_end(key)
+      while len(self._entries) > self.max_size:
+        self._entries.popitem(last=False)
+
+  def _evict(self, key):
+    with self._lock:
+      self._entries.pop(key, None)
+
+  #-----------------------------------------------------------------------------
+  # Returns the session cookie's claims, e.g. {'uid': ...}.
+  # - Input:
+  #   - (string) session_cookie,
+  #   - (bool) check_revoked, to check for revocation now rather than use a
+  #     cached check (for sensitive requests)
+  # - Output:
+  #   - (dict) claims,
+  #   - (string) error
+  def verify(self, session_cookie, check_revoked=False):
+    self.start()
+    if not check_revoked:
+      claims = self.lookup(session_cookie)
+      if claims is not None:
+        return claims, ''
+    key = sessionKey(session_cookie)
+    with self._lock:
+      self.misses += 1
+
+    try:
+      claims = self._verify(session_cookie)
+    except Exception as e:
+      self._evict(key)
+      return None, f'Unable to authenticate the user, err = {e}'
+    self._store(key, session_cookie, claims)
+    return claims, ''
+
+  #-----------------------------------------------------------------------------
+  # Returns the session cookie's cached claims if they can be used without
+  # verifying the cookie again, otherwise None.
+  def lookup(self, session_cookie):
+    key = sessionKey(session_cookie)
+    now = time.time()
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is None:
+        return None
+      if entry['claims'].get('exp', 0) <= now:
+        self._entries.pop(key)
+        return None
+      if now - entry['checked'] >= self.revocation_interval:
+        return None
+      self._entries.move_to_end(key)
+      entry['used'] = now
+      self.hits += 1
+      return entry['claims']
+
+  #-----------------------------------------------------------------------------
+  # Checks up to max_checks of the cached cookies used since they were last
+  # checked more than max_age seconds ago, dropping the expired, revoked and
+  # otherwise invalid ones. Idle cookies are not checked: those that are
+  # due are dropped, as they would be checked again on their next use
+  # anyway. A cookie that can not be checked (e.g. the network is down) is
+  # kept, and is checked again when it is next used once it is
+  # revocation_interval old.
+  def checkRevocations(self, max_age=0):
+    now = time.time()
+    with self._lock:
+      due = []
+      for key, entry in list(self._entries.items()):
+        if now - entry['checked'] < max_age:
+          continue
+        if entry['used'] > entry['checked']:
+          due.append((entry['checked'], key, entry['cookie']))
+        elif now - entry['checked'] >= self.revocation_interval:
+          self._entries.pop(key)
+    due.sort()
+    for _, key, session_cookie in due[:self.max_checks]:
+      try:
+        claims = self._verify(session_cookie)
+      except (auth.RevokedSessionCookieError, auth.UserDisabledError,
+              auth.ExpiredSessionCookieError, auth.InvalidSessionCookieError) as e:
+        debug(f'[SessionCookieCache - INFO]: Dropping a cached session, err = {e}')
+        with self._lock:
+          if self._entries.pop(key, None) is not None:
+            self.dropped += 1
+        continue
+      except Exception as e:
+        debug(f'[SessionCookieCache - WARN]: Unable to check a session for revocation, err = {e}')
+        continue
+      with self._lock:
+        if key in self._entries:
+          self._entries[key].update({'claims': claims, 'checked': time.time()})
+    if len(due) > self.max_checks:
+      debug(f'[SessionCookieCache - WARN]: {len(due) - self.max_checks} sessions were left for the next check.')
+
+  def stats(self):
+    with self._lock:
+      oldest = min((entry['checked'] for entry in self._entries.values()), default=None)
+      return {'size': len(self._entries),
+              'max_size': self.max_size,
+              'revocation_interval': self.revocation_interval,
+              'max_checks': self.max_checks,
+              'oldest_check_age': time.time() - oldest if oldest is not None else 0,
+              'hits': self.hits,
+              'misses': self.misses,
+              'checks': self.checks,
+              'dropped': self.dropped}
+
+# Process-wide cache used by routes.authCookies
+session_cache = SessionCookieCache()
@@ -0,0 +1,350 @@
+################################################################################
+# Q-Chef Server
+# Authors: Q-Chef Backend Programmers
+# Updated: 20261018
+
+# Storage backends behind func.py's DocumentSession. Documents are addressed
+# by their path, a tuple of alternating collection and document names (IDs),
+# e.g. ('users', user_id) or ('reviews', user_id, recipe_id, 'review').
+
+import asyncio
+import base64
+import copy
+import json
+import sqlite3
+import threading
+
+from firebase_admin import firestore
+
+################################################################################
+# Helper Functions
+################################################################################
+# applyFieldPath
+# Applies a field path update, e.g. {'ic_taste.219.n_ratings': Increment(1)},
+# to a document's data the same way Firestore does.
+# Input:
+#  - (dict) data <- document data, changed in place
+#  - (string) field_path <- dot separated field names
+#  - value <- new value, firestore.Increment or firestore.DELETE_FIELD
+def applyFieldPath(data, field_path, value):
+  names = field_path.split('.')
+  for name in names[:-1]:
+    if not isinstance(data.get(name), dict):
+      data[name] = {}
+    data = data[name]
+  if value is firestore.DELETE_FIELD:
+    data.pop(names[-1], None)
+  elif isinstance(value, firestore.Increment):
+    data[names[-1]] = (data.get(names[-1]) or 0) + value.value
+  else:
+    data[names[-1]] = copy.deepcopy(value)
+
+################################################################################
+# mergeFields
+# Merges nested maps the same way as a set with merge=True, adding up
+# firestore.Increment values and removing firestore.DELETE_FIELD ones.
+# Input:
+#  - (dict) data <- changed in place
+#  - (dict) merge_data
+#  - (bool) pending <- data is a pending write, so keeps its Increments
+def mergeFields(data, merge_data, pending=False):
+  for key, value in merge_data.items():
+    if isinstance(value, dict):
+      if not isinstance(data.get(key), dict):
+        data[key] = {}
+      mergeFields(data[key], value, pending)
+    elif value is firestore.DELETE_FIELD:
+      if pending:
+        data[key] = value
+      else:
+        data.pop(key, None)
+    elif isinstance(value, firestore.Increment):
+      if isinstance(data.get(key), firestore.Increment):
+        data[key] = firestore.Increment(data[key].value + value.value)
+      elif pending and not (key in data):
+        data[key] = value
+      else:
+        data[key] = (data.get(key) or 0) + value.value
+    else:
+      data[key] = copy.deepcopy(value)
+
+################################################################################
+# dumpDocument / loadDocument
+# Convert a document's data to and from json, keeping bytes values (e.g.
+# func.py's packed ratings) as base64.
+def dumpDocument(data):
+  def encodeValue(value):
+    if isinstance(value, bytes):
+      return {'__bytes__': base64.b64encode(value).decode('ascii')}
+    return str(value)
+  return json.dumps(data, default=encodeValue)
+
+def loadDocument(text):
+  def decodeValue(value):
+    if len(value) == 1 and '__bytes__' in value:
+      return base64.b64decode(value['__bytes__'])
+    return value
+  return json.loads(text, object_hook=decodeValue)
+
+################################################################################
+# documentReference
+# Returns the Firestore reference of a document path, with a Client or an
+# AsyncClient.
+def documentReference(client, path):
+  ref = client
+  for i, name in enumerate(path):
+    ref = ref.collection(name) if i % 2 == 0 else ref.document(name)
+  return ref
+
+################################################################################
+# batchWrites
+# Returns a Firestore write batch of StorageBackend.commit's writes, with a
+# Client or an AsyncClient.
+def batchWrites(client, writes):
+  batch = client.batch()
+  for operation, path, data in writes:
+    ref = documentReference(client, path)
+    if operation == 'set':
+      batch.set(ref, data)
+    elif operation == 'merge':
+      batch.set(ref, data, merge=True)
+    elif operation == 'update':
+      batch.update(ref, data)
+    elif operation == 'delete':
+      batch.delete(ref)
+  return batch
+
+################################################################################
+# StorageBackend
+################################################################################
+# StorageBackend
+# Interface used by func.DocumentSession.
+# - getDocument(path) returns the document's data, or None if it does not exist.
+# - getDocuments(paths) returns a list of getDocument(path) for each path,
+#   read together, or raises NotImplementedError.
+# - commit(writes) atomically applies a list of (operation, path, data),
+#   where operation is 'set', 'merge', 'update' or 'delete', and raises if
+#   any of them fail.
+# - watchDocument(path, callback) calls callback(data) whenever the document
+#   changes, or raises NotImplementedError.
+# - isWatchActive(watch) is True while the watch returned by watchDocument
+#   is still calling its callback.
+class StorageBackend:
+  name = ''
+
+  def getDocument(self, path):
+    raise NotImplementedError
+
+  def getDocuments(self, paths):
+    raise NotImplementedError
+
+  def commit(self, writes):
+    raise NotImplementedError
+
+  def watchDocument(self, path, callback):
+    raise NotImplementedError
+
+  def isWatchActive(self, watch):
+    return True
+
+################################################################################
+# FirestoreBackend
+# Stores the documents in Cloud Firestore.
+class FirestoreBackend(StorageBackend):
+  name = 'firestore'
+
+  def __init__(self, client):
+    self.client = client
+
+  def reference(self, path):
+    return documentReference(self.client, path)
+
+  def getDocument(self, path):
+    doc = self.reference(path).get()
+    return doc.to_dict() if doc.exists else None
+
+  # Reads the documents in one round trip. get_all returns them in any order.
+  def getDocuments(self, paths):
+    refs = [self.reference(path) for path in paths]
+    documents = {tuple(doc.reference.path.split('/')): doc.to_dict() if doc.exists else None
+                 for doc in self.client.get_all(refs)}
+    return [documents.get(tuple(path)) for path in paths]
+
+  def commit(self, writes):
+    batchWrites(self.client, writes).commit()
+
+  def watchDocument(self, path, callback):
+    def onSnapshot(doc_snapshots, changes, read_time):
+      for doc in doc_snapshots:
+        callback(doc.to_dict() if doc.exists else None)
+    return self.reference(path).on_snapshot(onSnapshot)
+
+  # A Watch closes itself for good on errors it can not recover from.
+  def isWatchActive(self, watch):
+    return watch is not None and watch.is_active
+
+################################################################################
+# LocalBackend
+# Keeps the documents in memory, and (if given a file) in SQLite, with the
+# same write semantics as Firestore. Used to run the server without
+# credentials or a network connection.
+# - Input:
+#   - (string) sqlite_fn, or '' to only keep the documents in memory
+class LocalBackend(StorageBackend):
+  name = 'local'
+
+  def __init__(self, sqlite_fn=''):
+    self.sqlite_fn = sqlite_fn
+    self._documents = {}
+    self._watchers = {}
+    self._lock = threading.Lock()
+    self._connection = None
+    if sqlite_fn:
+      self.name = 'sqlite'
+      self._connection = sqlite3.connect(sqlite_fn, check_same_thread=False)
+      self._connection.execute('CREATE TABLE IF NOT EXISTS documents (path TEXT PRIMARY KEY, data TEXT NOT NULL)')
+      self._connection.commit()
+      for path, data in self._connection.execute('SELECT path, data FROM documents'):
+        self._documents[tuple(path.split('/'))] = loadDocument(data)
+
+  def getDocument(self, path):
+    with self._lock:
+      data = self._documents.get(tuple(path))
+      return copy.deepcopy(data)
+
+  def getDocuments(self, paths):
+    with self._lock:
+      return [copy.deepcopy(self._documents.get(tuple(path))) for path in paths]
+
+  def commit(self, writes):
+    with self._lock:
+      # Apply the writes to copies, so a failed write changes nothing.
+      changed = {}
+      for operation, path, data in writes:
+        path = tuple(path)
+        current = changed[path] if path in changed else copy.deepcopy(self._documents.get(path))
+        if operation == 'set':
+          current = {}
+          mergeFields(current, data)
+        elif operation == 'merge':
+          current = current if current is not None else {}
+          mergeFields(current, data)
+        elif operation == 'update':
+          if current is None:
+            raise KeyError(f'No document to update: {"/".join(path)}')
+          for key, value in data.items():
+            applyFieldPath(current, key, value)
+        elif operation == 'delete':
+          current = None
+        else:
+          raise ValueError(f'Unknown write operation {operation}')
+        changed[path] = current
+
+      if self._connection is not None:
+        with self._connection:
+          for path, data in changed.items():
+            if data is None:
+              self._connection.execute('DELETE FROM documents WHERE path = ?', ('/'.join(path),))
+            else:
+              self._connection.execute('REPLACE INTO documents (path, data) VALUES (?, ?)', ('/'.join(path), dumpDocument(data)))
+      for path, data in changed.items():
+        if data is None:
+          self._documents.pop(path, None)
+        else:
+          self._documents[path] = data
+      callbacks = [(callback, copy.deepcopy(changed[path])) for path in changed for callback in self._watchers.get(path, [])]
+
+    for callback, data in callbacks:
+      callback(data)
+
+  def watchDocument(self, path, callback):
+    with self._lock:
+      self._watchers.setdefault(tuple(path), []).append(callback)
+      data = copy.deepcopy(self._documents.get(tuple(path)))
+    callback(data)
+
+  #-----------------------------------------------------------------------------
+  # Adds the documents that do not exist yet, e.g. server/settings.
+  # - Input:
+  #   - (dict) 'collection/document' path -> data
+  def seed(self, documents):
+    writes = [('set', tuple(path.split('/')), data) for path, data in documents.items()
+              if self.getDocument(tuple(path.split('/'))) is None]
+    if writes:
+      self.commit(writes)
+
+################################################################################
+# Async Storage Backends
+################################################################################
+# Used by asgi.py to read and commit a request's documents without holding
+# a thread. They have the same getDocuments and commit as StorageBackend,
+# as coroutines.
+
+################################################################################
+# AsyncFirestoreBackend
+# Reads and writes the documents with the async Firestore client.
+class AsyncFirestoreBackend:
+  name = 'firestore'
+
+  def __init__(self, client):
+    self.client = client
+
+  async def getDocuments(self, paths):
+    refs = [documentReference(self.client, path) for path in paths]
+    documents = {}
+    async for doc in self.client.get_all(refs):
+      documents[tuple(doc.reference.path.split('/'))] = doc.to_dict() if doc.exists else None
+    return [documents.get(tuple(path)) for path in paths]
+
+  async def commit(self, writes):
+    await batchWrites(self.client, writes).commit()
+
+################################################################################
+# AsyncLocalBackend
+# Async interface to a LocalBackend. The LocalBackend takes a lock and may
+# write to SQLite, so its calls are run on the event loop's default
+# executor rather than on the loop itself.
+class AsyncLocalBackend:
+  def __init__(self, backend):
+    self.backend = backend
+    self.name = backend.name
+
+  async def getDocuments(self, paths):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, self.backend.getDocuments, paths)
+
+  async def commit(self, writes):
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, self.backend.commit, writes)
+
+################################################################################
+# createAsyncStorage
+# Returns the async storage backend for the storage backend.
+# - Input:
+#   - (StorageBackend) storage, from createStorage,
+#   - (function) async_firestore_client(), only called for Firestore
+# - Output:
+#   - async storage backend
+def createAsyncStorage(storage, async_firestore_client=None):
+  if isinstance(storage, FirestoreBackend):
+    return AsyncFirestoreBackend(async_firestore_client())
+  if isinstance(storage, LocalBackend):
+    return AsyncLocalBackend(storage)
+  raise ValueError(f'No async storage backend for {storage.name}.')
+
+################################################################################
+# createStorage
+# Returns the storage backend named by the QCHEF_STORAGE setting.
+# - Input:
+#   - (string) setting, 'firestore', 'memory' or 'sqlite:<file name>',
+#   - (function) firestore_client(), only called for 'firestore'
+# - Output:
+#   - (StorageBackend) storage
+def createStorage(setting, firestore_client=None):
+  if setting == 'firestore':
+    return FirestoreBackend(firestore_client())
+  if setting == 'memory':
+    return LocalBackend()
+  if setting.startswith('sqlite:'):
+    return LocalBackend(setting[len('sqlite:'):])
+  raise ValueError(f'Unknown storage backend {setting}, expected firestore, memory or sqlite:<file name>.')
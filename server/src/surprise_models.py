@@ -1,12 +1,14 @@
 from flask import g
-from joblib import load
 import csv,math
 from scipy.spatial import distance
+import functools
 import numpy as np
-import pandas as pd
-import traceback
+import threading
 
 from func import *
+from catalog import getCatalog, feature_percentiles
+from model_registry import ModelRegistry
+from server_settings import SettingsService
 from sklearn.preprocessing import PolynomialFeatures
 
 from sklearn.preprocessing import minmax_scale
@@ -18,6 +20,16 @@ model_fns = fns={
     "surp_neg":"./data/best_surp_neg_model_10board_poly_final.joblib"
 }
 
+# The onboarding/recipes document (the archetype recipe ids), kept in memory
+# and up to date the same way as server/settings, see server_settings.py.
+onboarding_recipes_service = SettingsService('onboarding', 'recipes')
+
+# Process-wide (archetype ids, archetype recipes, recipes x archetypes
+# similarity matrix), rebuilt by getRecipeArchetypes when the onboarding
+# set changes.
+_archetypes = (None, None, None)
+_archetypes_lock = threading.Lock()
+
 ######## Surprise Helper Functions ########
 
 # recipeSimilarity - returns cosine similarity between two recipe vectors
@@ -30,46 +42,63 @@ model_fns = fns={
 def recipeSimilarity(recipe1,recipe2):
     return distance.cdist([recipe1["vector"]], [recipe2["vector"]], "cosine")[0].item(),""
 
-# getRecipeArchetypes - returns IDs for the onboarding recipe set, initialising if needed
+# getRecipeArchetypes - returns the onboarding recipe set, and sets g.archetype_similarities to its
+# similarity matrix. Both are built once per archetype set (not per request), from the in memory
+# onboarding/recipes document.
 # Input:
 #  - None
 # Output:
-#  - (list of dicts): the archetype recipe objects
+#  - (dict): archetype recipe id -> the archetype recipe object
 #  - (string): error
 def getRecipeArchetypes():
-    archetypes = g.get("archetype_recipes",None)
-    if archetypes == None:
-        _, archetype_ids, err = retrieveDocument("onboarding","recipes")
-        if err:
-            return None, f"Failed to load archetypes from db."
-        archetype_ids = archetype_ids.to_dict().keys()
-        archetypes = {}
-        for a_id in archetype_ids:
-            try:
-                archetypes[a_id] = g.r_data[a_id]
-            except:
-                return None, f"Failed to load archetype recipe id {a_id} from g.r_data."
-        g.archetype_recipes = archetypes
+    global _archetypes
+    onboarding_recipes, err = onboarding_recipes_service.get()
+    if err:
+        return None, f"Failed to load archetypes from db."
+    archetype_ids = tuple(onboarding_recipes.keys())
+    cached_ids, archetypes, matrix = _archetypes
+    if cached_ids != archetype_ids:
+        with _archetypes_lock:
+            cached_ids, archetypes, matrix = _archetypes
+            if cached_ids != archetype_ids:
+                catalog = getCatalog()
+                archetypes = {}
+                for a_id in archetype_ids:
+                    try:
+                        archetypes[a_id] = catalog.recipe(a_id)
+                    except:
+                        return None, f"Failed to load archetype recipe id {a_id} from the catalog."
+                matrix = computeArchetypeSimilarities(archetype_ids)
+                _archetypes = (archetype_ids, archetypes, matrix)
+                debug(f"[getRecipeArchetypes - INFO]: Computed archetype similarities for {len(archetype_ids)} archetypes")
+    g.archetype_similarities = matrix
     return archetypes,""
 
+# computeArchetypeSimilarities - cosine similarity of every catalog recipe to each archetype
+# Input:
+#  - (list of strings): the archetype recipe ids
+# Output:
+#  - (np.array float32): recipes x archetypes similarities, clipped at 0 like archetypeSimilarities
+def computeArchetypeSimilarities(archetype_ids):
+    catalog = getCatalog()
+    vectors = catalog.columns["r_vector"]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        unit_vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    archetype_vectors = unit_vectors[catalog.recipeRows(archetype_ids)]
+    similarities = np.nan_to_num(unit_vectors @ archetype_vectors.T, nan=0.)
+    return np.maximum(similarities, 0).astype(np.float32)
+
 # archetypeSimilarities - returns similarities between a target recipe and the onboarding recipe set
 # Input:
-#  - (dict): the recipe object
+#  - (string): the recipe id
 # Output:
-#  - (list of floats): the archetype similarities, ordered by key
+#  - (np.array of floats): the archetype similarities, ordered by key
 #  - (string): error
-def archetypeSimilarities(recipe):
+def archetypeSimilarities(recipe_id):
     archetype_recipes,error = getRecipeArchetypes()
     if len(error):
         return None,error
-    archetype_ids = archetype_recipes.keys()
-    sims = []
-    for id in archetype_ids:
-        sim, err = recipeSimilarity(recipe,archetype_recipes[id])
-        if err:
-            return None,err
-        sims.append(max(0,1-sim))
-    return sims
+    return g.archetype_similarities[getCatalog().recipeRow(recipe_id)]
 
 # userArchetypeSurpRatings - returns user ratings of the archetypes (from onboarding)
 # Input:
@@ -129,24 +158,22 @@ def userArchetypeFamRatings(user):
     return arch_fams,""
 
 
+# warmupModel - runs one prediction on a dummy feature row, so that sklearn/BLAS initialise before the first user
+# Input:
+#  - (dict): the model
+def warmupModel(model):
+    n_features = len(model["recipe_pset"]) + len(model["user_pset"])
+    predictFeatures(model, np.zeros((1, n_features)))
+
+# Process-wide registry of the neural surprise models, see model_registry.py
+model_registry = ModelRegistry(model_fns, warmup=warmupModel)
+
 # getModels - returns the pretrained classifier used in neural surprise, initialising if needed
 # Output:
 #  - (dict): dict of four sklearn BaseEstimator objects (fam_high,fam_low,surp_pos,surp_neg)
 #  - (string): error
 def getModels():
-    models_dict = g.get("models_dict",None)
-    if models_dict == None:
-        models_dict = {}
-        for model_key,model_fn in fns.items():
-            try:
-                models_dict[model_key] = load(model_fn)
-            except:
-                traceback.print_exc()
-                return None, f"Failed to load model from file. Does {model_fn} exist?"
-            print("Loaded",model_fn)
-
-        g.models_dict = models_dict
-    return models_dict,""
+    return model_registry.models()
 
 # rawSurpRecipe - returns the ingredient co-occurrence based surprise score for a recipe
 # Input:
@@ -158,14 +185,14 @@ def getModels():
 #  - (string): error
 def rawSurpRecipe(recipe_id,percentile=100):
     try:
-        recipe = g.r_data[recipe_id]
+        surprises = getCatalog().recipeSurprises(recipe_id)
     except:
-        return None,recipe_id + " not found in g.r_data."
-    if "surprises" not in recipe.keys() or not len(recipe["surprises"]):
+        return None,recipe_id + " not found in the catalog."
+    if not len(surprises):
         return None,"No surprises found for this recipe."
-    if not str(percentile)+"%" in recipe["surprises"].keys():
+    if not str(percentile)+"%" in surprises.keys():
         return None,"That percentile was not found in the pre-calculated surprises for this recipe."
-    return recipe["surprises"][str(percentile)+"%"], ""
+    return surprises[str(percentile)+"%"], ""
 
 # culinaryExperience - classifies user as novice, moderate, or foodie
 # Input:
@@ -226,95 +253,119 @@ def simpleSurpRecipe(user, recipe_id, sigma=2, delta=1):
 def simpleSurpRecipes(user, recipe_ids, sigma=2, delta=1):
     raise NotImplementedError
 
-def predict_many_users_one_recipe(model, users, recipe_id, weight_id = None):
-    X = pd.DataFrame()
-    debug(f'[predict_many_users_one_recipe - INFO]: Starting, model= {model}')
-    for col in model["recipe_pset"]:
+# getPolynomialExpander - returns a fitted PolynomialFeatures, shared by every call with the same shape
+# Input:
+#  - (int): polynomial degree
+#  - (int): number of input features
+# Output:
+#  - (PolynomialFeatures): the fitted expander (its transform is stateless, so safe to share between threads)
+@functools.lru_cache(maxsize=None)
+def getPolynomialExpander(degree, n_features):
+    return PolynomialFeatures(degree).fit(np.zeros((1, n_features)))
+
+# recipeFeatures - the model's recipe features for many recipes, read from the catalog columns
+# Input:
+#  - (dict): the model
+#  - (list of strings): recipe ids
+# Output:
+#  - (np.array): recipes x len(model["recipe_pset"]) features
+#  - (string): error
+def recipeFeatures(model, recipe_ids):
+    catalog = getCatalog()
+    try:
+        recipe_rows = catalog.recipeRows(recipe_ids)
+    except KeyError as e:
+        return None, f"Recipe {e} not found in the catalog."
+    X = np.empty((len(recipe_rows), len(model["recipe_pset"])))
+    for i, col in enumerate(model["recipe_pset"]):
         if "nov" in col:
-            try:
-                percentile = col.split("_")[-1]
-                feature = g.nov_data[recipe_id]["novelty_"+percentile]
-            except:
-                return None, col + " is not a supported model feature."
+            column = "r_nov_features"
         elif "surp" in col:
-            try:
-                percentile = col.split("_")[-1]
-                feature = g.surp_data[recipe_id]["surprise_"+percentile]
-            except:
-                return None, col + " is not a supported model feature."
+            column = "r_surp_features"
         else:
             return None,col+" is not a supported model feature."
-        X[col] = [feature] * len(users)
-    archetype_similarities = archetypeSimilarities(g.r_data[recipe_id])
-    for col in model["user_pset"]:
-        if not "onboarding" in col:
-                return None, col + " is not a supported model feature."
-        features = []
-        for user in users:
-            if "taste_avg" in col:
-                archetype_ratings, error = userArchetypeTasteRatings(user)
-            elif "surp_avg" in col:
-                archetype_ratings, error = userArchetypeSurpRatings(user)
-            elif "fam_avg" in col:
-                archetype_ratings, error = userArchetypeFamRatings(user)
-            if error != "":
-                return None, error
-            if weight_id is not None:
-                features.append(np.average(archetype_ratings, weights=archetype_similarities))
-            else:
-                features.append(np.mean(archetype_ratings))
-        X[col] = features
+        percentile = col.split("_")[-1]
+        if not percentile in feature_percentiles:
+            return None, col + " is not a supported model feature."
+        features = catalog.columns[column][recipe_rows, feature_percentiles.index(percentile)]
+        if np.isnan(features).any():
+            return None, col + " is not a supported model feature."
+        X[:, i] = features
+    return X,""
+
+# userArchetypeRatings - the user's archetype ratings used by a model's user feature
+# Input:
+#  - (dict): user object
+#  - (string): model user feature name
+# Output:
+#  - (list of floats): the user's ratings of the archetypal recipes
+#  - (string): error
+def userArchetypeRatings(user, col):
+    if not "onboarding" in col:
+        return None, col + " is not a supported model feature."
+    if "taste_avg" in col:
+        return userArchetypeTasteRatings(user)
+    elif "surp_avg" in col:
+        return userArchetypeSurpRatings(user)
+    elif "fam_avg" in col:
+        return userArchetypeFamRatings(user)
+    return None, col + " is not a supported model feature."
+
+# predictFeatures - runs a model on an assembled (recipe_pset + user_pset) feature matrix
+# Input:
+#  - (dict): the model
+#  - (np.array): rows x features
+# Output:
+#  - (np.array of floats): the model's prediction per row
+#  - (string): error
+def predictFeatures(model, X):
     if model["poly_features"] > 0:
-        X = PolynomialFeatures(model["poly_features"]).fit_transform(X)
+        X = getPolynomialExpander(model["poly_features"], X.shape[1]).transform(X)
     X_scaled = model["scaler"].transform(X)
     if "decision_norm" in model.keys():
         return model["predictor"].decision_function(X_scaled) / model["decision_norm"],""
     else:
         return model["predictor"].predict_proba(X_scaled)[:,1],""
 
+def predict_many_users_one_recipe(model, users, recipe_id, weight_id = None):
+    debug(f'[predict_many_users_one_recipe - INFO]: Starting, model= {model}')
+    recipe_X, error = recipeFeatures(model, [recipe_id])
+    if error != "":
+        return None, error
+    n_recipe_features = recipe_X.shape[1]
+    X = np.empty((len(users), n_recipe_features + len(model["user_pset"])))
+    X[:, :n_recipe_features] = recipe_X
+    archetype_similarities = archetypeSimilarities(recipe_id)
+    for i, col in enumerate(model["user_pset"]):
+        for j, user in enumerate(users):
+            archetype_ratings, error = userArchetypeRatings(user, col)
+            if error != "":
+                return None, error
+            if weight_id is not None:
+                X[j, n_recipe_features+i] = np.average(archetype_ratings, weights=archetype_similarities)
+            else:
+                X[j, n_recipe_features+i] = np.mean(archetype_ratings)
+    return predictFeatures(model, X)
+
 def predict_one_user_many_recipes(model, user, recipe_ids, weight_ids = None):
-    X = pd.DataFrame()
     debug(f'[predict_one_user_many_recipes - INFO]: Starting, model= {model}')
-    for col in model["recipe_pset"]:
-        if "nov" in col:
-            try:
-                percentile = col.split("_")[-1]
-                features = [g.nov_data[recipe_id]["novelty_"+percentile] for recipe_id in recipe_ids]
-            except:
-                return None, col + " is not a supported model feature."
-        elif "surp" in col:
-            try:
-                percentile = col.split("_")[-1]
-                features = [g.surp_data[recipe_id]["surprise_"+percentile] for recipe_id in recipe_ids]
-            except:
-                return None, col + " is not a supported model feature."
-        else:
-            return None,col+" is not a supported model feature."
-        X[col] = features
-    for col in model["user_pset"]:
-        if not "onboarding" in col:
-                return None, col + " is not a supported model feature."
-        if "taste_avg" in col:
-            archetype_ratings, error = userArchetypeTasteRatings(user)
-        elif "surp_avg" in col:
-            archetype_ratings, error = userArchetypeSurpRatings(user)
-        elif "fam_avg" in col:
-            archetype_ratings, error = userArchetypeFamRatings(user)
+    recipe_X, error = recipeFeatures(model, recipe_ids)
+    if error != "":
+        return None, error
+    n_recipe_features = recipe_X.shape[1]
+    X = np.empty((len(recipe_ids), n_recipe_features + len(model["user_pset"])))
+    X[:, :n_recipe_features] = recipe_X
+    for i, col in enumerate(model["user_pset"]):
+        archetype_ratings, error = userArchetypeRatings(user, col)
         if error != "":
             return None, error
         if weight_ids is not None:
-            archetype_similarities_list = [archetypeSimilarities(g.r_data[recipe_id]) for recipe_id in recipe_ids]
-            features = [np.average(archetype_ratings, weights=arch_sim) for arch_sim in archetype_similarities_list]
+            # Weighted average of the archetype ratings by each recipe's row of similarities
+            archetype_similarities = g.archetype_similarities[getCatalog().recipeRows(recipe_ids)].astype(np.float64)
+            X[:, n_recipe_features+i] = (archetype_similarities @ np.asarray(archetype_ratings, dtype=np.float64)) / archetype_similarities.sum(axis=1)
         else:
-            features = [np.mean(archetype_ratings)] * len(recipe_ids)
-        X[col] = features
-    if model["poly_features"] > 0:
-        X = PolynomialFeatures(model["poly_features"]).fit_transform(X)
-    X_scaled = model["scaler"].transform(X)
-    if "decision_norm" in model.keys():
-        return model["predictor"].decision_function(X_scaled) / model["decision_norm"],""
-    else:
-        return model["predictor"].predict_proba(X_scaled)[:,1],""
+            X[:, n_recipe_features+i] = np.mean(archetype_ratings)
+    return predictFeatures(model, X)
 
 
 # advancedSurpRecipe - returns the surprise score for a given user-recipe pair
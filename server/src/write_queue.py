@@ -0,0 +1,160 @@
+################################################################################
+# Q-Chef Server
+# Authors: Q-Chef Backend Programmers
+# Updated: 20261018
+
+import atexit
+import itertools
+import queue
+import threading
+import time
+import zlib
+
+from app import app
+from func import debug, commitDocumentSession, discardDocumentSession
+
+################################################################################
+# Constants
+################################################################################
+WRITE_QUEUE_SIZE = 1000 # jobs
+WRITE_QUEUE_WORKERS = 4
+WRITE_QUEUE_RETRIES = 5
+WRITE_QUEUE_BACKOFF = 0.5 # seconds, doubled after each failed attempt
+WRITE_QUEUE_MAX_BACKOFF = 30 # seconds
+# How long a worker waits for the queued writes when it shuts down. This has
+# to fit inside gunicorn's graceful_timeout (see gunicorn.conf.py), which
+# has to fit inside the 10 seconds Cloud Run gives after SIGTERM.
+WRITE_QUEUE_FLUSH_TIMEOUT = 5 # seconds
+
+################################################################################
+# WriteBehindQueue
+################################################################################
+# WriteBehindQueue
+# Bounded in-process queue of writes that the client does not need to wait
+# for. Each job is a function returning an error string, run in its own
+# app context so its document session is committed in one batch once it
+# succeeds. Jobs that fail on storage (the job raises, e.g. a read failed,
+# or its commit fails) are retried with exponential backoff. An error the
+# job returns itself is about its data, so it would fail again and is not
+# retried; callers should check the data before queueing it.
+# Jobs with the same key (e.g. user id) always go to the same worker, so
+# they are run in the order they were queued.
+class WriteBehindQueue:
+  def __init__(self, max_size=WRITE_QUEUE_SIZE, workers=WRITE_QUEUE_WORKERS,
+               retries=WRITE_QUEUE_RETRIES, backoff=WRITE_QUEUE_BACKOFF):
+    self.max_size = max_size
+    self.workers = workers
+    self.retries = retries
+    self.backoff = backoff
+    self.enqueued = 0
+    self.completed = 0
+    self.failed = 0
+    self.retried = 0
+    self.rejected = 0
+    self._queues = [queue.Queue(max(1, max_size//workers)) for _ in range(workers)]
+    self._pending = {} # job id -> time queued
+    self._job_ids = itertools.count()
+    self._threads = []
+    self._lock = threading.Lock()
+
+  #-----------------------------------------------------------------------------
+  # Starts the worker threads (in the process that uses them, i.e. after
+  # gunicorn has forked).
+  def start(self):
+    with self._lock:
+      if self._threads:
+        return
+      for worker_queue in self._queues:
+        thread = threading.Thread(target=self._work, args=(worker_queue,), daemon=True)
+        thread.start()
+        self._threads.append(thread)
+    atexit.register(self.flush)
+
+  #-----------------------------------------------------------------------------
+  # Queues fn(*args). Returns an error string if the queue is full, in which
+  # case the caller should do the write itself.
+  def enqueue(self, key, name, fn, *args):
+    if not self._threads:
+      self.start()
+    job_id = next(self._job_ids)
+    worker_queue = self._queues[zlib.crc32(f'{key}'.encode('utf-8')) % len(self._queues)]
+    with self._lock:
+      self._pending[job_id] = time.time()
+    try:
+      worker_queue.put_nowait((job_id, name, fn, args))
+    except queue.Full:
+      with self._lock:
+        self._pending.pop(job_id, None)
+        self.rejected += 1
+      err = f'[WriteBehindQueue - WARN]: Queue is full, unable to queue {name} for {key}.'
+      debug(err)
+      return err
+    with self._lock:
+      self.enqueued += 1
+    return ''
+
+  #-----------------------------------------------------------------------------
+  # Runs one job, returning (error string, whether to retry it).
+  def _run(self, name, fn, args):
+    try:
+      with app.app_context():
+        err = fn(*args)
+        if err:
+          discardDocumentSession()
+          return err, False
+        err = commitDocumentSession()
+    except Exception as e:
+      err = f'{name} raised {e!r}'
+    return err, bool(err)
+
+  def _work(self, worker_queue):
+    while True:
+      job_id, name, fn, args = worker_queue.get()
+      delay = self.backoff
+      for attempt in range(self.retries+1):
+        err, retry = self._run(name, fn, args)
+        if not retry:
+          break
+        if attempt < self.retries:
+          debug(f'[WriteBehindQueue - WARN]: {name} failed (attempt {attempt+1}), retrying in {delay}s, err = {err}')
+          with self._lock:
+            self.retried += 1
+          time.sleep(delay)
+          delay = min(delay*2, WRITE_QUEUE_MAX_BACKOFF)
+      with self._lock:
+        self._pending.pop(job_id, None)
+        if err:
+          self.failed += 1
+        else:
+          self.completed += 1
+      if err:
+        print(f'[WriteBehindQueue - ERROR]: Giving up on {name} after {attempt+1} attempts, err = {err}')
+      worker_queue.task_done()
+
+  #-----------------------------------------------------------------------------
+  # Waits for the queued jobs to finish, e.g. before the worker exits.
+  # Returns the number of jobs that were still pending.
+  def flush(self, timeout=WRITE_QUEUE_FLUSH_TIMEOUT):
+    deadline = time.time() + timeout
+    while self._pending and self._threads and time.time() < deadline:
+      time.sleep(0.05)
+    remaining = len(self._pending)
+    if remaining:
+      print(f'[WriteBehindQueue - ERROR]: {remaining} writes were not flushed.')
+    return remaining
+
+  def stats(self):
+    with self._lock:
+      oldest = min(self._pending.values()) if self._pending else None
+      return {'depth': len(self._pending),
+              'max_size': self.max_size,
+              'workers': len(self._threads),
+              'lag_seconds': time.time() - oldest if oldest else 0.,
+              'enqueued': self.enqueued,
+              'completed': self.completed,
+              'failed': self.failed,
+              'retried': self.retried,
+              'rejected': self.rejected}
+
+# Process-wide queue used by routes.py
+write_queue = WriteBehindQueue()
@@ -0,0 +1,41 @@
+################################################################################
+# Q-Chef Server
+# Authors: Q-Chef Backend Programmers
+# Updated: 20261018
+
+# Runs the tests against the in-memory LocalBackend (see storage.py), from
+# server/src so the catalog and models in ./data are found:
+#   cd server && python -m pytest tests
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+
+os.environ['QCHEF_STORAGE'] = 'memory'
+os.environ['QCHEF_STORAGE_SEED'] = ''
+os.environ['QCHEF_BLOB_STORE'] = 'local:' + tempfile.mkdtemp(prefix='qchef-blobs-')
+os.environ.setdefault('QCHEF_USER_DOC_ENCODING', 'maps')
+sys.path.insert(0, SRC_DIR)
+os.chdir(SRC_DIR)
+
+# app.py has to be imported before func.py and the modules that use it
+import app as server_app
+
+################################################################################
+# Fixtures
+################################################################################
+# A fresh in-memory LocalBackend.
+@pytest.fixture
+def local_backend():
+  from storage import LocalBackend
+  return LocalBackend()
+
+# The app's LocalBackend, used by func.py's document sessions.
+@pytest.fixture
+def storage():
+  return server_app.storage
+
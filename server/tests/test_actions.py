@@ -0,0 +1,64 @@
+################################################################################
+# Q-Chef Server
+# Authors: Q-Chef Backend Programmers
+# Updated: 20261018
+
+from func import jobDocumentSession
+from actions import updateActionLog, checkActionLog
+
+ACTION_LOG = [
+  ['1609459200000', '94249', 'viewed'],
+  ['1609459300000', '94249', 'cooked'],
+  ['1609459250000', '88444', 'viewed'],
+]
+
+################################################################################
+# Helper Functions
+################################################################################
+# Runs updateActionLog the way the write queue does, outside a request.
+def logActions(user_id, action_log):
+  with jobDocumentSession():
+    return updateActionLog({'userID': user_id, 'action_log': action_log})
+
+################################################################################
+# updateActionLog
+################################################################################
+def test_action_log_summary(storage):
+  assert logActions('actions-summary', ACTION_LOG) == ''
+  assert storage.getDocument(('actions', 'actions-summary')) == {
+    '94249': {'n_actions': 2, 'last_action': 'cooked', 'last_timestamp': '1609459300000'},
+    '88444': {'n_actions': 1, 'last_action': 'viewed', 'last_timestamp': '1609459250000'},
+  }
+  assert storage.getDocument(('actions', 'actions-summary', 'log', '202101')) == {
+    '94249': {'1609459200000': 'viewed', '1609459300000': 'cooked'},
+    '88444': {'1609459250000': 'viewed'},
+  }
+
+def test_action_log_is_idempotent(storage):
+  assert logActions('actions-again', ACTION_LOG) == ''
+  summary = storage.getDocument(('actions', 'actions-again'))
+  log = storage.getDocument(('actions', 'actions-again', 'log', '202101'))
+  # e.g. a retried job whose first commit went through
+  assert logActions('actions-again', ACTION_LOG) == ''
+  assert storage.getDocument(('actions', 'actions-again')) == summary
+  assert storage.getDocument(('actions', 'actions-again', 'log', '202101')) == log
+
+def test_older_actions_do_not_change_the_summary(storage):
+  assert logActions('actions-older', ACTION_LOG[1:2]) == ''
+  assert logActions('actions-older', ACTION_LOG[:1]) == ''
+  assert storage.getDocument(('actions', 'actions-older'))['94249'] == {
+    'n_actions': 1, 'last_action': 'cooked', 'last_timestamp': '1609459300000'}
+
+def test_newer_actions_are_counted(storage):
+  assert logActions('actions-newer', ACTION_LOG[:1]) == ''
+  assert logActions('actions-newer', ACTION_LOG[1:2]) == ''
+  assert storage.getDocument(('actions', 'actions-newer'))['94249'] == {
+    'n_actions': 2, 'last_action': 'cooked', 'last_timestamp': '1609459300000'}
+
+################################################################################
+# checkActionLog
+################################################################################
+def test_check_action_log():
+  assert checkActionLog(ACTION_LOG) == ''
+  assert checkActionLog({'94249': 'viewed'})
+  assert checkActionLog([['1609459200000', '94249']])
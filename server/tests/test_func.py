@@ -0,0 +1,42 @@
+################################################################################
+# Q-Chef Server
+# Authors: Q-Chef Backend Programmers
+# Updated: 20261018
+
+import pytest
+
+from func import packRatingMaps, unpackRatingMaps, decodeUserDocument, PACKED_RATINGS_FIELD
+
+USER_DICT = {
+  'name': 'test',
+  'ic_taste': {'219': {'rating': 0.5, 'n_ratings': 2}, '1000': {'rating': -1, 'n_ratings': 1}},
+  'r_surprise': {'94249': {'rating': 1.0, 'n_ratings': 1}},
+  'i_taste': {},
+}
+
+################################################################################
+# Packed Ratings
+################################################################################
+def test_pack_round_trip():
+  packed, names = packRatingMaps(USER_DICT)
+  assert isinstance(packed, bytes)
+  assert sorted(names) == ['i_taste', 'ic_taste', 'r_surprise']
+  assert unpackRatingMaps(packed) == {name: USER_DICT[name] for name in names}
+
+def test_pack_keeps_other_entries_as_maps():
+  user_dict = dict(USER_DICT, ic_familiarity={'219': {'rating': 1, 'n_ratings': 1, 'note': 'x'}})
+  packed, names = packRatingMaps(user_dict)
+  assert not ('ic_familiarity' in names)
+  assert not ('ic_familiarity' in unpackRatingMaps(packed))
+
+def test_unpack_rejects_other_data():
+  with pytest.raises(ValueError):
+    unpackRatingMaps(b'not packed')
+
+def test_decode_user_document():
+  packed, names = packRatingMaps(USER_DICT)
+  stored = {key: value for key, value in USER_DICT.items() if not (key in names)}
+  stored[PACKED_RATINGS_FIELD] = packed
+  assert decodeUserDocument(stored) == USER_DICT
+  assert decodeUserDocument(USER_DICT) is USER_DICT
+  assert decodeUserDocument(None) is None
@@ -0,0 +1,93 @@
+################################################################################
+# Q-Chef Server
+# Authors: Q-Chef Backend Programmers
+# Updated: 20261018
+
+import os
+
+import pytest
+
+from app import app
+from catalog import getCatalog
+from func import commitDocumentSession, decodeUserDocument
+from ratings import ratingSnapshot, ratingDelta, updateIngredientClusterRatings, updateRecipeRatings
+
+################################################################################
+# Helper Functions
+################################################################################
+def setUser(storage, user_id, data):
+  storage.commit([('set', ('users', user_id), data)])
+
+def getUser(storage, user_id):
+  return decodeUserDocument(storage.getDocument(('users', user_id)))
+
+# Rates the ingredient clusters with a document session of their own, as
+# the /onboarding_ingredient_rating route does.
+def rateClusters(user_id, ratings):
+  with app.app_context():
+    err = updateIngredientClusterRatings({'userID': user_id, 'taste_ratings': ratings, 'familiarity_ratings': ratings}, ['taste', 'familiarity'])
+    assert err == ''
+    assert commitDocumentSession() == ''
+
+################################################################################
+# ratingDelta
+################################################################################
+def test_rating_delta_has_the_whole_changed_entries():
+  user_dict = {'ic_taste': {'219': {'rating': 1, 'n_ratings': 1}, '220': {'rating': 0, 'n_ratings': 3}}}
+  snapshot = ratingSnapshot(user_dict, ['ic_'], ['taste'])
+  user_dict['ic_taste']['219'] = {'rating': 0.5, 'n_ratings': 2}
+  user_dict['ic_taste']['221'] = {'rating': -1, 'n_ratings': 1}
+  assert ratingDelta(snapshot, user_dict) == {
+    'ic_taste.219': {'rating': 0.5, 'n_ratings': 2},
+    'ic_taste.221': {'rating': -1, 'n_ratings': 1},
+  }
+
+def test_rating_delta_is_empty_without_changes():
+  user_dict = {'ic_taste': {'219': {'rating': 1, 'n_ratings': 1}}}
+  assert ratingDelta(ratingSnapshot(user_dict, ['ic_'], ['taste']), user_dict) == {}
+
+################################################################################
+# Rating Updates
+################################################################################
+def test_cluster_ratings_are_averaged(storage):
+  setUser(storage, 'rate-ic', {'ic_taste': {'219': {'rating': 1, 'n_ratings': 1}}, 'ic_familiarity': {}, 'name': 'kept'})
+  rateClusters('rate-ic', {'219': 0, '220': 2})
+  user_dict = getUser(storage, 'rate-ic')
+  assert user_dict['ic_taste'] == {'219': {'rating': 0, 'n_ratings': 2}, '220': {'rating': 1, 'n_ratings': 1}}
+  assert user_dict['ic_familiarity'] == {'219': {'rating': -1, 'n_ratings': 1}, '220': {'rating': 1, 'n_ratings': 1}}
+  assert user_dict['name'] == 'kept'
+
+def test_stale_cluster_ratings_keep_rating_and_n_ratings_together(storage):
+  setUser(storage, 'rate-stale', {'ic_taste': {'219': {'rating': 1, 'n_ratings': 1}}, 'ic_familiarity': {}})
+  data = {'userID': 'rate-stale', 'taste_ratings': {'219': 0}, 'familiarity_ratings': {'219': 0}}
+  # Both sessions read the user before either writes
+  with app.app_context():
+    assert updateIngredientClusterRatings(data, ['taste', 'familiarity']) == ''
+    with app.app_context():
+      assert updateIngredientClusterRatings(data, ['taste', 'familiarity']) == ''
+      assert commitDocumentSession() == ''
+    assert commitDocumentSession() == ''
+  # Last writer wins, with the rating it averaged for its n_ratings
+  assert getUser(storage, 'rate-stale')['ic_taste'] == {'219': {'rating': 0, 'n_ratings': 2}}
+
+# The recipe data is not kept in the repository, it is added to ./data
+# before the image is built (see Dockerfile)
+@pytest.mark.skipif(not os.path.exists('./data/qchef_recipes.json'), reason='needs the recipe data in ./data')
+def test_recipe_ratings_update_the_recipe_and_its_ingredients(storage):
+  recipe_id = '94249'
+  assert getCatalog().hasRecipe(recipe_id)
+  setUser(storage, 'rate-recipe', {})
+  with app.app_context():
+    err = updateRecipeRatings({'userID': 'rate-recipe', 'taste_ratings': {recipe_id: 2},
+                               'familiarity_ratings': {recipe_id: 1}, 'surprise_ratings': {recipe_id: 0}},
+                              ['taste', 'familiarity', 'surprise'])
+    assert err == ''
+    assert commitDocumentSession() == ''
+  user_dict = getUser(storage, 'rate-recipe')
+  assert user_dict['r_taste'] == {recipe_id: {'rating': 1, 'n_ratings': 1}}
+  assert user_dict['r_familiarity'] == {recipe_id: {'rating': 0, 'n_ratings': 1}}
+  assert user_dict['r_surprise'] == {recipe_id: {'rating': -1, 'n_ratings': 1}}
+  ingredient_ids = [str(i) for i in getCatalog().recipeIngredientIDs(recipe_id) if i]
+  assert ingredient_ids
+  for ingredient_id in ingredient_ids:
+    assert user_dict['i_taste'][ingredient_id]['n_ratings'] >= 1
@@ -0,0 +1,108 @@
+################################################################################
+# Q-Chef Server
+# Authors: Q-Chef Backend Programmers
+# Updated: 20261018
+
+import pytest
+from firebase_admin import firestore
+
+from storage import LocalBackend
+
+USER_PATH = ('users', 'u1')
+
+################################################################################
+# Writes
+################################################################################
+def test_set_replaces_the_document(local_backend):
+  local_backend.commit([('set', USER_PATH, {'a': 1, 'b': {'c': 2}})])
+  local_backend.commit([('set', USER_PATH, {'b': {'d': 3}})])
+  assert local_backend.getDocument(USER_PATH) == {'b': {'d': 3}}
+
+def test_set_applies_increment_and_delete_field(local_backend):
+  local_backend.commit([('set', USER_PATH, {'n': firestore.Increment(2), 'gone': firestore.DELETE_FIELD})])
+  assert local_backend.getDocument(USER_PATH) == {'n': 2}
+
+def test_merge_keeps_other_fields(local_backend):
+  local_backend.commit([('set', USER_PATH, {'a': 1, 'm': {'x': 1, 'y': 2}})])
+  local_backend.commit([('merge', USER_PATH, {'m': {'y': 3, 'z': 4}})])
+  assert local_backend.getDocument(USER_PATH) == {'a': 1, 'm': {'x': 1, 'y': 3, 'z': 4}}
+
+def test_merge_with_increment_and_delete_field(local_backend):
+  local_backend.commit([('set', USER_PATH, {'m': {'n': 1, 'old': True}})])
+  local_backend.commit([('merge', USER_PATH, {'m': {'n': firestore.Increment(2), 'new': firestore.Increment(5), 'old': firestore.DELETE_FIELD}})])
+  assert local_backend.getDocument(USER_PATH) == {'m': {'n': 3, 'new': 5}}
+
+def test_merge_creates_a_missing_document(local_backend):
+  local_backend.commit([('merge', USER_PATH, {'n': firestore.Increment(1)})])
+  assert local_backend.getDocument(USER_PATH) == {'n': 1}
+
+def test_update_with_field_paths(local_backend):
+  local_backend.commit([('set', USER_PATH, {'ic_taste': {'219': {'rating': 1, 'n_ratings': 1}, '220': {'rating': 0, 'n_ratings': 1}}})])
+  local_backend.commit([('update', USER_PATH, {
+    'ic_taste.219.n_ratings': firestore.Increment(1),
+    'ic_taste.220': firestore.DELETE_FIELD,
+    'ic_taste.221': {'rating': -1, 'n_ratings': 1},
+  })])
+  assert local_backend.getDocument(USER_PATH) == {'ic_taste': {
+    '219': {'rating': 1, 'n_ratings': 2},
+    '221': {'rating': -1, 'n_ratings': 1},
+  }}
+
+def test_update_of_a_missing_document_raises(local_backend):
+  with pytest.raises(KeyError):
+    local_backend.commit([('update', USER_PATH, {'a': 1})])
+  assert local_backend.getDocument(USER_PATH) is None
+
+def test_delete(local_backend):
+  local_backend.commit([('set', USER_PATH, {'a': 1})])
+  local_backend.commit([('delete', USER_PATH, None)])
+  assert local_backend.getDocument(USER_PATH) is None
+
+def test_writes_to_one_document_apply_in_order(local_backend):
+  local_backend.commit([('set', USER_PATH, {'n': 1}),
+                        ('update', USER_PATH, {'n': firestore.Increment(1)}),
+                        ('merge', USER_PATH, {'m': 1})])
+  assert local_backend.getDocument(USER_PATH) == {'n': 2, 'm': 1}
+
+def test_read_documents_are_copies(local_backend):
+  local_backend.commit([('set', USER_PATH, {'m': {'a': 1}})])
+  local_backend.getDocument(USER_PATH)['m']['a'] = 2
+  assert local_backend.getDocuments([USER_PATH, ('users', 'u2')]) == [{'m': {'a': 1}}, None]
+
+################################################################################
+# Atomic Commits
+################################################################################
+def test_failed_commit_changes_nothing(local_backend):
+  local_backend.commit([('set', USER_PATH, {'n': 1})])
+  seen = []
+  local_backend.watchDocument(USER_PATH, seen.append)
+  with pytest.raises(KeyError):
+    local_backend.commit([('update', USER_PATH, {'n': firestore.Increment(1)}),
+                          ('set', ('users', 'u2'), {'n': 1}),
+                          ('update', ('users', 'missing'), {'n': 1})])
+  assert local_backend.getDocument(USER_PATH) == {'n': 1}
+  assert local_backend.getDocument(('users', 'u2')) is None
+  assert seen == [{'n': 1}]
+
+def test_unknown_operation_changes_nothing(local_backend):
+  with pytest.raises(ValueError):
+    local_backend.commit([('set', USER_PATH, {'n': 1}), ('upsert', USER_PATH, {'n': 2})])
+  assert local_backend.getDocument(USER_PATH) is None
+
+def test_failed_sqlite_commit_changes_nothing(tmp_path):
+  sqlite_fn = str(tmp_path / 'documents.db')
+  backend = LocalBackend(sqlite_fn)
+  backend.commit([('set', USER_PATH, {'n': 1, 'packed': b'\x00QCR'})])
+  with pytest.raises(KeyError):
+    backend.commit([('set', USER_PATH, {'n': 2}), ('update', ('users', 'missing'), {'n': 1})])
+  assert LocalBackend(sqlite_fn).getDocument(USER_PATH) == {'n': 1, 'packed': b'\x00QCR'}
+
+################################################################################
+# Watches
+################################################################################
+def test_watch_is_called_with_each_change(local_backend):
+  seen = []
+  local_backend.watchDocument(USER_PATH, seen.append)
+  local_backend.commit([('set', USER_PATH, {'n': 1})])
+  local_backend.commit([('delete', USER_PATH, None)])
+  assert seen == [None, {'n': 1}, None]
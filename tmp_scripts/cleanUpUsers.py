@@ -8,12 +8,18 @@
 
 # Change the lists within `Constants`.
 
-# This script runs through all specified file ids and deletes them from the specified collections in the database.
+# This script runs through all specified file ids and deletes them from the
+# specified collections in the database, along with all of their
+# subcollections (e.g. reviews/<user>/<recipe_id>/review and
+# actions/<user>/log/<month>).
+# The documents are found and deleted across a thread pool, in batches of
+# up to 500 deletes.
 
 ################################################################################
 # Imports
 ################################################################################
 import json, time
+from concurrent.futures import ThreadPoolExecutor
 
 import firebase_admin
 from firebase_admin import credentials
@@ -26,10 +32,81 @@ from firebase_admin import firestore
 # Holds the document ids to be deleted
 
 f_ids = ['0', '84']
-test_ids = ['userID'+str(i) for i in range(99)]
+test_ids = ['userID'+str(i) for i in range(100)]
 
 
 collection_ids = ['users', 'actions', 'reviews']
+
+BATCH_SIZE = 500 # Firestore's limit of writes per batch
+NUM_THREADS = 16
+
+################################################################################
+# Helper Functions
+################################################################################
+# findDocuments
+# Returns the document and every document in its subcollections (at any
+# depth), children before their parents. Documents that only exist as the
+# parent of a subcollection are included too.
+# - Input:
+#   - (doc_ref) doc_ref
+# - Output:
+#   - (list - doc_ref) documents
+def findDocuments(doc_ref):
+  doc_refs = []
+  for col_ref in doc_ref.collections():
+    for sub_doc_ref in col_ref.list_documents():
+      doc_refs += findDocuments(sub_doc_ref)
+  doc_refs.append(doc_ref)
+  return doc_refs
+
+################################################################################
+# deleteBatch
+# Deletes up to BATCH_SIZE documents in one batched write.
+# - Input:
+#   - (db) db,
+#   - (list - doc_ref) doc_refs
+# - Output:
+#   - (int) number of documents deleted
+def deleteBatch(db, doc_refs):
+  batch = db.batch()
+  for doc_ref in doc_refs:
+    batch.delete(doc_ref)
+  batch.commit()
+  return len(doc_refs)
+
+################################################################################
+# deleteUsers
+# Deletes the users' documents (and their subcollections) from each collection.
+# - Input:
+#   - (db) db,
+#   - (list - string) user_ids
+# - Output:
+#   - (int) number of documents deleted
+def deleteUsers(db, user_ids):
+  start = time.time()
+  with ThreadPoolExecutor(max_workers=NUM_THREADS) as executor:
+    # Find everything to delete, in parallel over the users
+    top_refs = [db.collection(c_id).document(u_id) for c_id in collection_ids for u_id in user_ids]
+    doc_refs = [doc_ref for found in executor.map(findDocuments, top_refs) for doc_ref in found]
+    found = time.time()
+    print(f"Found {len(doc_refs)} documents in {found - start:.2f}s")
+
+    # The batches are committed in parallel. If one fails, re-running the
+    # script still finds its documents, as list_documents also returns
+    # deleted parents that have subcollections.
+    batches = [doc_refs[i:i+BATCH_SIZE] for i in range(0, len(doc_refs), BATCH_SIZE)]
+    futures = [executor.submit(deleteBatch, db, batch) for batch in batches]
+    num_deleted = 0
+    for batch, future in zip(batches, futures):
+      try:
+        num_deleted += future.result()
+      except Exception as e:
+        print(f"Unable to delete {len(batch)} documents starting at {batch[0].path}, err = {e}")
+
+  elapsed = time.time() - start
+  print(f"Deleted {num_deleted}/{len(doc_refs)} documents in {len(batches)} batches, {elapsed:.2f}s ({num_deleted/max(elapsed, 1e-9):.1f} documents/s)")
+  return num_deleted
+
 ################################################################################
 # MAIN
 ################################################################################
@@ -43,28 +120,4 @@ if __name__ == "__main__":
 
   db = firestore.client()
 
-  for c_id in collection_ids:
-    for f_id in f_ids:
-      try:
-        doc_ref = db.collection(c_id).document(f_id)
-        try:
-          doc_ref.delete()
-          print(f"Deleted {c_id}/{f_id}")
-        except:
-          print(f"Unable to delete {c_id}/{f_id}")
-      except:
-        print(f"Unable to find {c_id}/{f_id}")
-
-
-  for c_id in collection_ids:
-    for test_id in test_ids:
-      try:
-        doc_ref = db.collection(c_id).document(test_id)
-        try:
-          doc_ref.delete()
-          print(f"Deleted {c_id}/{test_id}")
-        except:
-          print(f"Unable to delete {c_id}/{test_id}")
-      except:
-        print(f"Unable to find {c_id}/{test_id}")
-
+  deleteUsers(db, f_ids + test_ids)